@@ -3,6 +3,7 @@
 from __future__ import print_function    # Python 3 compatibility
 
 import os
+import time
 from math import pi, ceil
 import numpy as np
 import glob
@@ -10,13 +11,22 @@ import cv2
 
 import sys; sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "..", "python_libs"))
 from cv2_helpers import rgb, line, circle, putText, drawKeypointsAndMotion, drawAxisSystem, drawCamera, \
-                        Rodrigues, goodFeaturesToTrack, extractChessboardFeatures
+                        Rodrigues, extractChessboardFeatures, FeatureGrid
 import transforms as trfm
 import calibration_tools
 from calibration_tools import reprojection_error
-import triangulation
-from triangulation import iterative_LS_triangulation
-triangulation.set_triangl_output_dtype(np.float32)    # solvePnPRansac() seems to dislike float64...
+from triangulation import multiview_triangulation
+import motion_model
+from motion_model import ConstantVelocityModel
+from pose_optimization import optimize_pose
+import depth_filter
+from relocalization import KeyframeDatabase, relocalize, compute_descriptors, hamming_distances
+from place_recognition import BinaryVocabularyTree, LoopDetector, match_descriptors
+from pose_graph import sim3_from_poses, poses_from_sim3, sim3_compose, sim3_inverse, sim3_transform_points, \
+                       sim3_ransac, optimize_pose_graph
+from bundle_adjustment import LocalBundleAdjuster
+from chunked_columns import ChunkedColumns
+import ba_journal
 import color_tools
 from color_tools import sample_colors
 import dataset_tools
@@ -26,20 +36,6 @@ fontScale = 0.3
 
 
 
-def keypoint_mask(points):
-    """Returns a mask that covers the keypoints with False, using 'keypoint_coverage_radius' as radius."""
-    mask_img = np.ones((imageSize[1], imageSize[0]), dtype=np.uint8)
-    for p in points:
-        circle(mask_img, p, keypoint_coverage_radius, False, thickness=-1)
-    # <DEBUG: visualize mask>    TODO: remove
-    if __debug__:
-        print ("countZero:", cv2.countNonZero(mask_img), "(total):", mask_img.size)
-        cv2.imshow("img", mask_img*255)
-        cv2.waitKey()
-    # </DEBUG>
-    return mask_img
-
-
 def keyframe_test(points1, points2,
                   cameraMatrix, distCoeffs):
     """Returns True if the two images can be taken as keyframes."""
@@ -76,7 +72,7 @@ def check_triangulation_input(base_img, new_img,
 
 
 class Composite2DPainter:
-    
+
     def __init__(self, img_title, imageSize):
         self.img_title = img_title
         
@@ -86,9 +82,9 @@ class Composite2DPainter:
                   [(imageSize[0]-1,              0), (imageSize[0]-1, imageSize[1]-1)], 
                   [(imageSize[0]-1, imageSize[1]-1), (             0, imageSize[1]-1)],
                   [(             0, imageSize[1]-1), (             0,              0)] ]
-
+    
     def draw(self, img, rvec, tvec, status,
-            cameraMatrix, distCoeffs, triangl_idxs, nontriangl_idxs, all_idxs_tmp, new_imgp, imgp_to_objp_idxs, objp, objp_groups, group_id, color_palette, color_palette_size):    # TODO: move these variables to another class
+            cameraMatrix, distCoeffs, state, color_palette, color_palette_size):
         """
         Draw 2D composite view.
         
@@ -106,11 +102,13 @@ class Composite2DPainter:
             drawAxisSystem(self.img, cameraMatrix, distCoeffs, rvec, tvec)
             
             # Draw each already-triangulated point as a dot with text indicating depth w.r.t. the camera
-            imgp = idxs_get_new_imgp_by_idxs(triangl_idxs, new_imgp, all_idxs_tmp)
+            tracks, objp = state.tracks, state.map.objp
+            triangl = tracks.triangl
+            imgp = tracks.imgp[triangl]
             text_imgp = np.array(imgp)
             text_imgp += [(-15, 10)]    # adjust for text-position
-            objp_idxs = imgp_to_objp_idxs[np.array(sorted(triangl_idxs))]
-            groups = objp_groups[objp_idxs]
+            objp_idxs = tracks.objp_idxs[triangl]
+            groups = state.map.groups[objp_idxs]
             P = trfm.P_from_R_and_t(Rodrigues(rvec), tvec)
             objp_depth = trfm.projection_depth(objp[objp_idxs], P)
             objp_colors = color_palette[groups % color_palette_size]    # set color by group id
@@ -119,8 +117,8 @@ class Composite2DPainter:
                 putText(self.img, "%.3f" % opd, ipt, fontFace, fontScale, color)    # draw depths
             
             # Draw each to-be-triangulated point as a cross
-            nontriangl_imgp = idxs_get_new_imgp_by_idxs(nontriangl_idxs, new_imgp, all_idxs_tmp).astype(int)
-            color = color_palette[group_id % color_palette_size]
+            nontriangl_imgp = tracks.imgp[tracks.nontriangl].astype(int)
+            color = color_palette[state.group_id % color_palette_size]
             for p in nontriangl_imgp:
                 line(self.img, (p[0]-2, p[1]), (p[0]+2, p[1]), color)
                 line(self.img, (p[0], p[1]-2), (p[0], p[1]+2), color)
@@ -135,7 +133,7 @@ class Composite2DPainter:
         cv2.waitKey()
 
 class Composite3DPainter:
-        
+
     key_bindings = {
             "MoveLeft"      : [0x51],               # LEFT key
             "MoveRight"     : [0x53],               # RIGHT key
@@ -163,7 +161,7 @@ class Composite3DPainter:
         self.save_results_flag = False    # TODO: move this to other class
     
     def draw(self, rvec, tvec, status,
-             triangl_idxs, imgp_to_objp_idxs, objp, objp_colors, objp_groups, color_palette, color_palette_size, neg_fy):    # TODO: move these variables to another class
+             state, color_palette, color_palette_size, neg_fy):
         """
         Draw 3D composite view.
         Navigate using the following keys:
@@ -195,11 +193,12 @@ class Composite3DPainter:
                 drawAxisSystem(self.img, self.K, None, Rodrigues(self.P[0:3, 0:3]), self.P[0:3, 3])
             
             # Draw 3D points
+            tracks, objp, objp_colors, objp_groups = state.tracks, state.map.objp, state.map.colors, state.map.groups
             objp_proj, objp_visible = trfm.project_points(objp, self.K, self.img.shape, self.P)
-            objp_visible = set(np.where(objp_visible)[0])
-            current_idxs = set(imgp_to_objp_idxs[np.array(tuple(triangl_idxs))]) & objp_visible
-            done_idxs = np.array(tuple(objp_visible - current_idxs), dtype=int)
-            current_idxs = np.array(tuple(current_idxs), dtype=int)
+            objp_current = np.zeros(len(objp), dtype=bool)
+            objp_current[tracks.objp_idxs[tracks.triangl]] = True    # 3D points that are currently tracked
+            current_idxs = np.where(np.logical_and(objp_visible, objp_current))[0]
+            done_idxs = np.where(np.logical_and(objp_visible, np.logical_not(objp_current)))[0]
             if self.color_mode == 0:
                 colors = objp_colors[current_idxs].astype(float)
             elif self.color_mode == 1:
@@ -285,222 +284,413 @@ class Composite3DPainter:
         
         return False
 
-### Attempt to simplify re-indexing
-
-def idxs_get_new_imgp_by_idxs(selection_idxs,
-                              new_imgp, all_idxs_tmp):
-    """Get selection of new_imgp corresponding with selection_idxs (of which elements correspond with idxs in base_imgp).
-    type(selection_idxs) must be of type "set".
+def rows_by_ids(track_ids, ids):
     """
-    if selection_idxs:
-        new_imgp_sel = np.array([p for p, idx in zip(new_imgp, all_idxs_tmp) if idx in selection_idxs])
-        if len(new_imgp_sel):
-            return new_imgp_sel
-    return np.zeros((0, 2), dtype=np.float32)
-
-def idxs_update_by_idxs(preserve_idxs,
-                        triangl_idxs, nontriangl_idxs, all_idxs_tmp):
-    """Only preserve preserve_idxs (elements correspond with idxs in base_imgp).
-    type(preserve_idxs) must be of type "set".
-    To update new_imgp, first use idxs_get_new_imgp_by_idxs().
+    Returns the boolean mask of the elements of "track_ids" that are contained in "ids",
+    both should be ascending arrays of track ids.
     """
-    triangl_idxs &= preserve_idxs
-    nontriangl_idxs &= preserve_idxs
-    #print ("first approach (fastest):")
-    #print (np.array(sorted(preserve_idxs), dtype=int))
-    #print ("second approach:")
-    #print (np.array(tuple(set(tuple(preserve_idxs))), dtype=int))
-    #print ("third approach:")
-    #print (np.array([i for i in all_idxs_tmp if i in preserve_idxs]))
-    all_idxs_tmp = np.array(sorted(preserve_idxs), dtype=int)
-    return triangl_idxs, nontriangl_idxs, all_idxs_tmp
+    if not len(ids):
+        return np.zeros(len(track_ids), dtype=bool)
+    pos = np.minimum(np.searchsorted(ids, track_ids), len(ids) - 1)
+    return (ids[pos] == track_ids)
 
-def idxs_add_objp(objp_extra_container, triangl_idxs_extra,
-                  objp_container, imgp_to_objp_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp):
-    """Add new object-points objp_extra, they correspond with elements in base_imgp of which their idx is in triangl_idxs_extra.
-    With:
-        objp_container == (objp, objp_colors, objp_groups)
-        objp_extra_container == (objp_extra, objp_colors_extra, objp_groups_extra)
-    
-    type(triangl_idxs_extra) must be of type "set".
+class TrackTable:
     """
-    # NOTICE: see approaches explained in idxs_update_by_idxs() to compare indexing methods
-    (objp, objp_colors, objp_groups) = objp_container
-    (objp_extra, objp_colors_extra, objp_groups_extra) = objp_extra_container
-    imgp_to_objp_idxs[np.array(sorted(triangl_idxs_extra), dtype=int)] = np.arange(len(objp), len(objp) + len(objp_extra))
-    triangl_idxs |= triangl_idxs_extra
-    nontriangl_idxs -= triangl_idxs_extra
-    objp = np.concatenate((objp, objp_extra))
-    objp_colors = np.concatenate((objp_colors, objp_colors_extra))
-    objp_groups = np.concatenate((objp_groups, objp_groups_extra))
-    return (objp, objp_colors, objp_groups), imgp_to_objp_idxs, triangl_idxs, nontriangl_idxs
-
-def idxs_rebase_and_add_imgp(imgp_extra,
-                             base_imgp, new_imgp, imgp_to_objp_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp):
-    """Rebase all idxs to new_imgp, instead of to base_imgp; also add new image-points imgp_extra."""
-    imgp_to_objp_idxs = imgp_to_objp_idxs[all_idxs_tmp]
-    triangl_idxs = set(i for i, idx in enumerate(all_idxs_tmp) if idx in triangl_idxs)
-    nontriangl_idxs = set(i for i, idx in enumerate(all_idxs_tmp) if idx in nontriangl_idxs)
-    all_idxs_tmp = np.arange(len(all_idxs_tmp))
-    
-    extra_idxs = np.arange(len(new_imgp), len(new_imgp) + len(imgp_extra))
-    new_imgp = np.concatenate((new_imgp, imgp_extra))
-    nontriangl_idxs |= set(extra_idxs)
-    imgp_to_objp_idxs = np.concatenate((imgp_to_objp_idxs, -np.ones((len(imgp_extra)), dtype=int)))    # add '-1' idxs, because not-yet-triangl
-    all_idxs_tmp = np.concatenate((all_idxs_tmp, extra_idxs))
-    base_imgp = new_imgp
-    return base_imgp, new_imgp, imgp_to_objp_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp
+    Array-backed table of the tracked 2D points, with one row per live track.
+    The rows are always kept in order of ascending track id,
+    such that selection, compaction and appending of tracks are plain vectorized NumPy operations.
+    
+    Columns:
+        "ids" : unique id of each track
+        "states" : TrackTable.NONTRIANGL or TrackTable.TRIANGL
+        "objp_idxs" : index of the corresponding 3D point in objp, or -1 if not yet triangulated
+        "base_imgp" : 2D position in the last keyframe
+        "imgp" : 2D position in the current frame
+        "seeds" : inverse-depth filter of the point (see "depth_filter"), NaN if not initialized
+        "seed_rays" : unit ray of the point in the keyframe where its filter started, rotated to world coordinates
+        "seed_centers" : optical center of that keyframe, in world coordinates
+    The filters keep their own keyframe, also when the tracks are rebased to a newer one.
+    """
+    
+    NONTRIANGL = 0    # not yet triangulated
+    TRIANGL = 1    # already triangulated
+    
+    columns = ("ids", "states", "objp_idxs", "base_imgp", "imgp", "seeds", "seed_rays", "seed_centers")
+    
+    def __init__(self):
+        self.ids = np.zeros((0), dtype=int)
+        self.states = np.zeros((0), dtype=np.uint8)
+        self.objp_idxs = np.zeros((0), dtype=int)
+        self.base_imgp = np.zeros((0, 2), dtype=np.float32)
+        self.imgp = np.zeros((0, 2), dtype=np.float32)
+        self.seeds = np.zeros((0, depth_filter.num_seed_columns))
+        self.seed_rays = np.zeros((0, 3))
+        self.seed_centers = np.zeros((0, 3))
+        
+        self.next_id = 0    # id of the next to-be-added track
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def copy(self):
+        """Returns a deep copy of this table."""
+        tracks = TrackTable()
+        for column in self.columns:
+            setattr(tracks, column, np.array(getattr(self, column)))
+        tracks.next_id = self.next_id
+        return tracks
+    
+    @property
+    def triangl(self):
+        """Boolean mask of the rows of already-triangulated tracks."""
+        return (self.states == TrackTable.TRIANGL)
+    
+    @property
+    def nontriangl(self):
+        """Boolean mask of the rows of not-yet-triangulated tracks."""
+        return (self.states == TrackTable.NONTRIANGL)
+    
+    def rows_by_ids(self, ids):
+        """Boolean mask of the rows of which the track id is in "ids", an ascending array of track ids."""
+        return rows_by_ids(self.ids, ids)
+    
+    def compact(self, selection):
+        """
+        Only preserve the rows selected by "selection",
+        either a boolean mask, or an ascending array of row indices.
+        """
+        for column in self.columns:
+            setattr(self, column, getattr(self, column)[selection])
+    
+    def append(self, imgp_extra, objp_idxs_extra=None):
+        """
+        Add new tracks at 2D positions "imgp_extra", both in the current frame and in the last keyframe.
+        If "objp_idxs_extra" is given, the new tracks are linked to these (already-triangulated) 3D points.
+        """
+        num_extra = len(imgp_extra)
+        if objp_idxs_extra is None:
+            objp_idxs_extra = -np.ones((num_extra), dtype=int)    # '-1' idxs, because not-yet-triangl
+        
+        self.ids = np.concatenate((self.ids, np.arange(self.next_id, self.next_id + num_extra)))
+        self.states = np.concatenate((self.states, np.where(
+                objp_idxs_extra >= 0, TrackTable.TRIANGL, TrackTable.NONTRIANGL ).astype(np.uint8)))
+        self.objp_idxs = np.concatenate((self.objp_idxs, objp_idxs_extra))
+        self.base_imgp = np.concatenate((self.base_imgp, imgp_extra)).astype(np.float32)
+        self.imgp = np.concatenate((self.imgp, imgp_extra)).astype(np.float32)
+        self.seeds = np.concatenate((self.seeds, np.full((num_extra, depth_filter.num_seed_columns), np.nan)))
+        self.seed_rays = np.concatenate((self.seed_rays, np.full((num_extra, 3), np.nan)))
+        self.seed_centers = np.concatenate((self.seed_centers, np.full((num_extra, 3), np.nan)))
+        self.next_id += num_extra
+    
+    def rebase(self):
+        """Make the current frame the new keyframe of all tracks, their depth filters keep their own keyframe."""
+        self.base_imgp = np.array(self.imgp)
+    
+    def set_objp_idxs(self, rows, objp_idxs):
+        """Link the tracks of rows "rows" to the (freshly triangulated) 3D points "objp_idxs"."""
+        self.objp_idxs[rows] = objp_idxs
+        self.states[rows] = TrackTable.TRIANGL
 
 class TrackingEvent:
-    def __init__(self, frame_idx, imgp, all_idxs_tmp):
+    def __init__(self, frame_idx, imgp, track_ids, rvec, tvec):
         self.frame_idx = frame_idx
         self.imgp = imgp
-        self.all_idxs_tmp = all_idxs_tmp
+        self.track_ids = track_ids
+        self.rvec = rvec    # pose of the frame
+        self.tvec = tvec
+
+def observations_of_tracks(tracking_history, track_ids):
+    """
+    Collects the observations of the tracks with ids "track_ids" (an ascending array) in all events of "tracking_history",
+    grouped per track in a ragged (CSR) layout, as needed by "multiview_triangulation()".
+    
+    Returns the observed image-points, the index in "tracking_history" of the event of each observation,
+    and the observation offsets of each track.
+    """
+    track_pos, event_idxs, imgp = [], [], []
+    for event_idx, event in enumerate(tracking_history):
+        rows = rows_by_ids(event.track_ids, track_ids)
+        track_pos.append(np.searchsorted(track_ids, event.track_ids[rows]))
+        event_idxs.append(np.repeat(event_idx, np.count_nonzero(rows)))
+        imgp.append(event.imgp[rows])
+    track_pos = np.concatenate(track_pos)
+    order = np.argsort(track_pos, kind="mergesort")    # group by track, keep chronological order within each track
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(track_pos, minlength=len(track_ids)))))
+    return np.concatenate(imgp)[order], np.concatenate(event_idxs)[order], offsets
+
+class Map:
+    """
+    Map of triangulated 3D points, with per-point BGR color and group id,
+    and the observation statistics of each point, used to cull bad points (see "maintain_map()").
+    
+    The points are stored in buffers of which the capacity grows by doubling,
+    such that appending new points only costs O(# new points) amortized.
+    "objp", "colors", "groups", "num_observations" and "sum_sq_errors" are views on the live region of these buffers,
+    they are invalidated by the next call to "append()" or "compact()".
+    """
+    
+    _buffers = ("_objp", "_colors", "_groups", "_num_observations", "_sum_sq_errors")
+    
+    def __init__(self, capacity=1024):
+        self._objp = np.empty((capacity, 3), dtype=np.float32)    # solvePnPRansac() seems to dislike float64...
+        self._colors = np.empty((capacity, 3), dtype=np.uint8)
+        self._groups = np.empty((capacity), dtype=int)
+        self._num_observations = np.empty((capacity), dtype=int)
+        self._sum_sq_errors = np.empty((capacity), dtype=float)
+        self._size = 0
+    
+    def __len__(self):
+        return self._size
+    
+    @property
+    def objp(self):
+        """3D points."""
+        return self._objp[:self._size]
+    
+    @property
+    def colors(self):
+        """3D point BGR color, measured at pixel of the keyframe in which the point was added."""
+        return self._colors[:self._size]
+    
+    @property
+    def groups(self):
+        """3D point group ids, each new batch of detected points is put in a separate group."""
+        return self._groups[:self._size]
+    
+    @property
+    def num_observations(self):
+        """Amount of frames in which the 3D point was used for pose optimization."""
+        return self._num_observations[:self._size]
+    
+    @property
+    def sum_sq_errors(self):
+        """Sum of the squared reprojection errors (in pixels) of the 3D point over its observations."""
+        return self._sum_sq_errors[:self._size]
+    
+    @property
+    def rms_errors(self):
+        """RMS reprojection error (in pixels) of each 3D point over its observations, 0 if not yet observed."""
+        return np.sqrt(self.sum_sq_errors / np.maximum(self.num_observations, 1))
+    
+    def _reserve(self, capacity):
+        """Grow the buffers to at least "capacity" points, by doubling."""
+        if capacity <= len(self._objp):
+            return
+        new_capacity = max(capacity, 2 * len(self._objp))
+        for name in Map._buffers:
+            old = getattr(self, name)
+            new = np.empty((new_capacity, ) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+    
+    def append(self, objp_extra, colors_extra, group_id):
+        """
+        Add 3D points "objp_extra" with BGR colors "colors_extra", all assigned to group "group_id".
+        Returns the indices of the new points.
+        """
+        num_extra = len(objp_extra)
+        self._reserve(self._size + num_extra)
+        idxs = np.arange(self._size, self._size + num_extra)
+        self._objp[idxs] = objp_extra
+        self._colors[idxs] = colors_extra
+        self._groups[idxs] = group_id
+        self._num_observations[idxs] = 0
+        self._sum_sq_errors[idxs] = 0.
+        self._size += num_extra
+        return idxs
+    
+    def add_observations(self, idxs, errors):
+        """Count an observation of each of the 3D points "idxs", with reprojection errors "errors" (in pixels)."""
+        np.add.at(self._num_observations, idxs, 1)
+        np.add.at(self._sum_sq_errors, idxs, np.square(errors))
+    
+    def compact(self, selection):
+        """
+        Only preserve the 3D points selected by "selection", an ascending array of point indices,
+        the buffers keep their capacity.
+        Returns the new index of each old point, or -1 if it got removed.
+        """
+        new_idxs = -np.ones((self._size), dtype=int)
+        new_idxs[selection] = np.arange(len(selection))
+        for name in Map._buffers:
+            buffer = getattr(self, name)
+            buffer[:len(selection)] = buffer[selection]
+        self._size = len(selection)
+        return new_idxs
+
+class SlamState:
+    """
+    Everything the tracking needs to remember between two frames,
+    "handle_new_frame()" updates it in-place, and only if the frame is not rejected.
+    """
+    
+    def __init__(self, tracks, map, group_id, base_img, base_img_gray, rvec_keyfr, tvec_keyfr):
+        self.tracks = tracks    # "TrackTable" of both triangulated as not-yet triangl points
+        self.map = map    # "Map" of triangulated 3D points
+        self.group_id = group_id    # current 3D point group id
+        self.base_img = base_img    # last keyframe, used for color extraction and debug
+        self.prev_img_gray = base_img_gray    # grayscale version of last accepted frame, used to calculate OF
+        self.rvec_keyfr = rvec_keyfr    # rvec and tvec of last keyframe
+        self.tvec_keyfr = tvec_keyfr
+        self.tracking_history = []    # contains "TrackingEvent"s since the last keyframe
+        self.motion_model = ConstantVelocityModel()    # predicts the pose of the next frame from the last accepted ones
+        self.keyframe_db = KeyframeDatabase()    # descriptors of the 3D points observed in each keyframe, to relocalize
+        self.loop_detector = None    # "LoopDetector" of the keyframes, only used if a vocabulary is given
+        self.loop_candidates = []    # verified (frame_idx, revisited keyframe's frame_idx, num_inliers) tuples
+        self.loop_closures = []    # (frame_idx, revisited keyframe's frame_idx, Sim3 from the 1st to the 2nd camera) tuples
+        self.local_ba = None    # "LocalBundleAdjuster" over the last keyframes, only used if enabled
 
-def handle_new_frame(base_imgp,    # includes 2D points of both triangulated as not-yet triangl points of last keyframe
-                     prev_imgp,    # includes 2D points of last frame
-                     base_img,    # used for color extraction and debug
-                     prev_img, prev_img_gray,
+def handle_new_frame(state,    # "SlamState", updated in-place if the frame is accepted
                      new_img, new_img_gray,
-                     triangl_idxs, nontriangl_idxs,    # indices of 2D points in base_imgp
-                     imgp_to_objp_idxs,    # indices from 2D points in base_imgp to 3D points in objp
-                     all_idxs_tmp,    # list of idxs of 2D points in base_imgp, matches prev_imgp to base_imgp
-                     objp,    # triangulated 3D points
-                     objp_colors,    # BGR values of triangulated 3D points
-                     objp_groups, group_id,    # corresponding group ids of triangulated 3D points, and current group id
-                     rvec_keyfr, tvec_keyfr,    # rvec and tvec of last keyframe
-                     tracking_history,    # contains "TrackingEvent"s
                      frame_idx):    # the current frame index
     
-    # Save initial indexing state
-    triangl_idxs_old = set(triangl_idxs)
-    nontriangl_idxs_old = set(nontriangl_idxs)
-    all_idxs_tmp_old = np.array(all_idxs_tmp)
-    
-    # Calculate OF (Optical Flow), and filter outliers based on OF error
-    new_imgp, status_OF, err_OF = cv2.calcOpticalFlowPyrLK(prev_img_gray, new_img_gray, prev_imgp)    # WARNING: OpenCV can output corrupted values in 'status_OF': "RuntimeWarning: invalid value encountered in less"
-    new_to_prev_idxs = np.where(np.logical_and((status_OF.reshape(-1) == 1), (err_OF.reshape(-1) < max_OF_error)))[0]
-    
-    # If there is too much OF error in the entire image, simply reject the frame
-    lost_tracks_ratio = (len(prev_imgp) - len(new_to_prev_idxs)) / float(len(prev_imgp))
-    print ("# points lost because of excessive OF error / # points before: ", len(prev_imgp) - len(new_to_prev_idxs), "/", len(prev_imgp), "=", lost_tracks_ratio)
-    if lost_tracks_ratio > max_lost_tracks_ratio:    # reject frame
-        print ("REJECTED: I lost track of all points!\n")
-        #brisk = cv2.BRISK()#ORB()
-        #prev_keyp, prev_descr = brisk.compute(prev_img_gray, [cv2.KeyPoint(p[0], p[1], keypoint_coverage_radius) for p in prev_imgp])
-        #print ("lengths equal?:", len(prev_keyp), len(prev_imgp))
-        #print ("check keypoints:", np.array([prev_keyp[i].pt for i in range(len(prev_keyp))]))
-        #print ("check array:", np.array([prev_imgp[i] for i in range(len(prev_imgp))]))
-        #new_imgp = goodFeaturesToTrack(new_img_gray, len(prev_imgp), corner_quality_level, corner_min_dist)
-        #new_keyp, new_descr = brisk.compute(new_img_gray, [cv2.KeyPoint(p[0], p[1], keypoint_coverage_radius) for p in new_imgp])
-        ##FLANN_INDEX_KDTREE = 1    # BUG: this enum is missing in the Python OpenCV binding
-        ##index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-        #FLANN_INDEX_LSH = 6
-        #index_params= dict(algorithm = FLANN_INDEX_LSH,
-                    #table_number = 6, # 12
-                    #key_size = 12,     # 20
-                    #multi_probe_level = 1) #2
-        #search_params = dict(checks=50)
-        #flann = cv2.FlannBasedMatcher(index_params, search_params)
-        #matches = flann.knnMatch(prev_descr, new_descr, k=2)
-        ## store all the good matches as per Lowe's ratio test.
-        ##print ([i for i in matches])
-        #new_to_prev_idxs, kp1, kp2 = zip(*[
-                #(np.where(prev_imgp == prev_keyp[neighbors[0].queryIdx].pt)[0][0], prev_keyp[neighbors[0].queryIdx].pt, new_keyp[neighbors[0].trainIdx].pt)
-                #for neighbors in matches
-                #if neighbors and (len(neighbors) == 1 or neighbors[0].distance < 0.7*neighbors[1].distance) ])
-        #new_to_prev_idxs = np.array(new_to_prev_idxs, dtype=int)
-        ##flann = cv2.flann_Index(new_descr, index_params)
-        ##idx2, dist = flann.knnSearch(prev_descr, 2, params = {}) # bug: need to provide empty dict
-        ##mask = dist[:,0] / dist[:,1] < 0.6
-        ##idx1 = np.arange(len(prev_descr))
-        ##matches = np.int32( zip(idx1, idx2[:,0]) )[mask]
-        ##kp1, kp2 = zip(*[(prev_keyp[m.queryIdx].pt, new_keyp[m.trainIdx].pt) for m, n in matches])
-        #print ("Trying to recover from lost tracks, using flann matcher...")
-        ##while True:
-        #kp1 = np.array(kp1)
-        #kp2 = np.array(kp2)
-        #print ("kp1", kp1)
-        #print ("kp2", kp2)
-        #cv2.imshow("img", drawKeypointsAndMotion(new_img, kp1.astype(int), kp2.astype(int), rgb(0,0,255)))
-        #cv2.waitKey()
-        #new_imgp = np.array(kp2)
-        #lost_tracks_ratio = (len(prev_imgp) - len(new_to_prev_idxs)) / float(len(prev_imgp))
-        #print ("Re-evaluating 'lost_tracks_ratio': ", len(prev_imgp) - len(new_to_prev_idxs), "/", len(prev_imgp), "=", lost_tracks_ratio)
-        #if lost_tracks_ratio > max_lost_tracks_ratio:    # reject frame
-        return False, base_imgp, prev_imgp, base_img, triangl_idxs_old, nontriangl_idxs_old, imgp_to_objp_idxs, all_idxs_tmp_old, objp, objp_colors, objp_groups, group_id, None, None, rvec_keyfr, tvec_keyfr
-    
-    # Save matches by idxs
-    preserve_idxs = set(all_idxs_tmp[new_to_prev_idxs])
-    triangl_idxs, nontriangl_idxs, all_idxs_tmp = idxs_update_by_idxs(
-            preserve_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp )
-    if len(triangl_idxs) < 8:    # solvePnP uses 8-point algorithm
-        print ("REJECTED: I lost track of too many already-triangulated points, so we can't do solvePnP() anymore...\n")
-        return False, base_imgp, prev_imgp, base_img, triangl_idxs_old, nontriangl_idxs_old, imgp_to_objp_idxs, all_idxs_tmp_old, objp, objp_colors, objp_groups, group_id, None, None, rvec_keyfr, tvec_keyfr
-    new_imgp = new_imgp[new_to_prev_idxs]
+    # Work on a copy of the tracks, they're only committed to 'state' when the frame gets accepted
+    tracks = state.tracks.copy()
+    objp = state.map.objp
+    rvec_keyfr, tvec_keyfr = state.rvec_keyfr, state.tvec_keyfr
+    base_img = state.base_img
+    prev_img_gray = state.prev_img_gray
+    tracking_history = state.tracking_history
+    
+    # If enabled, predict the pose of the current frame with the motion model, and the image-points of the already-triangulated tracks
+    use_prior = (use_motion_model and state.motion_model.has_prediction)
+    if use_prior:
+        triangl = tracks.triangl
+        predicted_imgp = np.zeros_like(tracks.imgp)
+        rvec_predicted, tvec_predicted, predicted_imgp[triangl] = state.motion_model.predict_imgp(
+                frame_idx, objp[tracks.objp_idxs[triangl]], cameraMatrix, distCoeffs )
+    
+    # Calculate OF (Optical Flow), and filter outliers based on OF error;
+    # a prediction of the motion model is used as initial flow, such that less pyramid levels are needed
+    if use_prior:
+        new_imgp, status_OF, err_OF = cv2.calcOpticalFlowPyrLK(
+                prev_img_gray, new_img_gray, tracks.imgp, motion_model.initial_flow(tracks.imgp, predicted_imgp, triangl),
+                winSize=(lk_win_size, lk_win_size), maxLevel=lk_max_level_seeded, flags=cv2.OPTFLOW_USE_INITIAL_FLOW )
+    else:
+        new_imgp, status_OF, err_OF = cv2.calcOpticalFlowPyrLK(
+                prev_img_gray, new_img_gray, tracks.imgp, winSize=(lk_win_size, lk_win_size), maxLevel=lk_max_level)    # WARNING: OpenCV can output corrupted values in 'status_OF': "RuntimeWarning: invalid value encountered in less"
+    tracked = np.logical_and((status_OF.reshape(-1) == 1), (err_OF.reshape(-1) < max_OF_error))
+    
+    # Optionally track the remaining points back to the previous frame, and drop the ones that don't return close to their start
+    forward_tracked_rows = np.where(tracked)[0]
+    if max_fb_OF_error > 0 and len(forward_tracked_rows):
+        prev_imgp = tracks.imgp[forward_tracked_rows]
+        back_imgp, status_back_OF, err_back_OF = cv2.calcOpticalFlowPyrLK(
+                new_img_gray, prev_img_gray, new_imgp.reshape(-1, 2)[forward_tracked_rows], np.array(prev_imgp),    # start from original positions
+                winSize=(lk_win_size, lk_win_size), maxLevel=lk_max_level, flags=cv2.OPTFLOW_USE_INITIAL_FLOW )
+        fb_error = np.sqrt(((back_imgp.reshape(-1, 2) - prev_imgp)**2).sum(axis=1))    # round-trip error
+        tracked[forward_tracked_rows] = np.logical_and((status_back_OF.reshape(-1) == 1), (fb_error < max_fb_OF_error))
+        print ("# points lost because of excessive forward-backward OF error:", len(forward_tracked_rows) - np.count_nonzero(tracked))
+    
+    # If there is too much OF error in the entire image, tracking is lost: try to relocalize, otherwise reject the frame;
+    # only the forward OF counts here, the forward-backward check drops unreliable tracks, they aren't lost
+    num_lost_tracks = len(tracks) - len(forward_tracked_rows)
+    lost_tracks_ratio = num_lost_tracks / float(len(tracks))
+    print ("# points lost because of excessive OF error / # points before: ", num_lost_tracks, "/", len(tracks), "=", lost_tracks_ratio)
+    if lost_tracks_ratio > max_lost_tracks_ratio:
+        print ("I lost track of all points!")
+        return relocalize_frame(state, new_img, new_img_gray, frame_idx)
+    
+    # Save matches
+    num_triangl_before = np.count_nonzero(tracks.triangl)
+    tracks.imgp = new_imgp.reshape(-1, 2)
+    tracks.compact(tracked)
+    if use_prior:
+        predicted_imgp = predicted_imgp[tracked]    # keep aligned with the rows of 'tracks'
+    triangl = tracks.triangl
+    num_triangl = np.count_nonzero(triangl)
+    print ("OF inlier ratio (input of solvePnP):", num_triangl / float(max(1, num_triangl_before)))    # of the already-triangulated tracks
+    if num_triangl < 8:    # solvePnP uses 8-point algorithm
+        print ("I lost track of too many already-triangulated points, so we can't do solvePnP() anymore...")
+        return relocalize_frame(state, new_img, new_img_gray, frame_idx)
     #cv2.cornerSubPix(    # TODO: activate this secret weapon    <-- hmm, actually seems to make it worse
-                #new_img_gray, new_imgp,
+                #new_img_gray, tracks.imgp,
                 #(corner_min_dist,corner_min_dist),    # window
                 #(-1,-1),    # deadzone
                 #(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001) )    # termination criteria
         ##corners = corners.reshape(-1, 2)
     
-    # Do solvePnPRansac() on current frame's (new_imgp) already triangulated points, ...
-    triangl_idxs_array = np.array(sorted(triangl_idxs))    # select already-triangulated point-indices
-    filtered_triangl_imgp = idxs_get_new_imgp_by_idxs(triangl_idxs, new_imgp, all_idxs_tmp)    # collect corresponding image-points
-    filtered_triangl_objp = objp[imgp_to_objp_idxs[triangl_idxs_array]]    # collect corresponding object-points
-    print ("Doing solvePnP() on", filtered_triangl_objp.shape[0], "points")
-    rvec_, tvec_, inliers = cv2.solvePnPRansac(    # perform solvePnPRansac() to identify outliers, force to obey max_solvePnP_outlier_ratio
-            filtered_triangl_objp, filtered_triangl_imgp, cameraMatrix, distCoeffs, minInliersCount=int(ceil((1 - max_solvePnP_outlier_ratio) * len(triangl_idxs))), reprojectionError=max_solvePnP_reproj_error )
+    # Robustly optimize the pose on the current frame's already triangulated points,
+    # starting from the motion model's prediction, or from the pose of the last accepted frame, ...
+    filtered_triangl_imgp = tracks.imgp[triangl]    # collect image-points of already-triangulated tracks
+    filtered_triangl_objp_idxs = tracks.objp_idxs[triangl]
+    filtered_triangl_objp = objp[filtered_triangl_objp_idxs]    # collect corresponding object-points
+    filtered_triangl_imgpnrm = cv2.undistortPoints(np.array([filtered_triangl_imgp]), cameraMatrix, distCoeffs)[0]    # undistort and normalize to homogenous coordinates
+    focal_length = abs(cameraMatrix[0, 0])    # to convert between normalized and pixel units
+    min_inliers_count = max(8, int(ceil((1 - max_solvePnP_outlier_ratio) * num_triangl)))
+    print ("Doing pose optimization on", num_triangl, "points")
+    rvec_init, tvec_init = (rvec_predicted, tvec_predicted) if use_prior else state.motion_model.initial_pose(frame_idx)
+    rvec, tvec, residuals, weights, converged = optimize_pose(
+            filtered_triangl_objp, filtered_triangl_imgpnrm, rvec_init, tvec_init,
+            kernel=pose_optimization_kernel, threshold=max_solvePnP_reproj_error / focal_length )
+    inliers = np.where(residuals * focal_length <= max_solvePnP_reproj_error)[0]
+    
+    # ... if that results in too few inliers, the initial pose was too far off:
+    # find the inliers with solvePnPRansac() instead, and restart the optimization from its pose, ...
+    if len(inliers) < min_inliers_count:
+        print ("Pose optimization found too few inliers (%s), falling back to solvePnPRansac()" % len(inliers))
+        inliers = None
+        if use_prior:
+            # With a motion model prediction, points too far from their predicted position are outliers anyway,
+            # so RANSAC starts from the predicted pose on the remaining points only, and needs less iterations
+            gated_rows = np.where(motion_model.gate(filtered_triangl_imgp, predicted_imgp[triangl], max_motion_model_error))[0]
+            print ("# points outside of the motion model gate:", num_triangl - len(gated_rows))
+            if len(gated_rows) >= min_inliers_count:
+                rvec_, tvec_, inliers = cv2.solvePnPRansac(
+                        filtered_triangl_objp[gated_rows], filtered_triangl_imgp[gated_rows], cameraMatrix, distCoeffs,
+                        np.array(rvec_predicted), np.array(tvec_predicted), useExtrinsicGuess=True, iterationsCount=solvePnP_iterations_seeded,
+                        minInliersCount=min_inliers_count, reprojectionError=max_solvePnP_reproj_error )
+                if inliers is not None:
+                    inliers = gated_rows[inliers.reshape(-1)]
+            if inliers is None or len(inliers) < min_inliers_count:
+                print ("Motion model prediction failed, retrying solvePnPRansac() without it")
+                inliers = None
+        if inliers is None:
+            rvec_, tvec_, inliers = cv2.solvePnPRansac(    # perform solvePnPRansac() to identify outliers, force to obey max_solvePnP_outlier_ratio
+                    filtered_triangl_objp, filtered_triangl_imgp, cameraMatrix, distCoeffs, minInliersCount=min_inliers_count, reprojectionError=max_solvePnP_reproj_error )
+        if inliers is None:    # inliers is empty => reject frame
+            print ("REJECTED: No inliers based on solvePnP()!\n")
+            return False, None, None
+        rvec, tvec, residuals, weights, converged = optimize_pose(
+                filtered_triangl_objp, filtered_triangl_imgpnrm, rvec_, tvec_,
+                kernel=pose_optimization_kernel, threshold=max_solvePnP_reproj_error / focal_length )
+        inliers = np.where(residuals * focal_length <= max_solvePnP_reproj_error)[0]
+    print ("pose optimization converged:", converged, "    mean weight:", weights.mean())
     
     # ... if ratio of 'inliers' vs input is too low, reject frame, ...
-    if inliers == None:    # inliers is empty => reject frame
-        print ("REJECTED: No inliers based on solvePnP()!\n")
-        return False, base_imgp, prev_imgp, base_img, triangl_idxs_old, nontriangl_idxs_old, imgp_to_objp_idxs, all_idxs_tmp_old, objp, objp_colors, objp_groups, group_id, None, None, rvec_keyfr, tvec_keyfr
-    inliers = inliers.reshape(-1)
-    solvePnP_outlier_ratio = (len(triangl_idxs) - len(inliers)) / float(len(triangl_idxs))
+    solvePnP_outlier_ratio = (num_triangl - len(inliers)) / float(num_triangl)
     print ("solvePnP_outlier_ratio:", solvePnP_outlier_ratio)
     if solvePnP_outlier_ratio > max_solvePnP_outlier_ratio or len(inliers) < 8:    # reject frame
         if solvePnP_outlier_ratio > max_solvePnP_outlier_ratio:
-            print ("REJECTED: Not enough inliers (ratio) based on solvePnP()!\n")
+            print ("REJECTED: Not enough inliers (ratio) based on pose optimization!\n")
         else:
-            print ("REJECTED: Not enough inliers (absolute) based on solvePnP() to perform (non-RANSAC) solvePnP()!\n")
-        return False, base_imgp, prev_imgp, base_img, triangl_idxs_old, nontriangl_idxs_old, imgp_to_objp_idxs, all_idxs_tmp_old, objp, objp_colors, objp_groups, group_id, None, None, rvec_keyfr, tvec_keyfr
-    
-    # <DEBUG: visualize reprojection error>    TODO: remove
-    if __debug__:
-        reproj_error, imgp_reproj1 = reprojection_error(filtered_triangl_objp, filtered_triangl_imgp, cameraMatrix, distCoeffs, rvec_, tvec_)
-        print ("solvePnP reproj_error:", reproj_error)
-        i3 = np.array(new_img)
-        try:
-            for imgppr, imgppp in zip(filtered_triangl_imgp, imgp_reproj1): line(i3, imgppr.T, imgppp.T, rgb(255,0,0))
-        except OverflowError: print ("WARNING: OverflowError!")
-        cv2.imshow("img", i3)
-        cv2.waitKey()
-    # </DEBUG>
+            print ("REJECTED: Not enough inliers (absolute) based on pose optimization!\n")
+        return False, None, None
     
-    # ... then do solvePnP() on inliers, to get the current frame's pose estimation, ...
-    triangl_idxs_array = triangl_idxs_array[inliers]    # select inliers among all already-triangulated point-indices
+    # ... then only preserve the inliers, ...
     filtered_triangl_imgp, filtered_triangl_objp = filtered_triangl_imgp[inliers], filtered_triangl_objp[inliers]
-    preserve_idxs = set(triangl_idxs_array) | nontriangl_idxs
-    new_imgp = idxs_get_new_imgp_by_idxs(preserve_idxs, new_imgp, all_idxs_tmp)
-    triangl_idxs, nontriangl_idxs, all_idxs_tmp = idxs_update_by_idxs(    # update indices to only preserve inliers
-            preserve_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp )
-    ret, rvec, tvec = cv2.solvePnP(    # perform solvePnP() to estimate the pose
-            filtered_triangl_objp, filtered_triangl_imgp, cameraMatrix, distCoeffs, rvec_, tvec_, useExtrinsicGuess=True )
-    
-    # .. finally do a check on the average reprojection error, and reject frame if too high.
-    reproj_error, imgp_reproj = reprojection_error(filtered_triangl_objp, filtered_triangl_imgp, cameraMatrix, distCoeffs, rvec, tvec)
-    print ("solvePnP refined reproj_error:", reproj_error)
+    filtered_triangl_imgpnrm = filtered_triangl_imgpnrm[inliers]
+    preserve = np.logical_not(triangl)    # preserve all not-yet-triangulated tracks, ...
+    preserve[np.where(triangl)[0][inliers]] = True    # ... and the inliers among the already-triangulated ones
+    tracks.compact(preserve)
+    
+    # .. finally do a check on the average reprojection error of the inliers (the optimizer's residuals), and reject frame if too high.
+    reproj_error = np.sqrt(((residuals[inliers] * focal_length)**2).mean())
+    print ("pose optimization reproj_error:", reproj_error)
     if reproj_error > max_solvePnP_reproj_error:    # reject frame
-        print ("REJECTED: Too high reprojection error based on pose estimate of solvePnP()!\n")
-        return False, base_imgp, prev_imgp, base_img, triangl_idxs_old, nontriangl_idxs_old, imgp_to_objp_idxs, all_idxs_tmp_old, objp, objp_colors, objp_groups, group_id, None, None, rvec_keyfr, tvec_keyfr
+        print ("REJECTED: Too high reprojection error based on pose estimate of pose optimization!\n")
+        return False, None, None
+    
+    # Count the observations of the 3D points in this frame, with their reprojection errors (also of the outliers),
+    # to cull points that are rarely observed, or that are consistently off
+    state.map.add_observations(filtered_triangl_objp_idxs, residuals * focal_length)
     
     # <DEBUG: verify poses by reprojection error>    TODO: remove
     if __debug__:
+        imgp_reproj = reprojection_error(filtered_triangl_objp, filtered_triangl_imgp, cameraMatrix, distCoeffs, rvec, tvec)[1]
         i0 = drawAxisSystem(np.array(new_img), cameraMatrix, distCoeffs, rvec, tvec)
         try:
-            for imgppp in imgp_reproj1: circle(i0, imgppp.T, 2, rgb(255,0,0), thickness=-1)
+            for imgppr, imgppp in zip(filtered_triangl_imgp, imgp_reproj): line(i0, imgppr.T, imgppp.T, rgb(255,0,0))
         except OverflowError: print ("WARNING: OverflowError!")
         for imgppp in imgp_reproj : circle(i0, imgppp.T, 2, rgb(0,255,255), thickness=-1)
         print ("cur img check")
@@ -510,21 +700,23 @@ def handle_new_frame(base_imgp,    # includes 2D points of both triangulated as
     
     # <DEBUG: verify OpticalFlow motion on preserved inliers>    TODO: remove
     if __debug__:
-        cv2.imshow("img", drawKeypointsAndMotion(new_img, base_imgp[all_idxs_tmp], new_imgp, rgb(0,0,255)))
+        cv2.imshow("img", drawKeypointsAndMotion(new_img, tracks.base_imgp, tracks.imgp, rgb(0,0,255)))
         cv2.waitKey()
     # </DEBUG>
     
+    # Add tracking info for current frame, used for the triangulation at the next keyframe
+    tracking_history.append(TrackingEvent(frame_idx, tracks.imgp, tracks.ids, rvec, tvec))
+    
     # Add BA info (2D -> 3D) for current frame
     underdetermined_system = False
     if ba_info:
-        tracking_history.append(TrackingEvent(frame_idx, new_imgp, all_idxs_tmp))
-        tracked_triangl_points = idxs_get_new_imgp_by_idxs(triangl_idxs, new_imgp, all_idxs_tmp)
-        ba_info.add_points2D_3Dassoc(tracked_triangl_points, imgp_to_objp_idxs[triangl_idxs_array], frame_idx)
+        triangl = tracks.triangl
+        ba_info.add_points2D_3Dassoc(tracks.imgp[triangl], tracks.objp_idxs[triangl], frame_idx)
         
         ## Assuming 30% of the non-yet-triangulated points will get properly triangulated,
         ## see whether the to-be-added projective factors in the factor-graph
         ## will add enough constraints to solve for all tracked poses and nontriangl points.
-        #num_points3D = len(nontriangl_idxs) * 0.30
+        #num_points3D = np.count_nonzero(tracks.nontriangl) * 0.30
         #num_frames = len(tracking_history)
         #num_unknowns = 3 * num_points3D + 6 * num_frames
         #num_constraints = 2 * num_points3D * num_frames
@@ -532,30 +724,43 @@ def handle_new_frame(base_imgp,    # includes 2D points of both triangulated as
             #underdetermined_system = True
             #print ("Warning (hypothesis): num_unknowns (%s) > num_constraints (%s)" % (num_unknowns, num_constraints))
     
+    # Triangulate the not-yet-triangulated tracks of which the depth filter converged, without waiting for a keyframe
+    if use_depth_filter:
+        rows_done = update_depth_filters(state, tracks, frame_idx, rvec, tvec)
+        print ("# points triangulated by the depth filter:", len(rows_done))
+    
     # Check whether we got a new keyframe
     is_keyframe = (not underdetermined_system and 
-                   keyframe_test(base_imgp[all_idxs_tmp], new_imgp, cameraMatrix, distCoeffs))
+                   keyframe_test(tracks.base_imgp, tracks.imgp, cameraMatrix, distCoeffs))
     print ("is_keyframe:", is_keyframe)
     if is_keyframe:
-        # If some points are not yet triangulated, do it now:
-        if nontriangl_idxs:
+        # With depth filters, drop the not-yet-triangulated tracks of which the filter diverged (bad tracks), ...
+        deferred_rows = np.zeros((0), dtype=int)
+        if use_depth_filter:
+            tracks.compact(np.logical_not(np.logical_and(tracks.nontriangl, depth_filter.outlier_seeds(tracks.seeds))))
+            deferred_rows = np.where(np.logical_and(tracks.nontriangl, np.isfinite(tracks.seeds[:, depth_filter.MU])))[0]
+        
+        # ... the other filters continue w.r.t. their own keyframe, so only the other points get triangulated now, if any:
+        nontriangl_rows = np.where(tracks.nontriangl)[0]    # select rows of not-yet-triangulated tracks
+        nontriangl_rows = np.setdiff1d(nontriangl_rows, deferred_rows)
+        if len(nontriangl_rows):
             
-            # First do triangulation of not-yet triangulated points using initial pose estimation, ...
-            nontriangl_idxs_array = np.array(sorted(nontriangl_idxs))    # select not-yet-triangulated point-indices
-            imgp0 = base_imgp[nontriangl_idxs_array]    # collect corresponding image-points of last keyframe
-            imgp1 = idxs_get_new_imgp_by_idxs(nontriangl_idxs, new_imgp, all_idxs_tmp)    # collect corresponding image-points of current frame
+            # First do triangulation of not-yet triangulated points using all their observations since the last keyframe, ...
+            imgp0 = tracks.base_imgp[nontriangl_rows]    # collect corresponding image-points of last keyframe
+            imgp1 = tracks.imgp[nontriangl_rows]    # collect corresponding image-points of current frame
             # <DEBUG: check sanity of input to triangulation function>    TODO: remove
             if __debug__:
                 check_triangulation_input(base_img, new_img, imgp0, imgp1, rvec_keyfr, tvec_keyfr, rvec, tvec, cameraMatrix, distCoeffs)
             # </DEBUG>
-            imgpnrm0 = cv2.undistortPoints(np.array([imgp0]), cameraMatrix, distCoeffs)[0]    # undistort and normalize to homogenous coordinates
-            imgpnrm1 = cv2.undistortPoints(np.array([imgp1]), cameraMatrix, distCoeffs)[0]
-            objp_done, objp_done_status = iterative_LS_triangulation(    # triangulate
-                    imgpnrm0, trfm.P_from_R_and_t(Rodrigues(rvec_keyfr), tvec_keyfr),    # data from last keyframe
-                    imgpnrm1, trfm.P_from_R_and_t(Rodrigues(rvec), tvec) )               # data from current frame
-            inliers_objp_done = np.where(objp_done_status == 1)[0]
+            obs_imgp, obs_event_idxs, obs_offsets = observations_of_tracks(tracking_history, tracks.ids[nontriangl_rows])
+            obs_imgpnrm = cv2.undistortPoints(np.array([obs_imgp]), cameraMatrix, distCoeffs)[0]    # undistort and normalize to homogenous coordinates
+            Ps = np.array([trfm.P_from_rvec_and_tvec(event.rvec, event.tvec)[0:3, :] for event in tracking_history])    # using initial pose estimation of current frame
+            objp_done, objp_done_status, objp_done_residuals = multiview_triangulation(    # triangulate
+                    obs_imgpnrm, Ps, obs_event_idxs, obs_offsets, dtype=np.float32 )    # solvePnPRansac() seems to dislike float64...
+            objp_done_residuals *= abs(cameraMatrix[0, 0])    # from normalized to pixel units
             if __debug__:
                 print ("objp_done_status:", objp_done_status)
+                print ("objp_done_residuals:", objp_done_residuals)
             
             # <DEBUG: check reprojection error of the new freshly triangulated points, based on both pose estimates of keyframe and current cam>    TODO: remove
             if __debug__:
@@ -563,49 +768,34 @@ def handle_new_frame(base_imgp,    # includes 2D points of both triangulated as
                 print ("triangl_reproj_error 1:", reprojection_error(objp_done, imgp1, cameraMatrix, distCoeffs, rvec, tvec)[0])
             # </DEBUG>
             
-            # ... filter out outliers based on Iterative-LS triangulation convergence, and whether points are in front of all cameras, ...
+            # ... filter out outliers based on Iterative-LS triangulation convergence, whether points are in front of all cameras,
+            # and on the reprojection error over all views, ...
+            inliers_objp_done = np.where(np.logical_and(
+                    objp_done_status == 1, objp_done_residuals <= max_triangl_reproj_error ))[0]
             objp_done = objp_done[inliers_objp_done]
             imgp1 = imgp1[inliers_objp_done]
-            imgpnrm0 = imgpnrm0[inliers_objp_done]
-            imgpnrm1 = imgpnrm1[inliers_objp_done]
             filtered_triangl_objp_tmp = np.concatenate((filtered_triangl_objp, objp_done))    # collect all desired object-points
             filtered_triangl_imgp_tmp = np.concatenate((filtered_triangl_imgp, imgp1))    # collect corresponding image-points of current frame
-            nontriangl_idxs_array = nontriangl_idxs_array[inliers_objp_done]
+            nontriangl_rows = nontriangl_rows[inliers_objp_done]
             
-            # ... then do solvePnP() on all preserved points ('inliers') to refine pose estimation, ...
-            ret, rvec, tvec = cv2.solvePnP(    # perform solvePnP(), we start from the initial pose estimation
-                    filtered_triangl_objp_tmp, filtered_triangl_imgp_tmp, cameraMatrix, distCoeffs, rvec, tvec, useExtrinsicGuess=True )
+            # ... then optimize the pose on all preserved points ('inliers') to refine pose estimation.
+            # The new points are already constrained by all their views, so they're not re-triangulated with the refined pose.
+            imgp1nrm = cv2.undistortPoints(np.array([imgp1]), cameraMatrix, distCoeffs)[0]
+            rvec, tvec = optimize_pose(    # we start from the initial pose estimation
+                    filtered_triangl_objp_tmp, np.concatenate((filtered_triangl_imgpnrm, imgp1nrm)), rvec, tvec,
+                    kernel=pose_optimization_kernel, threshold=max_solvePnP_reproj_error / focal_length )[0:2]
             if __debug__:
                 print ("total triangl_reproj_error 1 refined:", reprojection_error(filtered_triangl_objp_tmp, filtered_triangl_imgp_tmp, cameraMatrix, distCoeffs, rvec, tvec)[0])    # TODO: remove
             
-            # ... then do re-triangulation of 'inliers_objp_done' using refined pose estimation.
-            objp_done, objp_done_status = iterative_LS_triangulation(    # triangulate
-                    imgpnrm0, trfm.P_from_R_and_t(Rodrigues(rvec_keyfr), tvec_keyfr),    # data from last keyframe
-                    imgpnrm1, trfm.P_from_R_and_t(Rodrigues(rvec), tvec) )               # data from current frame
-            if __debug__:
-                print ("objp_done_status refined:", objp_done_status)
-            
-            # Uncomment this to re-filter triangulation output, otherwise ...
-            inliers_objp_done = np.where(objp_done_status >= 0)[0]    # we only require points to lay in front of cam
-            objp_done = objp_done[inliers_objp_done]
-            imgp1 = imgp1[inliers_objp_done]
-            imgpnrm0 = imgpnrm0[inliers_objp_done]
-            imgpnrm1 = imgpnrm1[inliers_objp_done]
-            #filtered_triangl_objp = np.concatenate((filtered_triangl_objp, objp_done))    # collect all desired object-points
-            filtered_triangl_imgp = np.concatenate((filtered_triangl_imgp, imgp1))    # collect corresponding image-points of current frame
-            nontriangl_idxs_array = nontriangl_idxs_array[inliers_objp_done]
-            
-            ## ... uncomment this.
-            #filtered_triangl_imgp = filtered_triangl_imgp_tmp
-            
-            # Preserve all good indices
-            nontriangl_idxs_done = set(nontriangl_idxs_array)
-            preserve_idxs = triangl_idxs | nontriangl_idxs_done
+            # Preserve all good tracks
+            preserve = tracks.triangl
+            preserve[nontriangl_rows] = True
+            preserve[deferred_rows] = True
             
-            # <DEBUG: check reprojection error of the new freshly (refined) triangulated points, based on both pose estimates of keyframe and current cam>    TODO: remove
+            # <DEBUG: check reprojection error of the new freshly triangulated points, based on both pose estimates of keyframe and (refined) current cam>    TODO: remove
             if __debug__:
                 if len(inliers_objp_done):
-                    imgp0 = imgp0[inliers_objp_done]
+                    imgp0 = tracks.base_imgp[nontriangl_rows]
                     print ("triangl_reproj_error 0 refined:", reprojection_error(objp_done, imgp0, cameraMatrix, distCoeffs, rvec_keyfr, tvec_keyfr)[0])
                     print ("triangl_reproj_error 1 refined:", reprojection_error(objp_done, imgp1, cameraMatrix, distCoeffs, rvec, tvec)[0])
             # </DEBUG>
@@ -613,7 +803,7 @@ def handle_new_frame(base_imgp,    # includes 2D points of both triangulated as
             #if ba_info:
                 ## See whether the to-be-added projective factors in the factor-graph
                 ## add enough constraints to solve for all tracked poses and nontriangl points.
-                #num_points3D = len(nontriangl_idxs_done)
+                #num_points3D = len(nontriangl_rows)
                 #num_frames = len(tracking_history)
                 #num_unknowns = 3 * num_points3D + 6 * num_frames
                 #num_constraints = 2 * num_points3D * num_frames
@@ -621,30 +811,29 @@ def handle_new_frame(base_imgp,    # includes 2D points of both triangulated as
                     #print ("WARNING: num_unknowns (%s) > num_constraints (%s)" % (num_unknowns, num_constraints))
                     ## TODO: unmark as a keyframe, restore previous rvec and tvec, and bail out (= return (successfully))
             
-            # Update image-points and indices, and store the newly triangulated object-points and assign them the current group id
-            new_imgp = filtered_triangl_imgp
-            triangl_idxs, nontriangl_idxs, all_idxs_tmp = idxs_update_by_idxs(
-                    preserve_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp )
-            objp_colors_done = sample_colors(base_img, base_imgp[nontriangl_idxs_array])    # use colors of base-image, they don't have OF drift
-            objp_groups_done = np.empty((len(objp_done)), dtype=int); objp_groups_done.fill(group_id)    # assign to current 'group_id'
-            (objp, objp_colors, objp_groups), imgp_to_objp_idxs, triangl_idxs, nontriangl_idxs = idxs_add_objp(
-                    (objp_done, objp_colors_done, objp_groups_done), preserve_idxs - triangl_idxs, (objp, objp_colors, objp_groups), imgp_to_objp_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp )
-    
+            # Store the newly triangulated object-points and assign them the current group id, then update the tracks
+            objp_colors_done = sample_colors(base_img, tracks.base_imgp[nontriangl_rows])    # use colors of base-image, they don't have OF drift
+            objp_idxs_done = state.map.append(objp_done, objp_colors_done, state.group_id)    # assign to current 'group_id'
+            track_ids_done = tracks.ids[nontriangl_rows]
+            tracks.set_objp_idxs(nontriangl_rows, objp_idxs_done)
+            if state.local_ba and len(nontriangl_rows):    # the previous keyframe observes the new points as well
+                state.local_ba.add_observations(tracking_history[0].frame_idx, cv2.undistortPoints(
+                        np.array([tracks.base_imgp[nontriangl_rows]]), cameraMatrix, distCoeffs )[0], objp_idxs_done)
+            tracks.compact(preserve)
+            
             # Add BA info (2D -> new 3D) for all frames from previous keyframe to current frame
             if ba_info:
-                tracking_history[-1] = TrackingEvent(frame_idx, new_imgp, all_idxs_tmp)    # adjust prev tracking event
-                objp_idxs_done = imgp_to_objp_idxs[nontriangl_idxs_array]
+                tracking_history[-1] = TrackingEvent(frame_idx, tracks.imgp, tracks.ids, rvec, tvec)    # adjust prev tracking event
                 ba_info.set_point3DAddedIdxs(objp_idxs_done)
                 for event in tracking_history:
-                    tracked_nontriangl_points = idxs_get_new_imgp_by_idxs(
-                            nontriangl_idxs_done, event.imgp, event.all_idxs_tmp )
+                    tracked_nontriangl_points = event.imgp[rows_by_ids(event.track_ids, track_ids_done)]
                     ba_info.add_points2D_3Dassoc(tracked_nontriangl_points, objp_idxs_done, event.frame_idx)
             
             ## <DEBUG: check intermediate outlier filtering>    TODO: remove
             #if __debug__:
                 #i4 = np.array(new_img)
-                #objp_test = objp[imgp_to_objp_idxs[np.array(sorted(triangl_idxs))]]
-                #imgp_test = idxs_get_new_imgp_by_idxs(triangl_idxs, new_imgp, all_idxs_tmp)
+                #objp_test = objp[tracks.objp_idxs[tracks.triangl]]
+                #imgp_test = tracks.imgp[tracks.triangl]
                 ##print (imgp_test - filtered_triangl_imgp)
                 #reproj_error, imgp_reproj4 = reprojection_error(objp_test, imgp_test, cameraMatrix, distCoeffs, rvec, tvec)
                 #print ("checking both 2", reproj_error)
@@ -653,56 +842,432 @@ def handle_new_frame(base_imgp,    # includes 2D points of both triangulated as
                 #cv2.waitKey()
             ## </DEBUG>
         
+        # Reacquire the points of the last keyframes that are no longer tracked, before new points get added
+        if use_local_map_search:
+            reacquired_rows = search_local_map(state, tracks, new_img_gray, rvec, tvec)
+            print ("# points reacquired from the local map:", len(reacquired_rows))
+            if ba_info:
+                ba_info.add_points2D_3Dassoc(tracks.imgp[reacquired_rows], tracks.objp_idxs[reacquired_rows], frame_idx)
+        
+        # Jointly refine the poses of the last keyframes and the points they observe (local BA), and update the map
+        if state.local_ba:
+            triangl = tracks.triangl
+            state.local_ba.add_keyframe(frame_idx, rvec, tvec, cv2.undistortPoints(
+                    np.array([tracks.imgp[triangl]]), cameraMatrix, distCoeffs )[0], tracks.objp_idxs[triangl])
+            local_ba_result = state.local_ba.optimize(state.map.objp)
+            if local_ba_result is not None:
+                objp_idxs_adjusted, objp_adjusted, rms_before, rms_after = local_ba_result
+                state.map.objp[objp_idxs_adjusted] = objp_adjusted
+                rvec, tvec = state.local_ba.keyframes[-1].rvec, state.local_ba.keyframes[-1].tvec
+                print ("Local BA: refined %s points, RMS reprojection error: %.3f -> %.3f pixels" % (
+                        len(objp_idxs_adjusted), rms_before * focal_length, rms_after * focal_length ))
+        
+        # Cull and merge 3D points, such that the size of the map is bounded by the size of the scene, not by the run length
+        if use_map_maintenance:
+            num_culled, num_merged = maintain_map(state, tracks, rvec, tvec)
+            print ("Map maintenance: culled %s and merged %s points, %s points left" % (num_culled, num_merged, len(state.map)))
+        
         # Check whether we should add new image-points
-        mask_img = keypoint_mask(new_imgp)    # generate mask that covers all image-points (with a certain radius)
-        to_add = max(0, target_amount_keypoints - len(new_imgp))    # limit the amount of to-be-added image-points
+        to_add = max(0, target_amount_keypoints - len(tracks))    # limit the amount of to-be-added image-points
         if __debug__:
-            print ("coverage:", 1 - cv2.countNonZero(mask_img)/float(mask_img.size))    # TODO: remove: unused
+            print ("coverage:", feature_grid.coverage(tracks.imgp))    # TODO: remove: unused
         
-        # Add new image-points
+        # Add new image-points, only in the grid cells that are not yet populated enough by the tracks
         if to_add > 0:
             print ("to_add:", to_add)
-            imgp_extra = goodFeaturesToTrack(new_img_gray, to_add, corner_quality_level, corner_min_dist, None, mask_img)
+            imgp_extra = feature_grid.detect(new_img_gray, tracks.imgp, to_add, corner_quality_level, corner_min_dist)
             print ("added:", len(imgp_extra))
-            group_id += 1    # create a new group to assign the new batch of points to, later on
+            state.group_id += 1    # create a new group to assign the new batch of points to, later on
         else:
             imgp_extra = np.zeros((0, 2), dtype=np.float32)
             print ("adding zero new points")
-        base_imgp, new_imgp, imgp_to_objp_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp = idxs_rebase_and_add_imgp(    # update indices to include new image-points
-                imgp_extra, base_imgp, new_imgp, imgp_to_objp_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp )
+        tracks.rebase()    # the current frame becomes the base of all tracks, ...
+        tracks.append(imgp_extra)    # ... and of the new image-points
         
         # <DEBUG: visualize newly added points>    TODO: remove
         if __debug__:
             cv2.imshow("img", cv2.drawKeypoints(new_img, [cv2.KeyPoint(p[0],p[1], 7.) for p in imgp_extra], color=rgb(0,0,255)))
             cv2.waitKey()
         # </DEBUG>
-    
+        
         # Add BA info (odometry) for current frame
         if ba_info:
             # TODO: replace with 8-point or 5-point relative pose estimation (+ scale compensation)
             odometry = trfm.delta_P(trfm.P_from_rvec_and_tvec(rvec, tvec),
                                     trfm.P_from_rvec_and_tvec(rvec_keyfr, tvec_keyfr))
             ba_info.add_odometry(odometry, tracking_history[0].frame_idx, frame_idx)
-            del tracking_history[:]    # reset tracking history in case of a new keyframe
-            tracking_history.append(TrackingEvent(frame_idx, new_imgp, all_idxs_tmp))
         
-        # Now this frame becomes the base (= keyframe)
-        rvec_keyfr = rvec
-        tvec_keyfr = tvec
-        base_img = new_img
+        # Reset tracking history in case of a new keyframe
+        del tracking_history[:]
+        tracking_history.append(TrackingEvent(frame_idx, tracks.imgp, tracks.ids, rvec, tvec))
+        
+        # Now this frame becomes the base (= keyframe), and can be used to relocalize later on
+        state.rvec_keyfr = rvec
+        state.tvec_keyfr = tvec
+        state.base_img = new_img
+        triangl = tracks.triangl
+        state.keyframe_db.add_keyframe(frame_idx, rvec, tvec, new_img_gray, tracks.imgp[triangl], tracks.objp_idxs[triangl])
+        detect_loop(state, new_img_gray, frame_idx)
+    
+    # Successfully return, this frame becomes the previous frame of the next one
+    state.tracks = tracks
+    state.prev_img_gray = new_img_gray
+    state.motion_model.update(frame_idx, rvec, tvec)
+    return True + int(is_keyframe), rvec, tvec
+
+def update_depth_filters(state,    # "SlamState", of which 'state.map' gets the newly triangulated points
+                         tracks,    # "TrackTable" of the current frame, updated in-place
+                         frame_idx, rvec, tvec):    # the current frame index, and its pose
+    """
+    Update the inverse-depth filters (see "depth_filter") of all not-yet-triangulated tracks
+    with the depth measured by triangulating their ray in the keyframe where their filter started
+    with their ray in the current frame; new filters start in the last keyframe.
+    The tracks of which the filter converged, and of which the point reprojects well in the current frame,
+    are added to the map, with their observations since the last keyframe.
+    Returns the rows of the newly triangulated tracks.
+    """
+    rows = np.where(tracks.nontriangl)[0]
+    keyframe = state.tracking_history[0]
+    R_keyfr, t_keyfr = cv2.Rodrigues(keyframe.rvec)[0], keyframe.tvec.reshape(3)
+    R_cur, t_cur = cv2.Rodrigues(rvec)[0], tvec.reshape(3)
+    
+    def rays(imgp):
+        imgpnrm = cv2.undistortPoints(np.array([imgp]), cameraMatrix, distCoeffs)[0]
+        f = np.concatenate((imgpnrm, np.ones((len(imgpnrm), 1))), axis=1)
+        return f / np.sqrt((f**2).sum(axis=1))[:, None]
+    
+    # Start the new filters in the last keyframe, with the depths of the already-triangulated points in the keyframe
+    new_rows = rows[np.isnan(tracks.seeds[rows, depth_filter.MU])]
+    if len(new_rows):
+        depths = state.map.objp[tracks.objp_idxs[tracks.triangl]].dot(R_keyfr[2]) + t_keyfr[2]
+        depths = depths[depths > 0]
+        if len(depths):
+            tracks.seeds[new_rows] = depth_filter.init_seeds(len(new_rows), np.median(depths), depths.min())
+            tracks.seed_rays[new_rows] = rays(tracks.base_imgp[new_rows]).dot(R_keyfr)    # to world orientation
+            tracks.seed_centers[new_rows] = -R_keyfr.T.dot(t_keyfr)
+    rows = rows[np.isfinite(tracks.seeds[rows, depth_filter.MU])]
+    if not len(rows):
+        return rows
+    
+    # Measure the depths along the rays of their keyframes, and update the filters;
+    # the reference frame of each ray has world orientation and origin at the optical center of its keyframe
+    focal_length = abs(cameraMatrix[0, 0])
+    f_ref, centers_ref, f_cur = tracks.seed_rays[rows], tracks.seed_centers[rows], rays(tracks.imgp[rows])
+    t = centers_ref.dot(R_cur.T) + t_cur    # from the reference frame of each ray to the current frame
+    depths = depth_filter.depths_from_triangulation(f_ref, f_cur, R_cur, t)
+    taus = depth_filter.depth_uncertainties(f_ref, depths, -R_cur.T.dot(t_cur) - centers_ref,
+                                            2 * np.arctan(depth_filter_px_noise / (2 * focal_length)))
+    seeds = tracks.seeds[rows]
+    depth_filter.update_seeds(seeds, depths, taus)
+    tracks.seeds[rows] = seeds
+    
+    # Points of the converged filters, only kept if in front of the current frame and if they reproject well
+    converged = np.where(depth_filter.converged_seeds(seeds, depth_filter_convergence_ratio))[0]
+    objp_converged = centers_ref[converged] + f_ref[converged] / seeds[converged, depth_filter.MU][:, None]
+    points_cur = objp_converged.dot(R_cur.T) + t_cur
+    reproj_errors = np.sqrt(((points_cur[:, 0:2] / points_cur[:, 2:3] - f_cur[converged, 0:2] / f_cur[converged, 2:3])**2).sum(axis=1))
+    good = np.logical_and(points_cur[:, 2] > 0, reproj_errors * focal_length <= max_triangl_reproj_error)
+    rows_done = rows[converged[good]]
+    if not len(rows_done):
+        return rows_done
+    objp_done = objp_converged[good].astype(np.float32)
+    
+    # Store the new points in the current group, then update the tracks
+    objp_colors_done = sample_colors(state.base_img, tracks.base_imgp[rows_done])
+    objp_idxs_done = state.map.append(objp_done, objp_colors_done, state.group_id)
+    track_ids_done = tracks.ids[rows_done]
+    tracks.set_objp_idxs(rows_done, objp_idxs_done)
+    if state.local_ba:    # the keyframe observes the new points as well
+        state.local_ba.add_observations(keyframe.frame_idx, cv2.undistortPoints(
+                np.array([tracks.base_imgp[rows_done]]), cameraMatrix, distCoeffs )[0], objp_idxs_done)
+    
+    # Add BA info (2D -> new 3D) for all frames from the keyframe to the current frame
+    if ba_info:
+        ba_info.set_point3DAddedIdxs(objp_idxs_done)
+        for event in state.tracking_history:
+            ba_info.add_points2D_3Dassoc(event.imgp[rows_by_ids(event.track_ids, track_ids_done)], objp_idxs_done, event.frame_idx)
+    
+    return rows_done
+
+def maintain_map(state,    # "SlamState", of which 'state.map' is culled and compacted in-place
+                 tracks,    # "TrackTable" of the current frame, updated in-place
+                 rvec, tvec):    # pose of the current frame
+    """
+    Bound the size of the map by culling and merging 3D points:
+    points that are no longer tracked and were observed in less than 'min_point_observations' frames,
+    and points of which the RMS reprojection error over all their observations exceeds 'max_point_reproj_error', are culled;
+    the remaining points are hashed into voxels of 'map_merge_voxel_ratio' times the median depth of the current frame,
+    and the points of each voxel are merged into the most observed one.
+    The map is then compacted, and all references to its points ("tracks", 'state.keyframe_db' and 'state.local_ba')
+    are remapped in bulk; the tracks of culled points are dropped.
+    Returns the amount of culled and of merged points.
+    """
+    slam_map = state.map
+    triangl = tracks.triangl
+    tracked = np.zeros(len(slam_map), dtype=bool)
+    tracked[tracks.objp_idxs[triangl]] = True
+    culled = np.logical_or(
+            np.logical_and(np.logical_not(tracked), slam_map.num_observations < min_point_observations),
+            slam_map.rms_errors > max_point_reproj_error )
+    
+    # Hash the remaining points into voxels, and sort them per voxel, most observed first
+    candidates = np.where(np.logical_not(culled))[0]
+    depths = trfm.projection_depth(slam_map.objp[tracks.objp_idxs[triangl]], trfm.P_from_rvec_and_tvec(rvec, tvec))
+    voxel_size = map_merge_voxel_ratio * np.median(depths)
+    voxels = np.floor(slam_map.objp[candidates] / voxel_size).astype(np.int64)
+    order = np.lexsort((-slam_map.num_observations[candidates], voxels[:, 2], voxels[:, 1], voxels[:, 0]))
+    candidates, voxels = candidates[order], voxels[order]
+    first = np.ones(len(candidates), dtype=bool)
+    first[1:] = np.any(voxels[1:] != voxels[:-1], axis=1)
+    
+    # Merge each point into the first point of its voxel, which inherits its observations
+    targets = -np.ones(len(slam_map), dtype=int)
+    targets[candidates] = candidates[first][np.cumsum(first) - 1]
+    merged = candidates[np.logical_not(first)]
+    np.add.at(slam_map.num_observations, targets[merged], slam_map.num_observations[merged])
+    np.add.at(slam_map.sum_sq_errors, targets[merged], slam_map.sum_sq_errors[merged])
+    
+    # Compact the map, and remap the references to it
+    new_idxs = slam_map.compact(np.sort(candidates[first]))
+    new_idxs = np.where(targets >= 0, new_idxs[targets], -1)
+    tracks.objp_idxs[triangl] = new_idxs[tracks.objp_idxs[triangl]]
+    tracks.compact(np.logical_or(np.logical_not(triangl), tracks.objp_idxs >= 0))
+    state.keyframe_db.remap_objp_idxs(new_idxs)
+    if state.local_ba:
+        state.local_ba.remap_objp_idxs(new_idxs)
+    
+    return np.count_nonzero(culled), len(merged)
+
+def search_local_map(state,    # "SlamState", of which the 3D points of the last keyframes are searched
+                     tracks,    # "TrackTable" of the current frame, the reacquired points are appended to it
+                     new_img_gray,
+                     rvec, tvec):    # pose of the current frame
+    """
+    Reacquire the 3D points observed in the last 'local_map_keyframes' keyframes that are no longer tracked,
+    e.g. after an occlusion or an OF error, such that they aren't triangulated again as new (duplicate) points.
+    The points are projected into the current frame, and matched by descriptor (of their latest keyframe observation)
+    against new corners of the current frame at most 'local_map_search_radius' pixels away from their projection;
+    the corners are only detected in the cells of 'feature_grid' that are not yet populated enough by the tracks.
+    Returns the rows of the new tracks of the reacquired points.
+    """
+    no_rows = np.zeros(0, dtype=int)
+    keyframe_db = state.keyframe_db
+    keyframe_idxs = range(max(0, len(keyframe_db) - local_map_keyframes), len(keyframe_db))
+    if not len(keyframe_idxs):
+        return no_rows
+    objp_idxs = np.concatenate([keyframe_db.keyframes[k].objp_idxs for k in keyframe_idxs])
+    descriptors = np.concatenate([keyframe_db.keyframe_descriptors(k) for k in keyframe_idxs])
+    
+    # The local map: the existing points that are not tracked, each with its latest descriptor
+    objp_idxs, latest = np.unique(objp_idxs[::-1], return_index=True)
+    descriptors = descriptors[::-1][latest]
+    tracked = np.zeros(len(state.map), dtype=bool)
+    tracked[tracks.objp_idxs[tracks.triangl]] = True
+    local = np.where(objp_idxs >= 0)[0]    # culled points are -1
+    local = local[np.logical_not(tracked[objp_idxs[local]])]
+    objp_idxs, descriptors = objp_idxs[local], descriptors[local]
+    
+    # Project them into the current frame, only keep the ones in front of the camera and inside the image
+    objp = state.map.objp[objp_idxs]
+    in_front = (trfm.projection_depth(objp, trfm.P_from_rvec_and_tvec(rvec, tvec)) > 0)
+    objp_idxs, descriptors, objp = objp_idxs[in_front], descriptors[in_front], objp[in_front]
+    if not len(objp_idxs):
+        return no_rows
+    imgp_proj = cv2.projectPoints(objp, rvec, tvec, cameraMatrix, distCoeffs)[0].reshape(-1, 2)
+    inside = np.logical_and(np.logical_and(0 <= imgp_proj[:, 0], imgp_proj[:, 0] < imageSize[0]),
+                            np.logical_and(0 <= imgp_proj[:, 1], imgp_proj[:, 1] < imageSize[1]))
+    objp_idxs, descriptors, imgp_proj = objp_idxs[inside], descriptors[inside], imgp_proj[inside]
+    if not len(objp_idxs):
+        return no_rows
+    
+    # Detect and describe the corners to match against
+    corners = feature_grid.detect(new_img_gray, tracks.imgp, target_amount_keypoints, corner_quality_level, corner_min_dist)
+    corner_descriptors, corner_rows = compute_descriptors(keyframe_db.extractor, new_img_gray, corners)
+    corners = corners[corner_rows]
+    
+    # Compare each projection with the corners around it, and only keep its closest match, ...
+    proj_idxs, corner_idxs = feature_grid.pairs_within(imgp_proj, corners, local_map_search_radius)
+    distances = hamming_distances(descriptors[proj_idxs], corner_descriptors[corner_idxs])
+    close = (distances <= local_map_max_distance)
+    proj_idxs, corner_idxs, distances = proj_idxs[close], corner_idxs[close], distances[close]
+    order = np.lexsort((distances, proj_idxs))
+    proj_idxs, corner_idxs, distances = proj_idxs[order], corner_idxs[order], distances[order]
+    first = np.ones(len(proj_idxs), dtype=bool)
+    first[1:] = (proj_idxs[1:] != proj_idxs[:-1])
+    proj_idxs, corner_idxs, distances = proj_idxs[first], corner_idxs[first], distances[first]
+    
+    # ... and each corner can only be matched once, to its closest projection
+    order = np.lexsort((distances, corner_idxs))
+    proj_idxs, corner_idxs = proj_idxs[order], corner_idxs[order]
+    first = np.ones(len(corner_idxs), dtype=bool)
+    first[1:] = (corner_idxs[1:] != corner_idxs[:-1])
+    proj_idxs, corner_idxs = proj_idxs[first], corner_idxs[first]
+    
+    num_tracks = len(tracks)
+    tracks.append(corners[corner_idxs], objp_idxs[proj_idxs])
+    return np.arange(num_tracks, len(tracks))
+
+def detect_loop(state,    # "SlamState", of which 'state.loop_detector' is updated in-place
+                new_img_gray, frame_idx):
+    """
+    Look for earlier keyframes that show the same place as the new keyframe (loop-closure candidates),
+    and add the new keyframe to 'state.loop_detector'; does nothing if no vocabulary is loaded.
+    The new keyframe should already be added to 'state.keyframe_db'.
+    For each candidate, the similarity transformation between both keyframes is estimated from their matched 3D points,
+    if it is consistent enough it is added to 'state.loop_closures', to close the loop at the end (see "close_loops()").
+    """
+    if state.loop_detector is None:
+        return
+    
+    keypoints, descriptors = state.keyframe_db.extractor.detectAndCompute(new_img_gray, None)
+    if descriptors is None or not len(keypoints):
+        return
+    imgp = np.array([kp.pt for kp in keypoints], dtype=np.float32)
+    
+    bow_vector, loops = state.loop_detector.detect(imgp, descriptors)
+    for loop_frame_idx, score, F, num_inliers in loops:
+        print ("Loop-closure candidate: keyframe", loop_frame_idx, "with score %.3f and" % score, num_inliers, "inliers")
+        state.loop_candidates.append((frame_idx, loop_frame_idx, num_inliers))
+        
+        sim3, num_sim3_inliers = estimate_loop_sim3(state.keyframe_db, state.map.objp, loop_frame_idx)
+        if num_sim3_inliers >= min_loop_closure_inliers:
+            print ("Loop closure accepted: scale %.3f, with" % np.exp(sim3[6]), num_sim3_inliers, "consistent 3D points")
+            state.loop_closures.append((frame_idx, loop_frame_idx, sim3))
+    state.loop_detector.add_keyframe(frame_idx, imgp, descriptors, bow_vector)
+
+def estimate_loop_sim3(keyframe_db, objp, loop_frame_idx):
+    """
+    Estimate the similarity transformation (Sim3, see "pose_graph.sim3_from_poses()") from the camera of
+    the last keyframe of "keyframe_db" to the camera of its earlier keyframe "loop_frame_idx",
+    using the 3D points ("objp") they observe with matching descriptors;
+    the scale accounts for the scale drift of the map in between.
+    Returns the Sim3 and its amount of inliers.
+    """
+    keyframe_frame_idxs = [keyframe.frame_idx for keyframe in keyframe_db.keyframes]
+    loop_keyframe_idx = np.searchsorted(keyframe_frame_idxs, loop_frame_idx)
+    keyframe, loop_keyframe = keyframe_db.keyframes[-1], keyframe_db.keyframes[loop_keyframe_idx]
+    idxs, loop_idxs = match_descriptors(keyframe_db.keyframe_descriptors(len(keyframe_db) - 1),
+                                        keyframe_db.keyframe_descriptors(loop_keyframe_idx))
+    valid = np.logical_and(keyframe.objp_idxs[idxs] >= 0, loop_keyframe.objp_idxs[loop_idxs] >= 0)    # skip culled points
+    idxs, loop_idxs = idxs[valid], loop_idxs[valid]
+    
+    # The matched 3D points in the camera coordinates of both keyframes, only if in front of both
+    points = objp[keyframe.objp_idxs[idxs]].dot(cv2.Rodrigues(keyframe.rvec)[0].T) + keyframe.tvec.reshape(1, 3)
+    loop_points = objp[loop_keyframe.objp_idxs[loop_idxs]].dot(cv2.Rodrigues(loop_keyframe.rvec)[0].T) + \
+                  loop_keyframe.tvec.reshape(1, 3)
+    in_front = np.logical_and(points[:, 2] > 0, loop_points[:, 2] > 0)
+    
+    sim3, inliers = sim3_ransac(points[in_front], loop_points[in_front],
+                                threshold=max_solvePnP_reproj_error / abs(cameraMatrix[0, 0]))
+    return sim3, np.count_nonzero(inliers)
+
+def relocalize_frame(state,    # "SlamState", updated in-place if relocalization succeeds
+                     new_img, new_img_gray,
+                     frame_idx):    # the current frame index
+    """
+    Try to recover from tracking loss, by relocalizing the current frame against the keyframes of 'state.keyframe_db'.
+    On success, tracking restarts from the relocalized features, and this frame becomes a new keyframe.
+    Returns the same as "handle_new_frame()".
+    """
+    print ("Trying to relocalize against", len(state.keyframe_db), "keyframes...")
+    relocalization = relocalize(state.keyframe_db, state.map.objp, new_img_gray, cameraMatrix, distCoeffs,
+                                max_reproj_error=max_solvePnP_reproj_error, min_inliers=min_relocalization_inliers)
+    if relocalization is None:
+        print ("REJECTED: Relocalization failed!\n")
+        return False, None, None
+    rvec, tvec, imgp, objp_idxs = relocalization
+    print ("Relocalized using", len(imgp), "points")
+    
+    # Restart tracking from the relocalized features, which are already triangulated, ...
+    tracks = TrackTable()
+    tracks.next_id = state.tracks.next_id    # keep track ids unique
+    tracks.append(imgp, objp_idxs)
+    
+    # ... and add new image-points, in a new group
+    to_add = max(0, target_amount_keypoints - len(tracks))
+    imgp_extra = feature_grid.detect(new_img_gray, tracks.imgp, to_add, corner_quality_level, corner_min_dist)
+    print ("added:", len(imgp_extra))
+    tracks.append(imgp_extra)
+    state.group_id += 1
     
-    # Successfully return
-    return True + int(is_keyframe), base_imgp, new_imgp, base_img, triangl_idxs, nontriangl_idxs, imgp_to_objp_idxs, all_idxs_tmp, objp, objp_colors, objp_groups, group_id, rvec, tvec, rvec_keyfr, tvec_keyfr
+    # Add BA info (2D -> 3D, and odometry) for current frame
+    if ba_info:
+        ba_info.add_points2D_3Dassoc(imgp, objp_idxs, frame_idx)
+        odometry = trfm.delta_P(trfm.P_from_rvec_and_tvec(rvec, tvec),
+                                trfm.P_from_rvec_and_tvec(state.rvec_keyfr, state.tvec_keyfr))
+        ba_info.add_odometry(odometry, state.tracking_history[0].frame_idx, frame_idx)
+    
+    # This frame becomes the new keyframe, the motion before the tracking loss is meaningless now
+    del state.tracking_history[:]
+    state.tracking_history.append(TrackingEvent(frame_idx, tracks.imgp, tracks.ids, rvec, tvec))
+    state.rvec_keyfr = rvec
+    state.tvec_keyfr = tvec
+    state.base_img = new_img
+    state.keyframe_db.add_keyframe(frame_idx, rvec, tvec, new_img_gray, imgp, objp_idxs)
+    detect_loop(state, new_img_gray, frame_idx)
+    if state.local_ba:
+        state.local_ba.add_keyframe(frame_idx, rvec, tvec,
+                                    cv2.undistortPoints(np.array([imgp]), cameraMatrix, distCoeffs)[0], objp_idxs)
+    state.tracks = tracks
+    state.prev_img_gray = new_img_gray
+    state.motion_model.reset()
+    state.motion_model.update(frame_idx, rvec, tvec)
+    return 2, rvec, tvec
 
 
+def close_loops(state,    # "SlamState", of which the points of 'state.map' are corrected in-place
+                rvecs, tvecs):    # poses of all frames, corrected in-place
+    """
+    Close the loops of 'state.loop_closures' by optimizing the pose graph of the keyframes (with Sim3 poses),
+    which corrects the drift of the trajectory and the map, including the scale drift.
+    
+    The odometry edges connect consecutive keyframes, their measurements are the relative poses between them,
+    the same as the odometry of the BA info; the loop-closure edges connect the keyframes of each loop.
+    Other frames and the 3D points follow the correction of their reference keyframe:
+    the last keyframe before the frame, or the first keyframe that observed the point.
+    """
+    keyframe_frame_idxs = np.array([keyframe.frame_idx for keyframe in state.keyframe_db.keyframes])
+    poses = sim3_from_poses([rvecs[f] for f in keyframe_frame_idxs], [tvecs[f] for f in keyframe_frame_idxs])
+    num_keyframes = len(poses)
+    
+    edges_from = np.concatenate((np.arange(num_keyframes - 1),
+                                 np.searchsorted(keyframe_frame_idxs, [f for f, loop_f, sim3 in state.loop_closures])))
+    edges_to = np.concatenate((np.arange(1, num_keyframes),
+                               np.searchsorted(keyframe_frame_idxs, [loop_f for f, loop_f, sim3 in state.loop_closures])))
+    measurements = np.concatenate((sim3_compose(poses[1:], sim3_inverse(poses[:-1])),
+                                   np.array([sim3 for f, loop_f, sim3 in state.loop_closures])))
+    
+    time_start = time.time()
+    poses_corrected, rms_before, rms_after = optimize_pose_graph(poses, edges_from, edges_to, measurements)
+    print ("Closed %s loops over %s keyframes: RMS residual %.4f -> %.4f, in %.3f seconds" % (
+            len(state.loop_closures), num_keyframes, rms_before, rms_after, time.time() - time_start))
+    corrections = sim3_compose(sim3_inverse(poses_corrected), poses)    # from old to corrected world coordinates
+    
+    # Correct the poses of the (accepted) frames, relative to their reference keyframe
+    frame_idxs = np.array([f for f, rvec in enumerate(rvecs) if rvec is not None], dtype=int)
+    ref_keyframes = np.searchsorted(keyframe_frame_idxs, frame_idxs, side="right") - 1
+    frame_poses = sim3_from_poses([rvecs[f] for f in frame_idxs], [tvecs[f] for f in frame_idxs])
+    frame_rvecs, frame_tvecs = poses_from_sim3(sim3_compose(frame_poses, sim3_inverse(corrections[ref_keyframes])))
+    for f, rvec, tvec in zip(frame_idxs, frame_rvecs, frame_tvecs):
+        rvecs[f], tvecs[f] = rvec.reshape(3, 1), tvec.reshape(3, 1)
+    
+    # Correct the 3D points, points that no keyframe observes follow the previous point (points are added in order)
+    ref_keyframes = np.full(len(state.map), -1, dtype=int)
+    for keyframe_idx in range(num_keyframes - 1, -1, -1):
+        objp_idxs = state.keyframe_db.keyframes[keyframe_idx].objp_idxs
+        ref_keyframes[objp_idxs[objp_idxs >= 0]] = keyframe_idx    # culled points are -1
+    observed = np.maximum.accumulate(np.where(ref_keyframes >= 0, np.arange(len(ref_keyframes)), 0))
+    ref_keyframes = np.maximum(ref_keyframes[observed], 0)
+    state.map.objp[:] = sim3_transform_points(corrections[ref_keyframes], state.map.objp.astype(float))
+
 def write_output(traj_out_file, fps, rvecs, tvecs,
-                 map_out_file, triangl_idxs, imgp_to_objp_idxs, objp, color_mode, color_palette, color_palette_size, objp_groups, objp_colors):
+                 map_out_file, state, color_mode, color_palette, color_palette_size):
     # Save trajectory
     if traj_out_file:
         print ("Saving trajectory...")
         Ps = []
         for rvec, tvec in zip(rvecs, tvecs):
-            if rvec == None == tvec:
+            if rvec is None and tvec is None:
                 Ps.append(None)    # bad frame
             else:
                 Ps.append(trfm.P_from_rvec_and_tvec(rvec, tvec))
@@ -713,6 +1278,7 @@ def write_output(traj_out_file, fps, rvecs, tvecs,
     # Save map
     if map_out_file:
         print ("Saving map pointcloud...")
+        tracks, objp, objp_colors, objp_groups = state.tracks, state.map.objp, state.map.colors, state.map.groups
         
         ## Visualize lifetime by group-number, ...
         #max_lifetime = float(np.max(objp_groups))
@@ -723,7 +1289,7 @@ def write_output(traj_out_file, fps, rvecs, tvecs,
         
         # ... or visualize lifetime by 1 if currently triangulated point, 0 otherwise
         objp_group_lifetime = np.zeros((len(objp_groups), 1))
-        objp_group_lifetime[imgp_to_objp_idxs[np.array(tuple(triangl_idxs))]] = 1
+        objp_group_lifetime[tracks.objp_idxs[tracks.triangl]] = 1
         
         # Export colors of the selected color-mode
         if color_mode == 0:
@@ -741,127 +1307,106 @@ def write_output(traj_out_file, fps, rvecs, tvecs,
 
 
 class BundleAdjustmentInfoContainer:
+    """
+    Collects the measurements for offline BA, and appends them to a binary journal at the end of each step,
+    see "ba_journal.py"; "write_all()" converts the journal to the text files read by the offline BA.
+    
+    The 2D observations of 3D points are stored in an append-only columnar table, one row per observation,
+    observations added during a step are stored contiguously, starting at row 'step_starts[step]'.
+    The 2D point idx of an observation is its index among all observations of the same frame and camera.
+    """
     
     def __init__(self, base_dir, base_name, num_cams):
         self.base_dir = base_dir
         self.base_name = base_name
         self.num_cams = num_cams
         
-        self.calibrations = [None] * num_cams
-        self.odometry = []
-        self.odometryAssocs = []
-        self.points2D = [[] for cam in range(num_cams)]
-        self.point2D3DAssocs = [[] for cam in range(num_cams)]
-        self.point3DAddedIdxs = []
-        self.objp_2Dassoc = []    # TODO: move this outside BA, only used for loop closure
+        self.journal_file = os.path.join(base_dir, "BA_info.journal-%s.bin" % base_name)
+        self.journal = ba_journal.JournalWriter(self.journal_file)
+        self.odometry = []    # odometry records of the current step
+        self.observations = ChunkedColumns([    # 29 bytes per observation
+                ("frame", np.int32), ("point2DIdx", np.int32), ("point3DIdx", np.int32),
+                ("x", np.float64), ("y", np.float64), ("cam", np.uint8) ])
+        self.step_starts = []
+        self.num_points2D = [[] for cam in range(num_cams)]    # per camera, the amount of 2D points of each frame
+        self.point3DAddedIdxs = []    # 3D points added in the current step
+        self.num_points3D = 0
         
         self.step = -1
         self.next_step()
     
     def next_step(self):
-        self.odometry.append([])
-        self.odometryAssocs.append([])
-        for cam in range(self.num_cams):
-            self.points2D[cam].append(np.zeros((0, 2)))
-            self.point2D3DAssocs[cam].append(np.zeros((0, 3), dtype=int))
-        self.point3DAddedIdxs.append([])
+        if self.step >= 0:
+            self.write_step()
         self.step += 1
+        self.journal.write(ba_journal.STEP, self.step, np.zeros(0, dtype=np.int32))
+        self.step_starts.append(len(self.observations))
+        for cam in range(self.num_cams):
+            self.num_points2D[cam].append(0)
+    
+    def write_step(self):
+        """Append the measurements of the current step to the journal, and flush it."""
+        if self.odometry:
+            self.journal.write(ba_journal.ODOMETRY, self.step, np.array(self.odometry, dtype=ba_journal.odometry_dtype))
+        start = self.step_starts[self.step]
+        if len(self.observations) > start:
+            observations = np.empty(len(self.observations) - start, dtype=ba_journal.observation_dtype)
+            for name in observations.dtype.names:
+                observations[name] = self.observations.column(name, start)
+            self.journal.write(ba_journal.OBSERVATIONS, self.step, observations)
+        if len(self.point3DAddedIdxs):
+            self.journal.write(ba_journal.POINTS3D_ADDED, self.step, np.asarray(self.point3DAddedIdxs, dtype=np.int32))
+        self.odometry = []
+        self.point3DAddedIdxs = []
+        self.journal.flush()
     
     def set_calibration(self, K, distCoeffs, cam=0):
-        self.calibrations[cam] = (K, distCoeffs)
+        calibration = np.zeros(1, dtype=ba_journal.calibration_dtype)
+        calibration["cam"], calibration["K"] = cam, K
+        distCoeffs = np.ravel(distCoeffs)[:5]
+        calibration["distCoeffs"][0, :len(distCoeffs)] = distCoeffs
+        self.journal.write(ba_journal.CALIBRATION, self.step, calibration)
     
     def add_odometry(self, odometry, from_frame, to_frame, from_cam=0, to_cam=0):
-        self.odometry[self.step].append(odometry)
-        self.odometryAssocs[self.step].append((from_cam, from_frame, to_cam, to_frame))
+        q, l = trfm.pose_TUM_from_P(odometry)
+        self.odometry.append((tuple(l.ravel()) + tuple(q.ravel()), from_cam, from_frame, to_cam, to_frame))
     
     def add_points2D_3Dassoc(self, points2D, point3DIdxs, frame, cam=0):
-        assocs = np.empty((len(points2D), 3), dtype=int)
-        assocs[:, 0] = frame
-        assocs[:, 1] = np.arange(len(self.points2D[cam][frame]), len(self.points2D[cam][frame]) + len(points2D))
-        assocs[:, 2] = point3DIdxs
-        self.points2D[cam][frame] = np.concatenate((self.points2D[cam][frame], points2D))
-        self.point2D3DAssocs[cam][self.step] = np.concatenate((self.point2D3DAssocs[cam][self.step], assocs))
-        for point3DIdx, point2DIdx in zip(point3DIdxs, assocs[:, 1]):
-            self.objp_2Dassoc[point3DIdx].append((cam, frame, point2DIdx))
+        points2D = np.asarray(points2D).reshape(-1, 2)
+        first_point2DIdx = self.num_points2D[cam][frame]
+        self.observations.append(
+                frame=frame, point2DIdx=np.arange(first_point2DIdx, first_point2DIdx + len(points2D)), point3DIdx=point3DIdxs,
+                x=points2D[:, 0], y=points2D[:, 1], cam=cam )
+        self.num_points2D[cam][frame] += len(points2D)
     
     def set_point3DAddedIdxs(self, point3DAddedIdxs):
-        self.point3DAddedIdxs[self.step] = point3DAddedIdxs
-        self.objp_2Dassoc += [[] for i in range(len(point3DAddedIdxs))]
-    
-    def write_file(self, title, lines, cam=-1, omit_base_name=False):
-        lines.append("")    # empty line at end
-        filename = "BA_info.%s%s%s.txt" % (
-                title, (".cam%s" % cam) * (cam > -1), ("-%s" % self.base_name) * (not omit_base_name) )
-        open(os.path.join(self.base_dir, filename), 'w').write('\n'.join(lines))
-    
-    def write_calibrations(self, cam):
-        K, distCoeffs = self.calibrations[cam]
-        if distCoeffs[4] != 0.:
-            raise AttributeError("GTSAM doesn't support 6th order radial distorion coefficients, "
-                                 "recalibrate using a lower order model, or fix GTSAM.")
-        lines = []
-        lines.append("# Format: fx fy shear u0 v0 k1 k2 p1 p2")
-        lines.append("%.16e %.16e %.16e %.16e %.16e %.16e %.16e %.16e %.16e" % (
-                (K[0, 0], K[1, 1], K[0, 1], K[0, 2], K[1, 2]) + tuple(distCoeffs[:4]) ))
-        self.write_file("calibrations", lines, cam, omit_base_name=True)
-    
-    def write_odometry(self):
-        lines = []
-        lines.append("# Format: tx ty tz qx qy qz qw")
-        lines.append("# Newline means next odometry; Empty line means next step")
-        for step, odometry_step in enumerate(self.odometry):
-            if step: lines.append("")    # empty line between steps
-            for P in odometry_step:
-                q, l = trfm.pose_TUM_from_P(P)
-                lines.append("%.16e %.16e %.16e %.16e %.16e %.16e %.16e" % (tuple(l) + tuple(q)))
-        self.write_file("measurements.odometry", lines)
-    
-    def write_odometryAssocs(self):
-        lines = []
-        lines.append("# Format: from_cam from_frame to_cam to_frame")
-        lines.append("# Newline means next odometry; Empty line means next step")
-        for step, odometryAssocs_step in enumerate(self.odometryAssocs):
-            if step: lines.append("")    # empty line between steps
-            lines += [' '.join(map(str, assoc)) for assoc in odometryAssocs_step]
-        self.write_file("measurements.odometryAssocs", lines)
-    
-    def write_points2D(self, cam):
-        lines = []
-        lines.append("# Format: x y")
-        lines.append("# Newline means next feature; Empty line means next frame, first feature")
-        for step, points2D_step in enumerate(self.points2D[cam]):
-            if step: lines.append("")    # empty line between steps
-            for imgp in points2D_step:
-                lines.append("%.16e %.16e" % tuple(imgp))
-        self.write_file("measurements.points2D", lines, cam)
-    
-    def write_point2D3DAssocs(self, cam):
-        lines = []
-        lines.append("# Format: frameIdx point2DIdx point3DIdx")
-        lines.append("# Newline means next feature; Empty line means next step, first feature")
-        for step, point2D3DAssocs_step in enumerate(self.point2D3DAssocs[cam]):
-            if step: lines.append("")    # empty line between steps
-            lines += [' '.join(map(str, assoc)) for assoc in point2D3DAssocs_step]
-        self.write_file("measurements.point2D3DAssocs", lines, cam)
-    
-    def write_point3DAddedIdxs(self):
-        lines = []
-        lines.append("# Format: point3DIdx")
-        lines.append("# Newline means next point; Empty line means next step")
-        for step, point3DAddedIdxs_step in enumerate(self.point3DAddedIdxs):
-            if step: lines.append("")    # empty line between steps
-            lines += tuple(map(str, point3DAddedIdxs_step))
-        self.write_file("measurements.point3DAddedIdxs", lines)
+        """Add 3D points to the ones added in the current step, they may get added in multiple batches."""
+        self.point3DAddedIdxs = np.concatenate((self.point3DAddedIdxs, point3DAddedIdxs)).astype(int)
+        self.num_points3D += len(point3DAddedIdxs)
+    
+    def observations_by_frame(self, cam=0):
+        """
+        Returns the observations of camera "cam" grouped per frame (CSR layout), in order of their 2D point idx:
+        the offsets of each frame, and the 2D points and 3D point idxs of the observations.
+        """
+        offsets, (x, y, point3DIdxs) = self.observations.csr(
+                "frame", len(self.num_points2D[cam]), ("x", "y", "point3DIdx"), self.observations.column("cam") == cam )
+        return offsets, np.stack((x, y), axis=1), point3DIdxs
+    
+    def observations_by_point3D(self):
+        """
+        Returns the observations grouped per 3D point (CSR layout), e.g. to find the frames in which a point was seen:
+        the offsets of each 3D point, and the camera, frame and 2D point idx of the observations.
+        """
+        offsets, (cams, frames, point2DIdxs) = self.observations.csr(
+                "point3DIdx", self.num_points3D, ("cam", "frame", "point2DIdx") )
+        return offsets, cams, frames, point2DIdxs
     
     def write_all(self):
         print ("Writing all BA_info files...")
-        for cam in range(self.num_cams):
-            self.write_calibrations(cam)
-            self.write_points2D(cam)
-            self.write_point2D3DAssocs(cam)
-        self.write_odometry()
-        self.write_odometryAssocs()
-        self.write_point3DAddedIdxs()
+        self.write_step()
+        self.journal.close()
+        ba_journal.journal_to_text(self.journal_file, self.base_dir, self.base_name)
         print ("Done.")
 
 
@@ -984,11 +1529,61 @@ def parse_cmd_args():
     parser.add_argument("-d", "--use-debug", dest="use_debug",
                         type=int, default=1,
                         help="show debug prints and images (default: 1)")
+    parser.add_argument("-H", "--headless", dest="headless",
+                        type=int, default=0,
+                        help="run without any GUI (no windows, no key-waits) as fast as possible, "
+                             "and report the frame-rate at the end; implies --use-debug=0 (default: 0)")
+    parser.add_argument("-P", "--prefetch-depth", dest="prefetch_depth",
+                        type=int, default=4,
+                        help="number of images to load and convert to grayscale in advance, on background threads; "
+                             "set to 0 to load each image synchronously (default: 4)")
+    parser.add_argument("--lk-levels", dest="lk_levels",
+                        type=int, default=3,
+                        help="maximal pyramid level (0-based) of the Lucas-Kanade optical flow (default: 3)")
+    parser.add_argument("--lk-win-size", dest="lk_win_size",
+                        type=int, default=21,
+                        help="size of the search window at each pyramid level of the Lucas-Kanade optical flow (default: 21)")
+    parser.add_argument("--fb-OF-threshold", dest="fb_OF_threshold",
+                        type=float, default=0.,
+                        help="maximal forward-backward (round-trip) optical flow error in pixels of a track, "
+                             "tracks with a higher error are dropped before solvePnP; set to 0 to disable (default: 0)")
+    parser.add_argument("--motion-model", dest="motion_model",
+                        type=int, default=0,
+                        help="predict the pose of each frame with a constant-velocity motion model, "
+                             "to seed the optical flow and solvePnPRansac, and to gate its input (default: 0)")
+    parser.add_argument("--motion-model-lk-levels", dest="motion_model_lk_levels",
+                        type=int, default=1,
+                        help="maximal pyramid level (0-based) of the Lucas-Kanade optical flow, "
+                             "when seeded by the motion model (default: 1)")
+    parser.add_argument("--depth-filter", dest="depth_filter",
+                        type=int, default=0,
+                        help="estimate the depth of each not-yet-triangulated track in every frame with an inverse-depth filter, "
+                             "and add it to the map as soon as its depth converged, instead of only at the next keyframe (default: 0)")
+    parser.add_argument("--local-BA-window", dest="local_BA_window",
+                        type=int, default=0,
+                        help="amount of last keyframes to jointly refine with the points they observe (local bundle adjustment), "
+                             "at each keyframe; the 2 oldest ones are held fixed, set to 0 to disable (default: 0)")
+    parser.add_argument("--map-maintenance", dest="map_maintenance",
+                        type=int, default=0,
+                        help="at each keyframe, cull the 3D points that are rarely observed or have a high reprojection error, "
+                             "and merge near-duplicate points, such that the map is bounded by the size of the scene; "
+                             "can't be combined with --BA-out-files-base-name (default: 0)")
+    parser.add_argument("--local-map-search", dest="local_map_search",
+                        type=int, default=0,
+                        help="at each keyframe, project the 3D points of the last keyframes that are no longer tracked, "
+                             "and match them by descriptor against new corners near their projection, to track them again (default: 0)")
+    parser.add_argument("--vocabulary-file", dest="vocabulary_file",
+                        help="filepath of a binary vocabulary tree (see 'tools/train_vocabulary.py'), "
+                             "if given, each keyframe is checked for loop-closure candidates (default: None)")
     
     # Parse arguments
     args = parser.parse_args()
-    img_dir, calib_file, init_chessboard_size_x, init_chessboard_size_y, init_objp_file, init_pose_file, fps, traj_out_file, map_out_file, BA_out_files_base_name, live_update_period, use_debug = \
-            args.img_dir, args.calib_file, args.init_chessboard_size_x, args.init_chessboard_size_y, args.init_objp_file, args.init_pose_file, args.fps, args.traj_out_file, args.map_out_file, args.BA_out_files_base_name, args.live_update_period, args.use_debug
+    img_dir, calib_file, init_chessboard_size_x, init_chessboard_size_y, init_objp_file, init_pose_file, fps, traj_out_file, map_out_file, BA_out_files_base_name, live_update_period, use_debug, headless, prefetch_depth, lk_levels, lk_win_size, fb_OF_threshold, use_motion_model, motion_model_lk_levels, use_depth_filter, local_BA_window, use_map_maintenance, use_local_map_search, vocabulary_file = \
+            args.img_dir, args.calib_file, args.init_chessboard_size_x, args.init_chessboard_size_y, args.init_objp_file, args.init_pose_file, args.fps, args.traj_out_file, args.map_out_file, args.BA_out_files_base_name, args.live_update_period, args.use_debug, args.headless, args.prefetch_depth, args.lk_levels, args.lk_win_size, args.fb_OF_threshold, args.motion_model, args.motion_model_lk_levels, args.depth_filter, args.local_BA_window, args.map_maintenance, args.local_map_search, args.vocabulary_file
+    
+    # Headless mode can't show debug images, so it requires optimized mode
+    if headless:
+        use_debug = 0
     
     # If debug is not desired, but the application is running in debug-mode, restart app in optimized mode
     if not use_debug and __debug__:
@@ -1015,21 +1610,44 @@ def parse_cmd_args():
         init_chessboard_size = None
         init_files = (init_objp_file, init_pose_file)
     
-    return img_dir, calib_file, init_chessboard_size, init_files, fps, traj_out_file, map_out_file, BA_out_files_base_name, live_update_period
+    if prefetch_depth < 0:
+        raise AttributeError("The --prefetch-depth argument should be at least 0.")
+    if lk_levels < 0 or lk_win_size < 3:
+        raise AttributeError("The --lk-levels argument should be at least 0, "
+                             "and the --lk-win-size argument at least 3.")
+    if fb_OF_threshold < 0:
+        raise AttributeError("The --fb-OF-threshold argument should be at least 0.")
+    if not (0 <= motion_model_lk_levels <= lk_levels):
+        raise AttributeError("The --motion-model-lk-levels argument should be in the range from 0 to --lk-levels.")
+    if local_BA_window and local_BA_window < 3:
+        raise AttributeError("The --local-BA-window argument should be 0 or at least 3.")
+    if use_map_maintenance and BA_out_files_base_name:
+        raise AttributeError("The --map-maintenance argument can't be combined with the --BA-out-files-base-name argument, "
+                             "since the BA info refers to the 3D points by their index in the map.")
+    if vocabulary_file and not os.path.isfile(vocabulary_file):
+        raise AttributeError("The --vocabulary-file argument should be an existing file.")
+    lk_params = (lk_win_size, lk_levels, motion_model_lk_levels)
+    
+    return img_dir, calib_file, init_chessboard_size, init_files, fps, traj_out_file, map_out_file, BA_out_files_base_name, live_update_period, headless, prefetch_depth, lk_params, fb_OF_threshold, use_motion_model, use_depth_filter, local_BA_window, use_map_maintenance, use_local_map_search, vocabulary_file
 
 
 def main():
     global cameraMatrix, distCoeffs, imageSize
-    global max_OF_error, max_lost_tracks_ratio
+    global max_OF_error, max_lost_tracks_ratio, lk_win_size, lk_max_level, max_fb_OF_error
+    global use_motion_model, lk_max_level_seeded, max_motion_model_error, solvePnP_iterations_seeded, pose_optimization_kernel
+    global use_depth_filter, depth_filter_px_noise, depth_filter_convergence_ratio
+    global use_map_maintenance, min_point_observations, max_point_reproj_error, map_merge_voxel_ratio
+    global use_local_map_search, local_map_keyframes, local_map_search_radius, local_map_max_distance
+    global min_relocalization_inliers, min_loop_closure_inliers
     global keypoint_coverage_radius#, min_keypoint_coverage
-    global target_amount_keypoints, corner_quality_level, corner_min_dist
+    global target_amount_keypoints, corner_quality_level, corner_min_dist, feature_grid
     global homography_condition_threshold, max_num_homography_points
-    global max_solvePnP_reproj_error, max_2nd_solvePnP_reproj_error, max_fundMat_reproj_error
+    global max_solvePnP_reproj_error, max_2nd_solvePnP_reproj_error, max_fundMat_reproj_error, max_triangl_reproj_error
     global max_solvePnP_outlier_ratio, max_2nd_solvePnP_outlier_ratio
     global ba_info
     
     # Parse command-line arguments
-    img_dir, calib_file, init_chessboard_size, init_files, fps, traj_out_file, map_out_file, BA_out_files_base_name, live_update_period = \
+    img_dir, calib_file, init_chessboard_size, init_files, fps, traj_out_file, map_out_file, BA_out_files_base_name, live_update_period, headless, prefetch_depth, lk_params, fb_OF_threshold, use_motion_model, use_depth_filter, local_BA_window, use_map_maintenance, use_local_map_search, vocabulary_file = \
             parse_cmd_args()
     
     # Setup BA info container
@@ -1040,7 +1658,6 @@ def main():
         ba_info = BundleAdjustmentInfoContainer(BA_out_files_base_dir, BA_out_files_base_name, 1)
     else:
         ba_info = None
-    tracking_history = []
     
     # Load camera intrinsics
     cameraMatrix, distCoeffs, imageSize = calibration_tools.load_camera_intrinsics(calib_file)
@@ -1063,16 +1680,24 @@ def main():
     # Create color palette, used to identify 3D point group ids
     color_palette, color_palette_size = color_tools.color_palette(2, 3, 4)
     
-    # Setup some visualization helpers
-    composite2D_painter = Composite2DPainter("composite 2D", imageSize)
-    composite3D_painter = Composite3DPainter(
-            "composite 3D", trfm.P_from_R_and_t(Rodrigues((pi, 0., 0.)), np.array([[0., 0., 40.]]).T), (1280, 720) )
+    # Setup some visualization helpers, unless no GUI is desired
+    color_mode = 0    # BGR colors, will follow the color-mode of the 3D painter, if any
+    if headless:
+        composite2D_painter = composite3D_painter = None
+    else:
+        composite2D_painter = Composite2DPainter("composite 2D", imageSize)
+        composite3D_painter = Composite3DPainter(
+                "composite 3D", trfm.P_from_R_and_t(Rodrigues((pi, 0., 0.)), np.array([[0., 0., 40.]]).T), (1280, 720) )
     
     
     ### Tweaking parameters ###
     # OF calculation
     max_OF_error = 12.
     max_lost_tracks_ratio = 0.5
+    lk_win_size, lk_max_level, lk_max_level_seeded = lk_params    # window size and maximal pyramid level (0-based), without and with motion model
+    max_fb_OF_error = fb_OF_threshold    # max forward-backward OF error, 0 to disable the check
+    # motion model
+    max_motion_model_error = 2 * max_OF_error    # max distance in pixels between the tracked and predicted position of a point, used to gate solvePnPRansac()
     # keypoint_coverage
     keypoint_coverage_radius = int(max_OF_error)
     #min_keypoint_coverage = 0.2
@@ -1083,28 +1708,45 @@ def main():
     print ("target_amount_keypoints:", target_amount_keypoints)
     corner_quality_level = 0.01
     corner_min_dist = keypoint_coverage_radius
+    # feature_grid
+    feature_grid_cell_size = 4 * keypoint_coverage_radius
+    feature_grid_num_cells = int(ceil(imageSize[0] / float(feature_grid_cell_size)) * ceil(imageSize[1] / float(feature_grid_cell_size)))
+    feature_grid = FeatureGrid(imageSize, feature_grid_cell_size,
+                               int(ceil(target_amount_keypoints / float(feature_grid_num_cells))))    # spread target evenly over the cells
     # keyframe_test
     homography_condition_threshold = 1.04    # defined as ratio between max and min singular values
-    max_num_homography_points = target_amount_keypoints / 4    # for performance reasons
+    max_num_homography_points = target_amount_keypoints // 4    # for performance reasons
     max_num_homography_points = max(4, max_num_homography_points)    # 4 is minimum number required for homography
     # reprojection error
     max_solvePnP_reproj_error = 2.#0.5    # TODO: revert to a lower number
     max_2nd_solvePnP_reproj_error = max_solvePnP_reproj_error / 2    # be more strict in a 2nd iteration, used after 1st pass of triangulation
+    max_triangl_reproj_error = max_solvePnP_reproj_error    # RMS over all views of a newly triangulated point
     max_fundMat_reproj_error = 2.0
     # solvePnP
     max_solvePnP_outlier_ratio = 0.33
     max_2nd_solvePnP_outlier_ratio = 1.    # used in 2nd iteration, after 1st pass of triangulation
+    solvePnP_iterations_seeded = 20    # RANSAC iterations when starting from the motion model prediction (OpenCV's default is 100)
+    pose_optimization_kernel = "huber"    # robust kernel of the pose optimization, "huber" or "cauchy"
+    # depth filter
+    depth_filter_px_noise = 1.    # standard deviation in pixels of the tracked position of a point, sets the uncertainty of its depth measurements
+    depth_filter_convergence_ratio = 200.    # a depth converged if its standard deviation is this many times smaller than its range (in inverse depth)
+    # map maintenance
+    min_point_observations = 3    # a 3D point that is no longer tracked is culled if it was observed in less frames
+    max_point_reproj_error = max_solvePnP_reproj_error    # a 3D point is culled if its RMS reprojection error over all its observations is higher
+    map_merge_voxel_ratio = 0.01    # 3D points within the same voxel of this size (relative to the median depth of the scene) are merged
+    # local map search
+    local_map_keyframes = 5    # amount of last keyframes of which the 3D points are searched
+    local_map_search_radius = keypoint_coverage_radius    # max distance in pixels between the projection of a 3D point and its match
+    local_map_max_distance = 50    # max Hamming distance between the descriptors of a 3D point and its match
+    # relocalization
+    min_relocalization_inliers = 20    # min amount of 2D-3D inliers to accept a relocalized pose
+    # loop closure
+    min_loop_closure_inliers = 20    # min amount of consistent 3D-3D matches to accept the Sim3 of a loop closure
     
     
     # Init
     
-    imgs = []
-    imgs_gray = []
-    
-    objp = []    # 3D points
-    objp_colors = []    # 3D point BGR color, measured at pixel of first frame of the newly added point
-    objp_groups = []    # 3D point group ids, each new batch of detected points is put in a separate group
-    group_id = 0    # current 3D point group id
+    frames = dataset_tools.prefetched_images(images, prefetch_depth)    # yields (image, grayscale image) pairs, in order
     
     rvecs, rvecs_keyfr = [], []
     tvecs, tvecs_keyfr = [], []
@@ -1113,13 +1755,11 @@ def main():
     # Start frame requires special treatment
     
     # Start frame : read image and detect 2D points ...
-    imgs.append(cv2.imread(images[0]))
-    base_img = imgs[0]
-    imgs_gray.append(cv2.cvtColor(imgs[0], cv2.COLOR_BGR2GRAY))
+    cur_img, cur_img_gray = next(frames)
     
     # ... in case of chessboard
     if init_chessboard_size:
-        ret, new_imgp = extractChessboardFeatures(imgs[0], init_chessboard_size)
+        ret, new_imgp = extractChessboardFeatures(cur_img, init_chessboard_size)
         if not ret:
             print ("First image must contain the entire chessboard!")
             return
@@ -1129,13 +1769,10 @@ def main():
         new_imgp = predef_imgp.astype(np.float32)
     
     if __debug__:
-        cv2.imshow("img", cv2.drawKeypoints(imgs[0], [cv2.KeyPoint(p[0],p[1], 7.) for p in new_imgp], color=rgb(0,0,255)))
+        cv2.imshow("img", cv2.drawKeypoints(cur_img, [cv2.KeyPoint(p[0],p[1], 7.) for p in new_imgp], color=rgb(0,0,255)))
         cv2.waitKey()
     
     # Start frame : define a priori 3D points ...
-    objp_colors = sample_colors(imgs[0], new_imgp)
-    objp_groups = np.zeros(len(new_imgp), dtype=np.int)
-    group_id += 1
     
     # ... in case of chessboard
     if init_chessboard_size:
@@ -1145,12 +1782,13 @@ def main():
     else:
         objp = np.array(predef_objp)
     
-    # Start frame : setup linking data-structures
-    base_imgp = new_imgp    # 2D points
-    all_idxs_tmp = np.arange(len(base_imgp))
-    triangl_idxs = set(all_idxs_tmp)
-    nontriangl_idxs = set()
-    imgp_to_objp_idxs = np.array(sorted(triangl_idxs), dtype=int)
+    # ... and store them in the map, in group 0
+    slam_map = Map()
+    objp_idxs = slam_map.append(objp, sample_colors(cur_img, new_imgp), 0)
+    
+    # Start frame : setup linking data-structures, all 2D points are already triangulated
+    tracks = TrackTable()
+    tracks.append(new_imgp, objp_idxs)
     
     # Start frame : get absolute pose
     ret, rvec, tvec = cv2.solvePnP(    # assume first frame is a proper frame with chessboard fully in-sight
@@ -1158,98 +1796,118 @@ def main():
     print ("solvePnP reproj_error init:", reprojection_error(objp, new_imgp, cameraMatrix, distCoeffs, rvec, tvec)[0])
     rvecs.append(rvec)
     tvecs.append(tvec)
-    rvec_keyfr = rvec
-    tvec_keyfr = tvec
-    rvecs_keyfr.append(rvec_keyfr)
-    tvecs_keyfr.append(tvec_keyfr)
+    rvecs_keyfr.append(rvec)
+    tvecs_keyfr.append(tvec)
     
     # Add BA info for first frame
     if ba_info:
-        ba_info.set_point3DAddedIdxs(all_idxs_tmp)
-        ba_info.add_points2D_3Dassoc(base_imgp, all_idxs_tmp, 0)
+        ba_info.set_point3DAddedIdxs(tracks.objp_idxs)
+        ba_info.add_points2D_3Dassoc(tracks.imgp, tracks.objp_idxs, 0)
     
     # Start frame : add other points
-    mask_img = keypoint_mask(new_imgp)
-    to_add = max(0, target_amount_keypoints - len(new_imgp))
-    imgp_extra = goodFeaturesToTrack(imgs_gray[0], to_add, corner_quality_level, corner_min_dist, None, mask_img)
+    to_add = max(0, target_amount_keypoints - len(tracks))
+    imgp_extra = feature_grid.detect(cur_img_gray, tracks.imgp, to_add, corner_quality_level, corner_min_dist)
     if __debug__:
-        cv2.imshow("img", cv2.drawKeypoints(imgs[0], [cv2.KeyPoint(p[0],p[1], 7.) for p in imgp_extra], color=rgb(0,0,255)))
+        cv2.imshow("img", cv2.drawKeypoints(cur_img, [cv2.KeyPoint(p[0],p[1], 7.) for p in imgp_extra], color=rgb(0,0,255)))
         cv2.waitKey()
     print ("added:", len(imgp_extra))
-    base_imgp, new_imgp, imgp_to_objp_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp = idxs_rebase_and_add_imgp(
-            imgp_extra, base_imgp, new_imgp, imgp_to_objp_idxs, triangl_idxs, nontriangl_idxs, all_idxs_tmp )
+    tracks.append(imgp_extra)
     ret = 2    # indicate keyframe
     
+    # Start frame : becomes the first keyframe, new points will be put in group 1
+    state = SlamState(tracks, slam_map, 1, cur_img, cur_img_gray, rvec, tvec)
+    
     # Add tracking info for first frame
-    if ba_info:
-        tracking_history.append(TrackingEvent(0, new_imgp, all_idxs_tmp))
-        
+    state.tracking_history.append(TrackingEvent(0, tracks.imgp, tracks.ids, rvec, tvec))
+    state.motion_model.update(0, rvec, tvec)
+    triangl = tracks.triangl
+    state.keyframe_db.add_keyframe(0, rvec, tvec, cur_img_gray, tracks.imgp[triangl], tracks.objp_idxs[triangl])
+    if local_BA_window:
+        state.local_ba = LocalBundleAdjuster(local_BA_window, kernel=pose_optimization_kernel,
+                                             threshold=max_solvePnP_reproj_error / abs(cameraMatrix[0, 0]))
+        state.local_ba.add_keyframe(0, rvec, tvec, cv2.undistortPoints(
+                np.array([tracks.imgp[triangl]]), cameraMatrix, distCoeffs )[0], tracks.objp_idxs[triangl])
+    if vocabulary_file:
+        state.loop_detector = LoopDetector(BinaryVocabularyTree.load(vocabulary_file))
+        detect_loop(state, cur_img_gray, 0)
+    
     # Draw 3D points info of current frame
-    if __debug__:
+    if __debug__ and composite2D_painter:
         print ("Drawing composite 2D image")
         composite2D_painter.draw(
-                imgs[0], rvec, tvec, ret,
-                cameraMatrix, distCoeffs, triangl_idxs, nontriangl_idxs, all_idxs_tmp, new_imgp, imgp_to_objp_idxs, objp, objp_groups, group_id, color_palette, color_palette_size )
+                cur_img, rvec, tvec, ret,
+                cameraMatrix, distCoeffs, state, color_palette, color_palette_size )
     
     # Draw 3D points info of all frames
-    if __debug__:
+    if __debug__ and composite3D_painter:
         print ("Drawing composite 3D image    (keys: LEFT/RIGHT/UP/DOWN/PAGEUP/PAGEDOWN/HOME/END)")
         #print ("                             (  or:   A    D    W   S     -       =      [   ] )")
         print ("                              (  or:                       -       =      [   ] )")
         composite3D_painter.draw(
                 rvec, tvec, ret,
-                triangl_idxs, imgp_to_objp_idxs, objp, objp_colors, objp_groups, color_palette, color_palette_size, neg_fy )
+                state, color_palette, color_palette_size, neg_fy )
     
-    for i in range(1, len(images)):
+    time_start = time.time()
+    for i, (cur_img, cur_img_gray) in enumerate(frames, 1):
         if ba_info: ba_info.next_step()    # signal next frame/step to BA
         
         # Frame[i-1] -> Frame[i]
         print ("\nFrame[%s] -> Frame[%s]" % (i-1, i))
         print ("    processing '", images[i], "':")
-        cur_img = cv2.imread(images[i])
-        imgs.append(cur_img)
-        imgs_gray.append(cv2.cvtColor(imgs[-1], cv2.COLOR_BGR2GRAY))
-        ret, base_imgp, new_imgp, base_img, triangl_idxs, nontriangl_idxs, imgp_to_objp_idxs, all_idxs_tmp, objp, objp_colors, objp_groups, group_id, rvec, tvec, rvec_keyfr, tvec_keyfr = \
-                handle_new_frame(base_imgp, new_imgp, base_img, imgs[-2], imgs_gray[-2], imgs[-1], imgs_gray[-1], triangl_idxs, nontriangl_idxs, imgp_to_objp_idxs, all_idxs_tmp, objp, objp_colors, objp_groups, group_id, rvec_keyfr, tvec_keyfr, tracking_history, i)
+        ret, rvec, tvec = handle_new_frame(state, cur_img, cur_img_gray, i)
         
         if ret:
             rvecs.append(rvec)
             tvecs.append(tvec)
             if ret == 2:    # frame is a keyframe
-                rvecs_keyfr.append(rvec_keyfr)
-                tvecs_keyfr.append(tvec_keyfr)
+                rvecs_keyfr.append(state.rvec_keyfr)
+                tvecs_keyfr.append(state.tvec_keyfr)
+                if state.local_ba:    # write back the refined poses of the keyframes in the local BA window
+                    for keyframe in state.local_ba.keyframes:
+                        rvecs[keyframe.frame_idx], tvecs[keyframe.frame_idx] = keyframe.rvec, keyframe.tvec
         else:    # frame rejected
             rvecs.append(None)
             tvecs.append(None)
-            del imgs[-1]
-            del imgs_gray[-1]
         
         # Draw 3D points info of current frame
-        if __debug__:
+        if __debug__ and composite2D_painter:
             print ("Drawing composite 2D image")
             composite2D_painter.draw(
                     cur_img, rvec, tvec, ret,
-                    cameraMatrix, distCoeffs, triangl_idxs, nontriangl_idxs, all_idxs_tmp, new_imgp, imgp_to_objp_idxs, objp, objp_groups, group_id, color_palette, color_palette_size )
+                    cameraMatrix, distCoeffs, state, color_palette, color_palette_size )
         
         # Draw 3D points info of all frames
-        if __debug__:
+        if __debug__ and composite3D_painter:
             print ("Drawing composite 3D image    (view keys: LEFT/RIGHT/UP/DOWN/PAGEUP/PAGEDOWN/HOME/END/C)")
             #print ("                             (       or:   A    D    W   S     -       =      [   ]   )")
             print ("                              (       or:                       -       =      [   ]   )")
             print ("                              (take snapshot of results:           ENTER               )")
             composite3D_painter.draw(
                     rvec, tvec, ret,
-                    triangl_idxs, imgp_to_objp_idxs, objp, objp_colors, objp_groups, color_palette, color_palette_size, neg_fy )
+                    state, color_palette, color_palette_size, neg_fy )
         
         # Save results once every 30 frames
-        if live_update_period and ((i % live_update_period) == 0 or composite3D_painter.save_results_flag):
-            composite3D_painter.save_results_flag = False
+        save_results_flag = False
+        if composite3D_painter:
+            save_results_flag, composite3D_painter.save_results_flag = composite3D_painter.save_results_flag, False
+            color_mode = composite3D_painter.color_mode
+        if live_update_period and ((i % live_update_period) == 0 or save_results_flag):
             write_output(traj_out_file, fps, rvecs, tvecs,
-                         map_out_file, triangl_idxs, imgp_to_objp_idxs, objp, composite3D_painter.color_mode, color_palette, color_palette_size, objp_groups, objp_colors)
+                         map_out_file, state, color_mode, color_palette, color_palette_size)
+    
+    # Report the throughput of the tracking loop
+    time_elapsed = time.time() - time_start
+    if headless and time_elapsed > 0:
+        print ("\nProcessed %s frames in %.3f seconds: %.2f frames per second" % (
+                len(images) - 1, time_elapsed, (len(images) - 1) / time_elapsed ))
+    if state.loop_detector is not None:
+        print ("\nFound %s loop-closure candidates in %s keyframes" % (len(state.loop_candidates), len(state.loop_detector.keyframes)))
+    if state.loop_closures:
+        close_loops(state, rvecs, tvecs)
     
     # Save results at the very end
     write_output(traj_out_file, fps, rvecs, tvecs,
-                 map_out_file, triangl_idxs, imgp_to_objp_idxs, objp, composite3D_painter.color_mode, color_palette, color_palette_size, objp_groups, objp_colors)
+                 map_out_file, state, color_mode, color_palette, color_palette_size)
     if ba_info: ba_info.write_all()
 
 
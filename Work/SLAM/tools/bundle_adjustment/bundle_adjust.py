@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function    # Python 3 compatibility
+
+import os
+import time
+import numpy as np
+
+import sys; sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "..", "python_libs"))
+import dataset_tools
+import transforms as trfm
+from calibration_tools import undistort_points
+from bundle_adjustment import bundle_adjustment
+import ba_journal
+
+
+
+def parse_cmd_args():
+    import argparse
+    
+    # Create parser object and help messages
+    parser = argparse.ArgumentParser(
+            description=
+            "Bundle-Adjustment (full optimization, Levenberg-Marquardt) of the trajectories and map of a SLAM run, "
+            'using the measurements of the "BA_info.*.txt" files, or of the binary BA journal. '
+            "This is a self-contained alternative to the GTSAM-based 'bundle_adjust' program of this directory, "
+            "it only optimizes the reprojection error of the 2D-3D associations (the odometry measurements are not used). "
+            "The input files are '<base_dir>/<title>[-<base_name>].<ext>', "
+            "the output files are '<base_dir>/traj_out.cam<C>-<base_name>-BA.txt' and '<base_dir>/map_out-<base_name>-BA.pcd'.")
+    
+    parser.add_argument("base_dir",
+                        help="directory of the trajectories, map, and BA_info files")
+    parser.add_argument("base_name",
+                        help="base name of the files, e.g. the name of the algorithm ('slam2')")
+    parser.add_argument("num_cams", type=int,
+                        help="amount of cameras")
+    parser.add_argument("fps", type=float,
+                        help="framerate of the trajectories, frame F has timestamp (F + 1) / fps; "
+                             "if set to 0, each pose of the trajectory files corresponds with the next frame")
+    
+    parser.add_argument("-j", "--journal", dest="journal",
+                        action="store_true", default=False,
+                        help='read the measurements from the binary "BA_info.journal-<base_name>.bin" file, '
+                             'instead of from the "BA_info.*.txt" files')
+    parser.add_argument("-s", "--solver", dest="solver",
+                        choices=("pcg", "sparse"), default="pcg",
+                        help="solver of the reduced camera system: "
+                             "preconditioned conjugate gradients, or sparse direct factorization (default: pcg)")
+    parser.add_argument("-k", "--kernel", dest="kernel",
+                        choices=("huber", "cauchy"), default="huber",
+                        help="robust kernel of the reprojection errors (default: huber)")
+    parser.add_argument("-r", "--threshold", dest="threshold",
+                        type=float, default=2.,
+                        help="scale of the robust kernel, in pixels (default: 2.)")
+    parser.add_argument("-i", "--max-iterations", dest="max_iterations",
+                        type=int, default=20,
+                        help="max amount of Levenberg-Marquardt iterations (default: 20)")
+    parser.add_argument("-F", "--num-fixed-frames", dest="num_fixed_frames",
+                        type=int, default=2,
+                        help="amount of first frames of which the poses are held fixed, "
+                             "2 to fix both the pose and the scale of the reconstruction (default: 2)")
+    
+    # Parse arguments
+    args = parser.parse_args()
+    base_dir, base_name, num_cams, fps, journal, solver, kernel, threshold, max_iterations, num_fixed_frames = \
+            args.base_dir, args.base_name, args.num_cams, args.fps, args.journal, \
+            args.solver, args.kernel, args.threshold, args.max_iterations, args.num_fixed_frames
+    
+    if num_cams < 1 or fps < 0:
+        raise AttributeError("The num_cams argument should be at least 1, and the fps argument can't be negative.")
+    if threshold <= 0 or max_iterations < 1 or num_fixed_frames < 1:
+        raise AttributeError("The --threshold, --max-iterations and --num-fixed-frames arguments should be positive.")
+    
+    return base_dir, base_name, num_cams, fps, journal, solver, kernel, threshold, max_iterations, num_fixed_frames
+
+
+def load_trajectory(traj_file, fps):
+    """
+    Load the TUM trajectory "traj_file", and return the timestamp and frame idx of each pose,
+    and the poses as "rvecs" and "tvecs" (transforming points from world to camera coordinates).
+    """
+    timestps, locations, quaternions = dataset_tools.load_cam_trajectory_TUM(traj_file)
+    if fps:
+        frames = np.round(timestps * fps).astype(int) - 1    # see "convert_cam_poses_to_cam_trajectory_TUM()"
+    else:
+        frames = np.arange(len(timestps))
+    
+    # The trajectory contains the inverse of the poses
+    rvecs = -trfm.rvecs_from_quats(quaternions)
+    tvecs = -np.matmul(trfm.R_from_rvecs(rvecs), locations[:, :, None])[:, :, 0]
+    return timestps, frames, rvecs, tvecs
+
+
+def save_trajectory(traj_file, timestps, rvecs, tvecs):
+    """Save the poses "rvecs", "tvecs" at "timestps" as TUM trajectory "traj_file"."""
+    locations = -np.matmul(trfm.R_from_rvecs(rvecs).transpose(0, 2, 1), tvecs[:, :, None])[:, :, 0]
+    quaternions = trfm.quats_from_rvecs(-rvecs)
+    dataset_tools.save_cam_trajectory_TUM(traj_file, (timestps, locations, quaternions))
+
+
+def main():
+    base_dir, base_name, num_cams, fps, journal, solver, kernel, threshold, max_iterations, num_fixed_frames = \
+            parse_cmd_args()
+    
+    def filepath(title, ext, cam=None, BA=False):
+        return os.path.join(base_dir, "%s%s-%s%s.%s" % (title, (".cam%s" % cam) * (cam is not None), base_name, "-BA" * BA, ext))
+    
+    print ("Loading measurements...")
+    if journal:
+        calibrations, observations = ba_journal.measurements_from_journal(filepath("BA_info.journal", "bin"))
+    else:
+        calibrations, observations = ba_journal.measurements_from_text(base_dir, base_name, num_cams)
+    if set(range(num_cams)) - set(calibrations["cam"].tolist()):
+        raise ValueError("The measurements don't contain the calibrations of all %s cameras" % num_cams)
+    calibrations = calibrations[np.argsort(calibrations["cam"])][:num_cams]
+    
+    print ("Loading trajectories and map...")
+    trajectories = [load_trajectory(filepath("traj_out", "txt", cam), fps) for cam in range(num_cams)]
+    objp, colors, found_alpha = dataset_tools.load_3D_points_from_pcd_file(filepath("map_out", "pcd"), use_alpha=True)
+    objp = objp.astype(float)
+    
+    # Each pose (of a frame, of a camera) to optimize, ordered by frame, such that the first frames are held fixed
+    pose_keys = np.concatenate([frames * num_cams + cam for cam, (timestps, frames, rvecs, tvecs) in enumerate(trajectories)])
+    pose_order = np.argsort(pose_keys, kind="mergesort")
+    pose_keys = pose_keys[pose_order]
+    rvecs = np.concatenate([rvecs for timestps, frames, rvecs, tvecs in trajectories])[pose_order]
+    tvecs = np.concatenate([tvecs for timestps, frames, rvecs, tvecs in trajectories])[pose_order]
+    
+    # Only keep observations of existing poses and map points, and of points observed by at least 2 poses
+    observation_keys = observations["frame"].astype(int) * num_cams + observations["cam"]
+    cam_idxs = np.minimum(np.searchsorted(pose_keys, observation_keys), len(pose_keys) - 1)
+    valid = np.logical_and(pose_keys[cam_idxs] == observation_keys,
+                           np.logical_and(0 <= observations["point3DIdx"], observations["point3DIdx"] < len(objp)))
+    num_observations = np.bincount(observations["point3DIdx"][valid], minlength=len(objp))
+    valid[valid] = (num_observations[observations["point3DIdx"][valid]] >= 2)
+    observations, cam_idxs = observations[valid], cam_idxs[valid]
+    objp_idxs, point_idxs = np.unique(observations["point3DIdx"], return_inverse=True)
+    print ("\t%s poses, %s points, %s observations" % (len(pose_keys), len(objp_idxs), len(observations)))
+    if not len(observations):
+        raise ValueError("No observations left to optimize")
+    
+    # Undistort and normalize the observations, per camera
+    imgpnrm = np.empty((len(observations), 2))
+    for cam, calibration in enumerate(calibrations):
+        rows = (observations["cam"] == cam)
+        imgpnrm[rows] = undistort_points(
+                np.stack((observations["x"][rows], observations["y"][rows]), axis=1), calibration["K"], calibration["distCoeffs"])
+    focal_length = np.abs(calibrations["K"][:, 0:2, 0:2].diagonal(axis1=1, axis2=2)).mean()    # to convert to/from pixels
+    
+    print ("Running bundle adjustment (solver: %s)..." % solver)
+    time_start = time.time()
+    rvecs_BA, tvecs_BA, objp_BA, rms_before, rms_after = bundle_adjustment(
+            rvecs, tvecs, objp[objp_idxs], cam_idxs, point_idxs, imgpnrm,
+            num_fixed_cams=min(num_fixed_frames * num_cams, len(pose_keys)), kernel=kernel, threshold=threshold / focal_length,
+            max_iterations=max_iterations, solver=solver, verbose=True )
+    print ("RMS reprojection error: %.4f -> %.4f pixels, in %.1f seconds" % (
+            rms_before * focal_length, rms_after * focal_length, time.time() - time_start))
+    
+    print ("Saving results...")
+    rvecs_BA[pose_order], tvecs_BA[pose_order] = rvecs_BA.copy(), tvecs_BA.copy()    # back in order of the trajectory files
+    offsets = np.cumsum([0] + [len(timestps) for timestps, frames, rvecs, tvecs in trajectories])
+    for cam, (timestps, frames, rvecs, tvecs) in enumerate(trajectories):
+        cam_poses = slice(offsets[cam], offsets[cam + 1])
+        save_trajectory(filepath("traj_out", "txt", cam, BA=True), timestps, rvecs_BA[cam_poses], tvecs_BA[cam_poses])
+    objp[objp_idxs] = objp_BA
+    dataset_tools.save_3D_points_to_pcd_file(filepath("map_out", "pcd", BA=True), objp, colors)
+    
+    print ("Done.")
+
+if __name__ == "__main__":
+    main()
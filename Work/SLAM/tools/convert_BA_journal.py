@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function    # Python 3 compatibility
+
+import os
+
+import sys; sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "python_libs"))
+import ba_journal
+
+
+
+def parse_cmd_args():
+    import argparse
+    
+    # Create parser object and help messages
+    parser = argparse.ArgumentParser(
+            description=
+            "Convert a binary BA journal (as written by the SLAM application with the -b argument) "
+            'to the "BA_info.*.txt" text files read by the offline bundle adjuster. '
+            "This also works on the journal of a crashed or interrupted run, up to its last completed step.")
+    
+    parser.add_argument("journal_file",
+                        help='filepath of the BA journal, named "BA_info.journal-<base_name>.bin"')
+    
+    parser.add_argument("-o", "--out-dir", dest="out_dir",
+                        help="directory of the output text files "
+                             "(default: directory of the journal)")
+    parser.add_argument("-n", "--base-name", dest="base_name",
+                        help="base name of the output text files "
+                             "(default: inferred from the filename of the journal)")
+    
+    # Parse arguments
+    args = parser.parse_args()
+    journal_file, out_dir, base_name = args.journal_file, args.out_dir, args.base_name
+    
+    if out_dir == None:
+        out_dir = os.path.dirname(journal_file)
+    if base_name == None:
+        filename = os.path.basename(journal_file)
+        if not (filename.startswith("BA_info.journal-") and filename.endswith(".bin")):
+            raise AttributeError("Can't infer the base name from the journal's filename, use the --base-name argument.")
+        base_name = filename[len("BA_info.journal-") : -len(".bin")]
+    
+    return journal_file, out_dir, base_name
+
+
+def main():
+    journal_file, out_dir, base_name = parse_cmd_args()
+    
+    print ('Converting journal "%s"...' % journal_file)
+    ba_journal.journal_to_text(journal_file, out_dir, base_name)
+    
+    print ("Done.")
+
+if __name__ == "__main__":
+    main()
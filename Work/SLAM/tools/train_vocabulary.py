@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function    # Python 3 compatibility
+
+import os
+import time
+import cv2
+
+import sys; sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "python_libs"))
+import dataset_tools
+from relocalization import create_ORB
+from place_recognition import BinaryVocabularyTree
+
+
+
+def parse_cmd_args():
+    import argparse
+    
+    # Create parser object and help messages
+    parser = argparse.ArgumentParser(
+            description=
+            "Train a binary vocabulary tree (bag of binary words) offline, "
+            "on the ORB descriptors of the images of one or more datasets. "
+            "The vocabulary is saved as a NumPy .npz file, "
+            "which can be given to the SLAM application to detect loop-closure candidates.")
+    
+    parser.add_argument("vocabulary_file",
+                        help="filepath of the output vocabulary, should end with '.npz'")
+    parser.add_argument("img_dirs", nargs='+',
+                        help="folder(s) containing the training images, "
+                             "the filenames must be such that they can be ordered by numbers")
+    
+    parser.add_argument("-k", "--branching", dest="branching",
+                        type=int, default=10,
+                        help="amount of children of each node of the tree (default: 10)")
+    parser.add_argument("-L", "--depth", dest="depth",
+                        type=int, default=5,
+                        help="amount of levels of the tree, up to branching^depth words (default: 5)")
+    parser.add_argument("-n", "--num-features", dest="num_features",
+                        type=int, default=500,
+                        help="max amount of ORB features per image (default: 500)")
+    parser.add_argument("-s", "--image-step", dest="image_step",
+                        type=int, default=10,
+                        help="only use one image out of this many, consecutive images look too similar (default: 10)")
+    
+    # Parse arguments
+    args = parser.parse_args()
+    vocabulary_file, img_dirs, branching, depth, num_features, image_step = \
+            args.vocabulary_file, args.img_dirs, args.branching, args.depth, args.num_features, args.image_step
+    
+    if branching < 2 or depth < 1:
+        raise AttributeError("The --branching argument should be at least 2, and the --depth argument at least 1.")
+    if num_features < 1 or image_step < 1:
+        raise AttributeError("The --num-features and --image-step arguments should be at least 1.")
+    
+    return vocabulary_file, img_dirs, branching, depth, num_features, image_step
+
+
+def main():
+    vocabulary_file, img_dirs, branching, depth, num_features, image_step = parse_cmd_args()
+    
+    print ("Extracting ORB descriptors...")
+    orb = create_ORB(num_features)
+    descriptors_per_image = []
+    for img_dir in img_dirs:
+        images = dataset_tools.image_filepaths_by_directory(img_dir)[::image_step]
+        for image in images:
+            img_gray = cv2.cvtColor(cv2.imread(image), cv2.COLOR_BGR2GRAY)
+            keypoints, descriptors = orb.detectAndCompute(img_gray, None)
+            if descriptors is not None and len(descriptors):
+                descriptors_per_image.append(descriptors)
+        print ('\t "%s": %s images' % (img_dir, len(images)))
+    if not descriptors_per_image:
+        raise ValueError("No ORB descriptors found in the given images.")
+    print ("Found %s descriptors in %s images" % (sum(len(d) for d in descriptors_per_image), len(descriptors_per_image)))
+    
+    print ("Training vocabulary (branching: %s, depth: %s)..." % (branching, depth))
+    time_start = time.time()
+    vocabulary = BinaryVocabularyTree.train(descriptors_per_image, branching, depth)
+    print ("Trained %s words in %.1f seconds" % (vocabulary.num_words, time.time() - time_start))
+    
+    print ('Saving vocabulary to "%s"...' % vocabulary_file)
+    vocabulary.save(vocabulary_file)
+    
+    print ("Done.")
+
+if __name__ == "__main__":
+    main()
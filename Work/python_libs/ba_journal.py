@@ -0,0 +1,271 @@
+import os
+import io
+import mmap
+import struct
+import numpy as np
+
+
+
+""" Record types """
+
+
+# Tags of the segments
+STEP = b"STEP"    # marks the start of a step (empty array)
+CALIBRATION = b"CALI"    # "calibration_dtype" records
+ODOMETRY = b"ODOM"    # "odometry_dtype" records
+OBSERVATIONS = b"OBSV"    # "observation_dtype" records
+POINTS3D_ADDED = b"ADD3"    # int32 point3DIdxs
+
+calibration_dtype = np.dtype([("cam", "<i4"), ("K", "<f8", (3, 3)), ("distCoeffs", "<f8", 5)])
+odometry_dtype = np.dtype([("pose", "<f8", 7),    # tx ty tz qx qy qz qw (TUM format)
+                           ("from_cam", "<i4"), ("from_frame", "<i4"), ("to_cam", "<i4"), ("to_frame", "<i4")])
+observation_dtype = np.dtype([("frame", "<i4"), ("point2DIdx", "<i4"), ("point3DIdx", "<i4"),
+                              ("x", "<f8"), ("y", "<f8"), ("cam", "u1")])
+
+_file_magic = b"BA_JOURNAL 1\n"
+_segment_header = struct.Struct("<4siQ")    # tag, step, length of the segment's .npy payload in bytes
+
+
+
+""" Writing """
+
+
+class JournalWriter:
+    """
+    Append-only binary journal of BA measurements.
+    
+    The file is a sequence of segments, each a (tag, step, length) header followed by a NumPy .npy payload,
+    such that readers can skip segments, and memory-map the arrays.
+    Everything written before the last "flush()" survives a crash, a truncated last segment is ignored by the reader.
+    """
+    
+    def __init__(self, filepath, sync=False):
+        """
+        "sync" : if True, "flush()" also forces the data to disk (fsync), which is slower
+        """
+        self.filepath = filepath
+        self.sync = sync
+        self.file = open(filepath, "wb")
+        self.file.write(_file_magic)
+    
+    def write(self, tag, step, array):
+        """Append "array" as a segment with tag "tag" (one of the tags of this module), belonging to step "step"."""
+        array = np.ascontiguousarray(array)
+        header = np.lib.format.header_data_from_array_1_0(array)
+        header_file = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header_file, header)
+        payload_header = header_file.getvalue()
+        self.file.write(_segment_header.pack(tag, step, len(payload_header) + array.nbytes))
+        self.file.write(payload_header)
+        self.file.write(array.tobytes())
+    
+    def flush(self):
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+    
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+
+""" Reading """
+
+
+def read_journal(filepath, mmap_arrays=True):
+    """
+    Iterate over the segments of the journal "filepath", yields (tag, step, array) tuples.
+    If "mmap_arrays" is True, the arrays are read-only views on a memory-map of the file, otherwise they're loaded into memory.
+    A truncated last segment (e.g. after a crash) is ignored.
+    """
+    file_size = os.path.getsize(filepath)
+    with open(filepath, "rb") as f:
+        if f.read(len(_file_magic)) != _file_magic:
+            raise ValueError("'%s' is not a BA journal file" % filepath)
+        file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if mmap_arrays else None    # shared by all arrays
+        
+        while True:
+            segment_start = f.tell()
+            header = f.read(_segment_header.size)
+            if len(header) < _segment_header.size:
+                break
+            tag, step, length = _segment_header.unpack(header)
+            segment_stop = segment_start + _segment_header.size + length
+            if segment_stop > file_size:
+                break
+            
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            count = int(np.prod(shape))
+            if file_map is not None:
+                array = np.frombuffer(file_map, dtype=dtype, count=count, offset=f.tell()).reshape(shape)
+            else:
+                array = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+            f.seek(segment_stop)
+            yield tag, step, array
+
+
+def load_journal(filepath, mmap_arrays=True):
+    """
+    Read the journal "filepath", and collect the segments per tag.
+    Returns the amount of steps, and a dict of tag -> list of (step, array) tuples, in order of writing.
+    """
+    segments = dict((tag, []) for tag in (STEP, CALIBRATION, ODOMETRY, OBSERVATIONS, POINTS3D_ADDED))
+    num_steps = 0
+    for tag, step, array in read_journal(filepath, mmap_arrays):
+        segments.setdefault(tag, []).append((step, array))
+        num_steps = max(num_steps, step + 1)
+    return num_steps, segments
+
+
+
+""" Loading the measurements """
+
+
+def measurements_from_journal(journal_file):
+    """
+    Return the camera calibrations ("calibration_dtype" records)
+    and the observations ("observation_dtype" records) of the journal "journal_file".
+    """
+    num_steps, segments = load_journal(journal_file, mmap_arrays=False)
+    return (_concatenated(segments[CALIBRATION], calibration_dtype)[0],
+            _concatenated(segments[OBSERVATIONS], observation_dtype)[0])
+
+
+def _read_text_groups(filepath):
+    """
+    Return the data lines of the "BA_info.*.txt" file "filepath",
+    and the group of each line, groups are separated by empty lines.
+    """
+    lines = [line.strip() for line in open(filepath, 'r').read().split('\n')]
+    lines = [line for line in lines if not line.startswith('#')]
+    groups = np.cumsum([not line for line in lines])    # amount of empty lines up to each line
+    data = [i for i, line in enumerate(lines) if line]
+    return [lines[i] for i in data], groups[data]
+
+
+def measurements_from_text(base_dir, base_name, num_cams):
+    """
+    Equivalent of "measurements_from_journal()", for the "BA_info.*.txt" files (in "base_dir", for "base_name")
+    of cameras 0 to "num_cams" - 1.
+    """
+    calibrations = np.zeros(num_cams, dtype=calibration_dtype)
+    observations = []
+    for cam in range(num_cams):
+        lines, groups = _read_text_groups(os.path.join(base_dir, "BA_info.calibrations.cam%s.txt" % cam))
+        fx, fy, shear, u0, v0, k1, k2, p1, p2 = map(float, lines[0].split())
+        calibrations[cam] = (cam, [[fx, shear, u0], [0., fy, v0], [0., 0., 1.]], [k1, k2, p1, p2, 0.])
+        
+        # The 2D points are grouped per frame, the associations refer to them by (frame, index in frame)
+        lines, frames = _read_text_groups(os.path.join(
+                base_dir, "BA_info.measurements.points2D.cam%s-%s.txt" % (cam, base_name) ))
+        points2D = np.array([line.split() for line in lines], dtype=float).reshape(-1, 2)
+        frame_offsets = np.searchsorted(frames, np.arange((frames[-1] + 1) if len(frames) else 0))
+        lines, steps = _read_text_groups(os.path.join(
+                base_dir, "BA_info.measurements.point2D3DAssocs.cam%s-%s.txt" % (cam, base_name) ))
+        assocs = np.array([line.split() for line in lines], dtype=int).reshape(-1, 3)
+        
+        cam_observations = np.zeros(len(assocs), dtype=observation_dtype)
+        cam_observations["frame"], cam_observations["point2DIdx"], cam_observations["point3DIdx"] = assocs.T
+        cam_observations["x"], cam_observations["y"] = points2D[frame_offsets[assocs[:, 0]] + assocs[:, 1]].T
+        cam_observations["cam"] = cam
+        observations.append(cam_observations)
+    
+    return calibrations, np.concatenate(observations)
+
+
+
+""" Conversion to the text layout of the offline BA (GTSAM) """
+
+
+def _concatenated(segments, dtype):
+    """Return the arrays of "segments" concatenated, and the step of each element."""
+    if not segments:
+        return np.zeros(0, dtype=dtype), np.zeros(0, dtype=int)
+    arrays = [array for step, array in segments]
+    return np.concatenate(arrays), np.repeat([step for step, array in segments], [len(array) for array in arrays])
+
+
+def _lines_per_group(lines, groups, num_groups):
+    """Return "lines" with an empty line between consecutive groups, "groups" is the (ascending) group of each line."""
+    offsets = np.searchsorted(groups, np.arange(num_groups + 1))
+    result = []
+    for group in range(num_groups):
+        if group: result.append("")    # empty line between groups
+        result += lines[offsets[group] : offsets[group + 1]]
+    return result
+
+
+def journal_to_text(journal_file, base_dir, base_name):
+    """
+    Convert the journal "journal_file" to the "BA_info.*.txt" text files (in "base_dir", for "base_name"),
+    as read by the offline bundle adjuster, see "/Work/SLAM/tools/bundle_adjustment/".
+    """
+    num_steps, segments = load_journal(journal_file)
+    
+    def write_file(title, lines, cam=-1, omit_base_name=False):
+        lines.append("")    # empty line at end
+        filename = "BA_info.%s%s%s.txt" % (
+                title, (".cam%s" % cam) * (cam > -1), ("-%s" % base_name) * (not omit_base_name) )
+        with open(os.path.join(base_dir, filename), 'w') as f:
+            f.write('\n'.join(lines))
+    
+    # Calibrations
+    calibrations, steps = _concatenated(segments[CALIBRATION], calibration_dtype)
+    for calibration in calibrations:
+        K, distCoeffs = calibration["K"], calibration["distCoeffs"]
+        if distCoeffs[4] != 0.:
+            raise ValueError("GTSAM doesn't support 6th order radial distorion coefficients, "
+                             "recalibrate using a lower order model, or fix GTSAM.")
+        lines = []
+        lines.append("# Format: fx fy shear u0 v0 k1 k2 p1 p2")
+        lines.append("%.16e %.16e %.16e %.16e %.16e %.16e %.16e %.16e %.16e" % (
+                (K[0, 0], K[1, 1], K[0, 1], K[0, 2], K[1, 2]) + tuple(distCoeffs[:4]) ))
+        write_file("calibrations", lines, int(calibration["cam"]), omit_base_name=True)
+    
+    # Odometry, per step
+    odometry, steps = _concatenated(segments[ODOMETRY], odometry_dtype)
+    lines = []
+    lines.append("# Format: tx ty tz qx qy qz qw")
+    lines.append("# Newline means next odometry; Empty line means next step")
+    lines += _lines_per_group(["%.16e %.16e %.16e %.16e %.16e %.16e %.16e" % tuple(pose) for pose in odometry["pose"].tolist()],
+                              steps, num_steps)
+    write_file("measurements.odometry", lines)
+    lines = []
+    lines.append("# Format: from_cam from_frame to_cam to_frame")
+    lines.append("# Newline means next odometry; Empty line means next step")
+    assocs = np.stack([odometry[name] for name in ("from_cam", "from_frame", "to_cam", "to_frame")], axis=1)
+    lines += _lines_per_group([' '.join(map(str, assoc)) for assoc in assocs.tolist()], steps, num_steps)
+    write_file("measurements.odometryAssocs", lines)
+    
+    # Observations, per camera: the 2D points per frame (in order of 2D point idx), and the 2D-3D associations per step
+    observations, steps = _concatenated(segments[OBSERVATIONS], observation_dtype)
+    for cam in sorted(set(calibrations["cam"].tolist()) | set(observations["cam"].tolist())):
+        rows = np.where(observations["cam"] == cam)[0]
+        frames = observations["frame"][rows]
+        order = np.argsort(frames, kind="mergesort")
+        lines = []
+        lines.append("# Format: x y")
+        lines.append("# Newline means next feature; Empty line means next frame, first feature")
+        points2D = np.stack((observations["x"][rows[order]], observations["y"][rows[order]]), axis=1)
+        lines += _lines_per_group(["%.16e %.16e" % tuple(imgp) for imgp in points2D.tolist()], frames[order], num_steps)
+        write_file("measurements.points2D", lines, cam)
+        
+        lines = []
+        lines.append("# Format: frameIdx point2DIdx point3DIdx")
+        lines.append("# Newline means next feature; Empty line means next step, first feature")
+        assocs = np.stack([observations[name][rows] for name in ("frame", "point2DIdx", "point3DIdx")], axis=1)
+        lines += _lines_per_group([' '.join(map(str, assoc)) for assoc in assocs.tolist()], steps[rows], num_steps)
+        write_file("measurements.point2D3DAssocs", lines, cam)
+    
+    # 3D points added, per step
+    points3D_added, steps = _concatenated(segments[POINTS3D_ADDED], np.int32)
+    lines = []
+    lines.append("# Format: point3DIdx")
+    lines.append("# Newline means next point; Empty line means next step")
+    lines += _lines_per_group(list(map(str, points3D_added.tolist())), steps, num_steps)
+    write_file("measurements.point3DAddedIdxs", lines)
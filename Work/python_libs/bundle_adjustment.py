@@ -0,0 +1,379 @@
+import numpy as np
+
+import transforms as trfm
+from pose_optimization import robust_kernels
+
+
+
+""" Bundle adjustment """
+
+
+def _right_jacobians(rvecs):
+    """
+    Return the (N, 3, 3) right Jacobians of SO(3) of the (N, 3) axis-angle represented "rvecs",
+    such that R(r + dr) ~= R(r) * exp(J_r(r) * dr).
+    """
+    angles = np.sqrt((rvecs**2).sum(axis=1))
+    
+    # Use the Taylor expansions of the coefficients near zero, to avoid illegal expressions
+    small = (angles < 1e-4)
+    angles_safe = np.where(small, 1., angles)
+    b = np.where(small, 0.5 - angles**2 / 24, (1. - np.cos(angles_safe)) / angles_safe**2)    # (1 - cos(x)) / x^2
+    c = np.where(small, 1. / 6 - angles**2 / 120, (angles_safe - np.sin(angles_safe)) / angles_safe**3)    # (x - sin(x)) / x^3
+    
+    K = trfm.skew_matrices(rvecs)
+    return np.eye(3) - b[:, None, None] * K + c[:, None, None] * np.einsum("nij,njk->nik", K, K)
+
+
+def _reprojection(cams, objp, cam_idxs, point_idxs, imgpnrm, jacobians=False):
+    """
+    Return the (N, 2) reprojection residuals of the N observations "imgpnrm" (undistorted and normalized)
+    of 3D points "objp"["point_idxs"] by cameras "cams"["cam_idxs"], each camera is a row (rvec, tvec).
+    Points behind the camera are projected as if they were at a tiny depth in front of it, resulting in a large residual.
+    
+    If "jacobians" is True, also returns the (N, 2, 6) Jacobians w.r.t. the camera, and the (N, 2, 3) ones w.r.t. the point.
+    """
+    Rs = trfm.R_from_rvecs(cams[:, 0:3])[cam_idxs]
+    objp_cam = np.matmul(Rs, objp[point_idxs, :, None])[:, :, 0] + cams[cam_idxs, 3:6]
+    depths = np.maximum(objp_cam[:, 2], 1.e-6)
+    residuals = objp_cam[:, 0:2] / depths[:, None] - imgpnrm
+    if not jacobians:
+        return residuals
+    
+    J_proj = np.zeros((len(cam_idxs), 2, 3))    # d(x/z, y/z) / d(objp_cam)
+    J_proj[:, 0, 0] = J_proj[:, 1, 1] = 1. / depths
+    J_proj[:, :, 2] = -objp_cam[:, 0:2] / depths[:, None]**2
+    J_point = np.matmul(J_proj, Rs)    # d(objp_cam) / d(objp) = R
+    J_cam = np.empty((len(cam_idxs), 2, 6))
+    J_cam[:, :, 0:3] = -np.matmul(np.matmul(J_point, trfm.skew_matrices(objp[point_idxs])),    # d(R * objp) / d(rvec) = ...
+                                  _right_jacobians(cams[:, 0:3])[cam_idxs])    # ... -R * [objp]_x * J_r(rvec)
+    J_cam[:, :, 3:6] = J_proj
+    return residuals, J_cam, J_point
+
+
+def _block_sums(blocks, idxs, num_idxs):
+    """Return the sums of the (N, ...) array "blocks", grouped per idx "idxs" in [0, "num_idxs")."""
+    size = int(np.prod(blocks.shape[1:]))
+    flat_idxs = idxs[:, None] * size + np.arange(size)
+    sums = np.bincount(flat_idxs.ravel(), blocks.reshape(-1), minlength=num_idxs * size)
+    return sums.reshape((num_idxs, ) + blocks.shape[1:])
+
+
+def _schur_solve(U, V, W, g_cam, g_point, cam_idxs, point_idxs, num_fixed_cams):
+    """
+    Solve the damped normal equations of bundle adjustment
+        [ U    W ] [d_cam  ]     [g_cam  ]
+        [ W.T  V ] [d_point] = - [g_point]
+    where "U" are the (C, 6, 6) diagonal camera blocks, "V" the (P, 3, 3) diagonal point blocks,
+    and "W" the (N, 6, 3) off-diagonal block of each observation (of point "point_idxs" by camera "cam_idxs").
+    
+    The points are eliminated first (Schur complement), which only requires inverting the 3x3 point blocks,
+    leaving a dense system of size 6 * C for the cameras; the first "num_fixed_cams" cameras get a zero update.
+    Meant for a few cameras only (e.g. a window of keyframes): W is gathered per point as a dense (6 * C, 3) block,
+    such that the reduced camera system is a single matrix product.
+    """
+    num_cams, num_points = len(U), len(V)
+    V_inv = np.linalg.inv(V)
+    W = _block_sums(W, point_idxs * num_cams + cam_idxs, num_points * num_cams)
+    W = W.reshape(num_points, num_cams, 6, 3).reshape(num_points, 6 * num_cams, 3)
+    Y = np.matmul(W, V_inv)    # W * V^-1, per point
+    
+    # Reduced camera system: S * d_cam = b, with S = U - W * V^-1 * W.T and b = -g_cam + W * V^-1 * g_point
+    S = -np.tensordot(Y, W, axes=([0, 2], [0, 2]))
+    for c in range(num_cams):
+        S[6 * c : 6 * c + 6, 6 * c : 6 * c + 6] += U[c]
+    b = -g_cam.ravel() + np.einsum("pij,pj->i", Y, g_point)
+    
+    # Solve for the free cameras, then back-substitute the points
+    d_cam = np.zeros(6 * num_cams)
+    free = 6 * num_fixed_cams
+    if free < len(d_cam):
+        d_cam[free:] = np.linalg.solve(S[free:, free:], b[free:])
+    d_point = np.einsum("pij,pj->pi", V_inv, -g_point - np.einsum("pji,j->pi", W, d_cam))
+    d_cam = d_cam.reshape(num_cams, 6)
+    return d_cam, d_point
+
+
+def sparse_block_matrix(blocks, block_rows, block_cols, shape):
+    """
+    Return a block sparse (BSR) matrix of shape "shape", with the (N, r, c) "blocks"
+    at block-rows "block_rows" and block-columns "block_cols"; overlapping blocks are summed.
+    Products of BSR matrices multiply whole blocks at once, which is much faster than element-wise sparse formats.
+    """
+    from scipy import sparse
+    order = np.argsort(block_rows, kind="mergesort")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(block_rows, minlength=shape[0] // blocks.shape[1]))))
+    matrix = sparse.bsr_matrix((blocks[order], block_cols[order], offsets), shape=shape)
+    matrix.sum_duplicates()
+    return matrix
+
+
+def _sparse_schur_terms(U, V, W, g_cam, g_point, cam_idxs, point_idxs):
+    """
+    Return the terms of the reduced camera system (see "_schur_solve()") for many cameras, as sparse matrices:
+    the point blocks inverted "V_inv", the (N, 6, 3) blocks "Y" = W * V^-1 of each observation,
+    the (6 * C, 3 * P) sparse matrices "W_sparse" and "Y_sparse" of "W" and "Y", and the right-hand side "b".
+    """
+    num_cams, num_points = len(U), len(V)
+    V_inv = np.linalg.inv(V)
+    Y = np.matmul(W, V_inv[point_idxs])    # W * V^-1, per observation
+    W_sparse = sparse_block_matrix(W, cam_idxs, point_idxs, (6 * num_cams, 3 * num_points))
+    Y_sparse = sparse_block_matrix(Y, cam_idxs, point_idxs, (6 * num_cams, 3 * num_points))
+    b = -g_cam.ravel() + Y_sparse.dot(g_point.ravel())
+    return V_inv, Y, W_sparse, Y_sparse, b
+
+
+def _back_substitute(V_inv, W_sparse, g_point, d_cam):
+    """Return the camera updates "d_cam" per camera, and the point updates that follow from them."""
+    d_point = np.matmul(V_inv, (-g_point - W_sparse.T.dot(d_cam).reshape(-1, 3))[:, :, None])[:, :, 0]
+    return d_cam.reshape(-1, 6), d_point
+
+
+def _schur_solve_sparse(U, V, W, g_cam, g_point, cam_idxs, point_idxs, num_fixed_cams):
+    """
+    Equivalent of "_schur_solve()", for many cameras:
+    the reduced camera system S = U - W * V^-1 * W.T is only non-zero for pairs of cameras that share a point,
+    it's built as a block sparse matrix product, and solved by a sparse direct (LU) factorization.
+    """
+    from scipy import sparse
+    from scipy.sparse.linalg import spsolve
+    num_cams = len(U)
+    V_inv, Y, W_sparse, Y_sparse, b = _sparse_schur_terms(U, V, W, g_cam, g_point, cam_idxs, point_idxs)
+    S = sparse_block_matrix(U, np.arange(num_cams), np.arange(num_cams), (6 * num_cams, 6 * num_cams)) - \
+        Y_sparse.dot(W_sparse.T)
+    
+    d_cam = np.zeros(6 * num_cams)
+    free = 6 * num_fixed_cams
+    if free < len(d_cam):
+        d_cam[free:] = spsolve(sparse.csc_matrix(S.tocsr()[free:, free:]), b[free:])
+    return _back_substitute(V_inv, W_sparse, g_point, d_cam)
+
+
+def _schur_solve_pcg(U, V, W, g_cam, g_point, cam_idxs, point_idxs, num_fixed_cams,
+                     tolerance=1.e-3, max_iterations=100):
+    """
+    Equivalent of "_schur_solve()", for many cameras:
+    the reduced camera system is solved by the preconditioned conjugate gradients method,
+    without ever forming it, each product S * x = U * x - Y * (W.T * x) only costs O(# observations).
+    The preconditioner is the inverse of the diagonal (6x6) camera blocks of S.
+    Iterates until the residual is "tolerance" times smaller than the right-hand side, or for "max_iterations":
+    an inexact solution suffices, since Levenberg-Marquardt re-linearizes after each step anyway.
+    """
+    num_cams = len(U)
+    V_inv, Y, W_sparse, Y_sparse, b = _sparse_schur_terms(U, V, W, g_cam, g_point, cam_idxs, point_idxs)
+    D_inv = np.linalg.inv(U - _block_sums(np.matmul(Y, W.transpose(0, 2, 1)), cam_idxs, num_cams))
+    free = 6 * num_fixed_cams
+    Y_csr, W_T_csr = Y_sparse.tocsr(), W_sparse.T.tocsr()    # faster matrix-vector products
+    
+    def apply_S(x_free):
+        x = np.zeros(6 * num_cams)
+        x[free:] = x_free
+        Sx = np.matmul(U, x.reshape(-1, 6, 1)).ravel() - Y_csr.dot(W_T_csr.dot(x))
+        return Sx[free:]
+    
+    def apply_preconditioner(r_free):
+        return np.matmul(D_inv[num_fixed_cams:], r_free.reshape(-1, 6, 1)).ravel()
+    
+    b_free = b[free:]
+    x = np.zeros(len(b_free))
+    r = b_free.copy()
+    z = apply_preconditioner(r)
+    p = z.copy()
+    rz = r.dot(z)
+    stop = (tolerance * np.sqrt(b_free.dot(b_free)))**2
+    for iteration in range(max_iterations):
+        if r.dot(r) <= stop:
+            break
+        Sp = apply_S(p)
+        alpha = rz / p.dot(Sp)
+        x += alpha * p
+        r -= alpha * Sp
+        z = apply_preconditioner(r)
+        rz, rz_prev = r.dot(z), rz
+        p = z + (rz / rz_prev) * p
+    
+    d_cam = np.zeros(6 * num_cams)
+    d_cam[free:] = x
+    return _back_substitute(V_inv, W_sparse, g_point, d_cam)
+
+
+schur_solvers = {"dense": _schur_solve, "sparse": _schur_solve_sparse, "pcg": _schur_solve_pcg}
+
+
+def bundle_adjustment(rvecs, tvecs, objp, cam_idxs, point_idxs, imgpnrm,
+                      num_fixed_cams=1, kernel="huber", threshold=1.e-3, max_iterations=10, tolerance=1.e-8,
+                      solver="dense", verbose=False):
+    """
+    Jointly refine the camera poses ("rvecs", "tvecs") and 3D points "objp",
+    minimizing the robust reprojection error of the observations "imgpnrm" (undistorted and normalized)
+    of points "point_idxs" by cameras "cam_idxs".
+    
+    The first "num_fixed_cams" cameras are held fixed, to fix the gauge freedom.
+    "threshold" is the scale of the robust kernel "kernel" ("huber" or "cauchy"), in normalized image coordinates.
+    Each Levenberg-Marquardt iteration re-weights all observations at once (IRLS),
+    and solves the normal equations with the Schur complement trick, see "_schur_solve()":
+    its cost grows linearly with the amount of observations, and cubically with the amount of cameras only.
+    The optimization stops early if the update is smaller than "tolerance".
+    
+    "solver" selects how the reduced camera system is solved:
+        "dense" : dense matrix, for a few cameras (e.g. a window of keyframes)
+        "sparse" : sparse direct factorization, for many cameras (e.g. offline BA of a full sequence)
+        "pcg" : preconditioned conjugate gradients, for many cameras, cheaper per iteration and in memory than "sparse"
+    If "verbose" is True, the cost and RMS error are printed after each iteration.
+    
+    Returns the refined "rvecs", "tvecs" and "objp",
+    and the RMS reprojection error (in normalized image coordinates) before and after the optimization.
+    """
+    if kernel not in robust_kernels:
+        raise ValueError("Unknown robust kernel '%s', choose from: %s" % (kernel, sorted(robust_kernels)))
+    kernel_weights, kernel_cost = robust_kernels[kernel]
+    if solver not in schur_solvers:
+        raise ValueError("Unknown solver '%s', choose from: %s" % (solver, sorted(schur_solvers)))
+    schur_solve = schur_solvers[solver]
+    
+    cams = np.concatenate((np.asarray(rvecs, dtype=float).reshape(-1, 3), np.asarray(tvecs, dtype=float).reshape(-1, 3)), axis=1)
+    objp = np.array(objp, dtype=float).reshape(-1, 3)
+    imgpnrm = np.asarray(imgpnrm, dtype=float).reshape(-1, 2)
+    cam_idxs, point_idxs = np.asarray(cam_idxs), np.asarray(point_idxs)
+    num_cams, num_points = len(cams), len(objp)
+    if not (0 <= num_fixed_cams <= num_cams):
+        raise ValueError("Can't hold %s cameras fixed, only %s cameras are given" % (num_fixed_cams, num_cams))
+    
+    def evaluate(cams, objp):
+        residuals = np.sqrt((_reprojection(cams, objp, cam_idxs, point_idxs, imgpnrm)**2).sum(axis=1))
+        return residuals, kernel_cost(residuals, threshold).sum()
+    
+    residuals, cost = evaluate(cams, objp)
+    rms_before = np.sqrt((residuals**2).mean())
+    damping = 1.e-3
+    for iteration in range(max_iterations):
+        errors, J_cam, J_point = _reprojection(cams, objp, cam_idxs, point_idxs, imgpnrm, jacobians=True)
+        weights = kernel_weights(residuals, threshold)
+        
+        # Weighted normal equations, in blocks
+        J_cam_weighted_T = (weights[:, None, None] * J_cam).transpose(0, 2, 1)
+        J_point_weighted_T = (weights[:, None, None] * J_point).transpose(0, 2, 1)
+        U = _block_sums(np.matmul(J_cam_weighted_T, J_cam), cam_idxs, num_cams)
+        V = _block_sums(np.matmul(J_point_weighted_T, J_point), point_idxs, num_points)
+        W = np.matmul(J_cam_weighted_T, J_point)
+        g_cam = _block_sums(np.matmul(J_cam_weighted_T, errors[:, :, None])[:, :, 0], cam_idxs, num_cams)
+        g_point = _block_sums(np.matmul(J_point_weighted_T, errors[:, :, None])[:, :, 0], point_idxs, num_points)
+        
+        # Increase the damping until the cost decreases
+        diag_U = np.eye(6) * (np.diagonal(U, axis1=1, axis2=2)[:, :, None] + 1.e-12)
+        diag_V = np.eye(3) * (np.diagonal(V, axis1=1, axis2=2)[:, :, None] + 1.e-12)
+        while damping < 1.e8:
+            d_cam, d_point = schur_solve(U + damping * diag_U, V + damping * diag_V, W, g_cam, g_point,
+                                          cam_idxs, point_idxs, num_fixed_cams)
+            residuals_new, cost_new = evaluate(cams + d_cam, objp + d_point)
+            if cost_new <= cost:
+                break
+            damping *= 10
+        else:
+            break    # no further decrease possible, we're at a minimum
+        
+        cams, objp = cams + d_cam, objp + d_point
+        residuals, cost = residuals_new, cost_new
+        damping = max(damping / 10, 1.e-7)
+        if verbose:
+            print ("Iteration %s: cost %.6e, RMS error %.6e" % (iteration + 1, cost, np.sqrt((residuals**2).mean())))
+        if np.sqrt((d_cam**2).sum() + (d_point**2).sum()) < tolerance:
+            break
+    
+    rms_after = np.sqrt((residuals**2).mean())
+    return cams[:, 0:3], cams[:, 3:6], objp, rms_before, rms_after
+
+
+
+""" Sliding-window (local) bundle adjustment """
+
+
+class WindowKeyframe:
+    def __init__(self, frame_idx, rvec, tvec, imgpnrm, objp_idxs):
+        self.frame_idx = frame_idx
+        self.rvec = rvec    # pose of the keyframe
+        self.tvec = tvec
+        self.imgpnrm = imgpnrm    # observations (undistorted and normalized) ...
+        self.objp_idxs = objp_idxs    # ... of these 3D points
+
+
+class LocalBundleAdjuster:
+    """
+    Keeps the observations of map points in the last "window_size" keyframes,
+    to jointly refine the poses of those keyframes and the points they observe, each time a keyframe is added.
+    The oldest keyframes of the window are held fixed (two of them, to fix both the pose and the scale of the window),
+    and only points observed in at least 2 keyframes of the window are refined;
+    hence the cost of an optimization is bounded by the size of the window, not by the size of the map.
+    """
+    
+    def __init__(self, window_size=5, num_fixed_keyframes=2, kernel="huber", threshold=1.e-3, max_iterations=5):
+        """
+        "num_fixed_keyframes" : amount of oldest keyframes of the window that are held fixed
+        "kernel", "threshold" : robust kernel, and its scale in normalized image coordinates, see "bundle_adjustment()"
+        "max_iterations" : max amount of Levenberg-Marquardt iterations per optimization
+        """
+        if not (1 <= num_fixed_keyframes < window_size):
+            raise ValueError("The window should contain more keyframes than the %s fixed ones" % num_fixed_keyframes)
+        self.window_size = window_size
+        self.num_fixed_keyframes = num_fixed_keyframes
+        self.kernel = kernel
+        self.threshold = threshold
+        self.max_iterations = max_iterations
+        self.keyframes = []    # "WindowKeyframe"s, oldest first
+    
+    def add_keyframe(self, frame_idx, rvec, tvec, imgpnrm, objp_idxs):
+        """Add keyframe "frame_idx" with pose ("rvec", "tvec"), observing 3D points "objp_idxs" at "imgpnrm"."""
+        self.keyframes.append(WindowKeyframe(frame_idx, rvec, tvec,
+                                             np.array(imgpnrm, dtype=float).reshape(-1, 2), np.array(objp_idxs, dtype=int)))
+        del self.keyframes[:-self.window_size]
+    
+    def add_observations(self, frame_idx, imgpnrm, objp_idxs):
+        """
+        Add observations "imgpnrm" of 3D points "objp_idxs" to keyframe "frame_idx", if it's still in the window,
+        e.g. for points that were triangulated after that keyframe was added.
+        """
+        for keyframe in self.keyframes:
+            if keyframe.frame_idx == frame_idx:
+                keyframe.imgpnrm = np.concatenate((keyframe.imgpnrm, np.asarray(imgpnrm, dtype=float).reshape(-1, 2)))
+                keyframe.objp_idxs = np.concatenate((keyframe.objp_idxs, objp_idxs))
+                break
+    
+    def remap_objp_idxs(self, new_idxs):
+        """
+        Replace each 3D point idx "i" of the observations by "new_idxs[i]", e.g. after the map got compacted;
+        the observations of points that got removed (a new idx of -1) are dropped.
+        """
+        for keyframe in self.keyframes:
+            objp_idxs = new_idxs[keyframe.objp_idxs]
+            keep = (objp_idxs >= 0)
+            keyframe.imgpnrm, keyframe.objp_idxs = keyframe.imgpnrm[keep], objp_idxs[keep]
+    
+    def optimize(self, objp):
+        """
+        Run bundle adjustment over the keyframes in the window, and the points of "objp" they observe (at least twice).
+        The keyframe poses are updated in-place.
+        
+        Returns the idxs of the refined 3D points, their refined coordinates,
+        and the RMS reprojection error (in normalized image coordinates) before and after the optimization;
+        or None if the window doesn't contain more keyframes than the fixed ones.
+        """
+        if len(self.keyframes) <= self.num_fixed_keyframes:
+            return None
+        
+        # Collect the observations, and only keep the ones of points seen by at least 2 keyframes
+        cam_idxs = np.concatenate([np.repeat(i, len(kf.objp_idxs)) for i, kf in enumerate(self.keyframes)])
+        objp_idxs = np.concatenate([kf.objp_idxs for kf in self.keyframes])
+        imgpnrm = np.concatenate([kf.imgpnrm for kf in self.keyframes])
+        window_objp_idxs, point_idxs, num_observations = np.unique(objp_idxs, return_inverse=True, return_counts=True)
+        keep = (num_observations[point_idxs] >= 2)
+        window_objp_idxs, point_idxs = np.unique(objp_idxs[keep], return_inverse=True)
+        if not len(window_objp_idxs):
+            return None
+        
+        rvecs, tvecs, objp_refined, rms_before, rms_after = bundle_adjustment(
+                [np.ravel(kf.rvec) for kf in self.keyframes], [np.ravel(kf.tvec) for kf in self.keyframes], objp[window_objp_idxs],
+                cam_idxs[keep], point_idxs, imgpnrm[keep],
+                num_fixed_cams=self.num_fixed_keyframes, kernel=self.kernel, threshold=self.threshold, max_iterations=self.max_iterations )
+        for keyframe, rvec, tvec in zip(self.keyframes, rvecs, tvecs):
+            keyframe.rvec, keyframe.tvec = rvec.reshape(3, 1), tvec.reshape(3, 1)
+        return window_objp_idxs, objp_refined, rms_before, rms_after
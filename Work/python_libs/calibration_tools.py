@@ -56,6 +56,33 @@ def load_camera_intrinsics(filename):
     return cameraMatrix, distCoeffs, imageSize
 
 
+def undistort_points(imgp, cameraMatrix, distCoeffs, iterations=20):
+    """
+    Return the (N, 2) undistorted and normalized coordinates of the (N, 2) image points "imgp",
+    by inverting OpenCV's radial-tangential distortion model with fixed-point iterations.
+    
+    "distCoeffs" contains (k1, k2, p1, p2[, k3]).
+    Unlike "cv2.undistortPoints()", the skew (shear) "cameraMatrix[0, 1]" is taken into account,
+    as in GTSAM's "Cal3DS2" model.
+    """
+    imgp = np.asarray(imgp, dtype=float).reshape(-1, 2)
+    distCoeffs = np.concatenate((np.ravel(distCoeffs), np.zeros(5)))
+    k1, k2, p1, p2, k3 = distCoeffs[0:5]
+    
+    # Distorted normalized coordinates
+    yd = (imgp[:, 1] - cameraMatrix[1, 2]) / cameraMatrix[1, 1]
+    xd = (imgp[:, 0] - cameraMatrix[0, 2] - cameraMatrix[0, 1] * yd) / cameraMatrix[0, 0]
+    
+    x, y = xd, yd
+    for i in range(iterations):
+        r2 = x**2 + y**2
+        radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+        x, y = ( (xd - (2 * p1 * x * y + p2 * (r2 + 2 * x**2))) / radial,
+                 (yd - (p1 * (r2 + 2 * y**2) + 2 * p2 * x * y)) / radial )
+    
+    return np.stack((x, y), axis=1)
+
+
 def undistort_image(img, cameraMatrix, distCoeffs, imageSize):
     """
     Undistort image "img",
@@ -0,0 +1,81 @@
+import numpy as np
+
+
+
+""" Chunked columnar storage """
+
+
+class ChunkedColumns:
+    """
+    Append-only table of named, typed columns, stored in chunks of "chunk_size" rows.
+    
+    Appending only writes into the last chunk, full chunks are never copied or touched again,
+    so the cost of an append is O(# new rows), and the memory use is close to the sum of the column item sizes per row.
+    Reading a column concatenates its chunks.
+    """
+    
+    def __init__(self, columns, chunk_size=1 << 16):
+        """
+        "columns" : list of (name, dtype) tuples
+        """
+        self.names = [name for name, dtype in columns]
+        self.dtypes = dict(columns)
+        self.chunk_size = chunk_size
+        self.chunks = []    # per chunk: dict of name -> array of "chunk_size" rows, the last one is partially filled
+        self._size = 0
+    
+    def __len__(self):
+        return self._size
+    
+    @property
+    def nbytes(self):
+        """Amount of bytes allocated for the chunks."""
+        return sum(array.nbytes for chunk in self.chunks for array in chunk.values())
+    
+    def append(self, **columns):
+        """
+        Append rows, given as one array per column (all of the same length); scalars are repeated.
+        All columns have to be given.
+        """
+        num_rows = max([np.size(values) for values in columns.values() if np.ndim(values)] or [1])
+        columns = dict((name, np.broadcast_to(columns[name], (num_rows, ))) for name in self.names)
+        
+        done = 0
+        while done < num_rows:
+            pos = self._size % self.chunk_size
+            if not pos:
+                self.chunks.append(dict((name, np.empty(self.chunk_size, dtype=self.dtypes[name])) for name in self.names))
+            count = min(self.chunk_size - pos, num_rows - done)
+            chunk = self.chunks[-1]
+            for name in self.names:
+                chunk[name][pos : pos + count] = columns[name][done : done + count]
+            done += count
+            self._size += count
+    
+    def column(self, name, start=0, stop=None):
+        """Return the rows ["start", "stop") of column "name", as one contiguous array."""
+        stop = self._size if stop is None else min(stop, self._size)
+        if start >= stop:
+            return np.zeros(0, dtype=self.dtypes[name])
+        first, last = start // self.chunk_size, (stop - 1) // self.chunk_size
+        parts = [chunk[name] for chunk in self.chunks[first : last + 1]]
+        parts[-1] = parts[-1][: stop - last * self.chunk_size]
+        parts[0] = parts[0][start - first * self.chunk_size :]
+        return np.concatenate(parts)
+    
+    def csr(self, key, num_keys, names, rows=None):
+        """
+        Group the rows by their (integer) value of column "key", in [0, "num_keys"), in compressed sparse row (CSR) layout;
+        the rows of each group stay in order of appending.
+        If "rows" is given (e.g. a boolean mask), only those rows are grouped.
+        
+        Returns the (num_keys + 1) offsets of the groups, and the grouped columns "names".
+        """
+        keys = self.column(key)
+        columns = [self.column(name) for name in names]
+        if rows is not None:
+            keys = keys[rows]
+            columns = [values[rows] for values in columns]
+        order = np.argsort(keys, kind="mergesort")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=num_keys))))
+        return offsets, [values[order] for values in columns]
@@ -39,5 +39,8 @@ def color_palette(nc_L, nc_a, nc_b):
 def sample_colors(img, imgp):
     """
     Sample the colors of image "img" at points "imgp", and return the resulting list of colors.
+    Points (slightly) outside the image, e.g. tracked by optical flow, get the color of the nearest border pixel.
     """
-    return img[tuple(np.rint(imgp[:, ::-1]).astype(int).T)]
+    rows_cols = np.rint(imgp[:, ::-1]).astype(int)
+    rows_cols = np.clip(rows_cols, 0, np.array(img.shape[0:2]) - 1)
+    return img[tuple(rows_cols.T)]
@@ -343,3 +343,140 @@ else:
         if not methodName.startswith('_'):
             exec("def method(self, *args, **kwargs): return self.this.%s(*args, **kwargs)" % methodName)
             setattr(BFMatcher, methodName, method)
+
+
+# Neighbourhood size of the corner response (minimal eigenvalue) of "FeatureGrid.detect()", OpenCV's default
+feature_grid_corner_block_size = 3
+
+class FeatureGrid:
+    """
+    Spatial grid over an image, with square cells of "cell_size" pixels,
+    to bucket 2D points and to detect new corners only in under-populated cells.
+    """
+    
+    def __init__(self, imageSize, cell_size, max_per_cell):
+        """
+        "imageSize" : (width, height) of the image
+        "max_per_cell" : amount of points a cell should contain to be considered fully populated
+        """
+        self.imageSize = imageSize
+        self.cell_size = cell_size
+        self.max_per_cell = max_per_cell
+        self.grid_shape = (    # (rows, cols)
+                int(np.ceil(imageSize[1] / float(cell_size))), int(np.ceil(imageSize[0] / float(cell_size))) )
+        self.num_cells = self.grid_shape[0] * self.grid_shape[1]
+    
+    def cell_idxs(self, points):
+        """Returns the (flattened) index of the cell of each of the 2D points "points"."""
+        points = np.asarray(points).reshape(-1, 2)
+        cols = np.clip((points[:, 0] // self.cell_size).astype(int), 0, self.grid_shape[1] - 1)
+        rows = np.clip((points[:, 1] // self.cell_size).astype(int), 0, self.grid_shape[0] - 1)
+        return rows * self.grid_shape[1] + cols
+    
+    def occupancy(self, points):
+        """Returns the amount of points "points" in each cell, as a (flattened) array."""
+        return np.bincount(self.cell_idxs(points), minlength=self.num_cells)
+    
+    def coverage(self, points):
+        """Returns the ratio of cells that contain at least one of the points "points"."""
+        return np.count_nonzero(self.occupancy(points)) / float(self.num_cells)
+    
+    def pairs_within(self, points, candidates, radius):
+        """
+        Returns the idxs in "points" and the idxs in "candidates" (both 2D points) of all pairs at most "radius" pixels apart.
+        
+        The candidates are bucketed by cell, and each point is only compared with the candidates of the 3x3 cells around it,
+        hence "radius" can't exceed "cell_size".
+        """
+        if radius > self.cell_size:
+            raise ValueError("The radius (%s) can't exceed the cell size (%s)" % (radius, self.cell_size))
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        candidates = np.asarray(candidates, dtype=np.float32).reshape(-1, 2)
+        
+        # Sort the candidates by cell, such that the candidates of each cell are stored contiguously
+        candidate_cells = self.cell_idxs(candidates)
+        order = np.argsort(candidate_cells, kind="mergesort")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(candidate_cells, minlength=self.num_cells))))
+        
+        # Collect the candidates of each neighbouring cell of each point
+        cells = self.cell_idxs(points)
+        rows, cols = cells // self.grid_shape[1], cells % self.grid_shape[1]
+        point_idxs, candidate_idxs = [], []
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                valid = np.where(np.logical_and(
+                        np.logical_and(0 <= rows + d_row, rows + d_row < self.grid_shape[0]),
+                        np.logical_and(0 <= cols + d_col, cols + d_col < self.grid_shape[1]) ))[0]
+                neighbours = (rows[valid] + d_row) * self.grid_shape[1] + cols[valid] + d_col
+                counts = offsets[neighbours + 1] - offsets[neighbours]
+                starts = np.repeat(offsets[neighbours] - np.cumsum(counts) + counts, counts)
+                point_idxs.append(np.repeat(valid, counts))
+                candidate_idxs.append(order[starts + np.arange(counts.sum())])
+        point_idxs, candidate_idxs = np.concatenate(point_idxs), np.concatenate(candidate_idxs)
+        
+        close = (((points[point_idxs] - candidates[candidate_idxs])**2).sum(axis=1) <= radius**2)
+        return point_idxs[close], candidate_idxs[close]
+    
+    def detect(self, img_gray, points, to_add, quality_level, min_dist):
+        """
+        Returns at most "to_add" new corners of "img_gray", at least "min_dist" pixels away from "points".
+        
+        Only cells containing less than "max_per_cell" of "points" are searched, the least populated ones first,
+        and each of them receives at most the amount of corners it's short of.
+        See OpenCV's "goodFeaturesToTrack()" documentation for "quality_level" and "min_dist",
+        however "quality_level" is relative to the strongest corner of the whole image, not of each cell,
+        such that cells of weak texture don't receive their (noisy) strongest responses as corners.
+        """
+        corners = np.zeros((0, 2), dtype=np.float32)
+        if to_add <= 0:
+            return corners
+        
+        # Find the under-populated cells, and the amount of corners each of them is allowed to receive
+        occupancy = self.occupancy(points)
+        cells = np.where(occupancy < self.max_per_cell)[0]
+        cells = cells[np.argsort(occupancy[cells], kind="mergesort")]    # least populated cells first, keep order otherwise
+        quotas = self.max_per_cell - occupancy[cells]
+        
+        # Absolute threshold on the corner response (the minimal eigenvalue, as used by "goodFeaturesToTrack()")
+        min_response = quality_level * cv2.cornerMinEigenVal(img_gray, feature_grid_corner_block_size).max()
+        if not min_response > 0:
+            return corners    # no corners at all
+        
+        # Detect corners in each of those cells, stop once enough candidates are found
+        cell_corners = []
+        num_found = 0
+        for cell, quota in zip(cells, quotas):
+            row, col = divmod(cell, self.grid_shape[1])
+            x0, y0 = col * self.cell_size, row * self.cell_size
+            roi = img_gray[y0 : y0 + self.cell_size, x0 : x0 + self.cell_size]
+            
+            # "goodFeaturesToTrack()" is relative to the strongest response of the ROI, convert the absolute threshold
+            max_roi_response = cv2.cornerMinEigenVal(roi, feature_grid_corner_block_size).max()
+            if max_roi_response < min_response:
+                continue
+            found = cv2.goodFeaturesToTrack(roi, int(quota), min_response / max_roi_response, min_dist,
+                                            blockSize=feature_grid_corner_block_size)
+            if found is None:
+                continue
+            found = found.reshape(-1, 2)
+            found += (x0, y0)    # from ROI to image coordinates
+            cell_corners.append(found)
+            num_found += len(found)
+            if num_found >= 2 * to_add:    # leave some margin for the distance filter below
+                break
+        if not cell_corners:
+            return corners
+        corners = np.concatenate(cell_corners)
+        
+        # Drop candidates too close to existing points, ...
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        if len(points):
+            sq_dists = ((corners[:, np.newaxis, :] - points[np.newaxis, :, :])**2).sum(axis=2)
+            corners = corners[sq_dists.min(axis=1) >= min_dist**2]
+        
+        # ... and candidates too close to a previous candidate of a neighbouring cell
+        sq_dists = ((corners[:, np.newaxis, :] - corners[np.newaxis, :, :])**2).sum(axis=2)
+        too_close = np.tril(sq_dists < min_dist**2, -1).any(axis=1)
+        corners = corners[np.logical_not(too_close)]
+        
+        return corners[:to_add]
@@ -1,5 +1,7 @@
 import os
 import struct
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
 
@@ -65,6 +67,48 @@ def image_filepaths_by_directory(img_dir):
     return [os.path.join(img_dir, image) for key, image in keys_and_images]
 
 
+""" Image loading functions """
+
+
+def load_image_and_gray(filepath):
+    """
+    Returns the BGR image at "filepath", together with its grayscale version.
+    """
+    import cv2
+    
+    img = cv2.imread(filepath)
+    if img is None:
+        raise IOError("Can't read the image file '%s'" % filepath)
+    return img, cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+def prefetched_images(filepaths, depth=4, num_threads=2):
+    """
+    Generator that yields (image, grayscale image) for each of the images at "filepaths", in order.
+    
+    The next "depth" images are decoded and converted to grayscale in advance, on a pool of "num_threads" threads,
+    such that disk access and decoding overlap with the processing of the current image.
+    If "depth" is 0, each image is loaded synchronously, when requested.
+    
+    Note: both cv2.imread() and cv2.cvtColor() release the GIL, so threads are sufficient.
+    """
+    if depth <= 0:
+        for filepath in filepaths:
+            yield load_image_and_gray(filepath)
+        return
+    
+    pool = ThreadPool(max(1, min(num_threads, depth)))
+    try:
+        pending = deque()    # async results, in order of the filepaths
+        for filepath in filepaths:
+            pending.append(pool.apply_async(load_image_and_gray, (filepath, )))
+            if len(pending) > depth:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
 """ File- import/export functions """
 
 
@@ -220,7 +264,7 @@ def save_3D_points_to_pcd_file(filename, points, colors=None):
     to PLY format with the application "pcd2ply" or "pcl_pcd2ply", included in PointCloudLibrary (pcl):
     http://pointclouds.org/
     """
-    use_alpha = (colors != None and colors.shape[1] == 4)
+    use_alpha = (colors is not None and colors.shape[1] == 4)
     
     def bgra2float(bgra):
         return struct.unpack('f', bytearray(bgra))[0]
@@ -240,14 +284,14 @@ def save_3D_points_to_pcd_file(filename, points, colors=None):
     VIEWPOINT 0 0 0 1 0 0 0
     POINTS %s
     DATA ascii
-    """ % (" rgb" * (colors != None), " 4" * (colors != None), " F" * (colors != None), " 1" * (colors != None),
+    """ % (" rgb" * (colors is not None), " 4" * (colors is not None), " F" * (colors is not None), " 1" * (colors is not None),
            len(points), len(points))
     from textwrap import dedent
     header = dedent(header[1:])    # removes first new-line and indents
     
     points = points.astype(np.float32)
     
-    if colors != None:
+    if colors is not None:
         if colors.dtype != np.uint8:
             colors = colors.astype(np.uint8)
         if use_alpha:
@@ -282,7 +326,7 @@ def convert_cam_poses_to_cam_trajectory_TUM(Ps, fps=30):
     timestps, locations, quaternions = [], [], []
     
     for i, P in enumerate(Ps):
-        if P == None:
+        if P is None:
             continue
         
         timestps.append(float(1 + i) / fps)
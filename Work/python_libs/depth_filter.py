@@ -0,0 +1,121 @@
+import numpy as np
+
+
+
+""" Inverse-depth filter """
+
+
+# Each seed is the depth estimate of a not-yet-triangulated point along its viewing ray in a reference frame,
+# modelled as in SVO (Forster et al., 2014, after Vogiatzis and Hernandez, 2011):
+# a Gaussian on the inverse depth for good measurements, mixed with a uniform distribution for outliers,
+# with a Beta distribution on the inlier ratio.
+# The seeds are stored as rows of an (N, 5) float array, with columns:
+MU, SIGMA2, A, B, Z_RANGE = range(5)    # mean and variance of the inverse depth, Beta parameters, max inverse depth
+num_seed_columns = 5
+
+
+def init_seeds(num_seeds, depth_mean, depth_min):
+    """
+    Return "num_seeds" new seeds, for points in a scene with mean depth "depth_mean" and min depth "depth_min".
+    """
+    seeds = np.empty((num_seeds, num_seed_columns))
+    seeds[:, MU] = 1. / depth_mean
+    seeds[:, Z_RANGE] = 1. / depth_min
+    seeds[:, SIGMA2] = seeds[:, Z_RANGE]**2 / 36
+    seeds[:, A] = 10.
+    seeds[:, B] = 10.
+    return seeds
+
+
+def depths_from_triangulation(f_ref, f_cur, R, t):
+    """
+    Return the depths along the (N, 3) rays "f_ref" of the reference frame,
+    of the points that are observed along the rays "f_cur" of the current frame,
+    where ("R", "t") transforms points from the reference frame to the current frame;
+    "t" is either shared by all rays, or an (N, 3) array (e.g. when each ray has its own reference frame).
+    The depths are those of the points on the reference rays closest to the current rays;
+    depths of (nearly) parallel rays, or of points behind a camera, are NaN.
+    """
+    Rf = f_ref.dot(R.T)
+    t = np.asarray(t, dtype=float).reshape(-1, 3)
+    
+    # Least-squares solution of depth_ref * Rf - depth_cur * f_cur = -t, per ray (2x2 normal equations)
+    a, b, c = (Rf**2).sum(axis=1), -(Rf * f_cur).sum(axis=1), (f_cur**2).sum(axis=1)
+    d, e = -(Rf * t).sum(axis=1), (f_cur * t).sum(axis=1)
+    det = a * c - b**2
+    valid = (det > 1e-12 * a * c)
+    det = np.where(valid, det, 1.)
+    depths_ref = (c * d - b * e) / det
+    depths_cur = (a * e - b * d) / det
+    valid = np.logical_and(valid, np.logical_and(depths_ref > 0, depths_cur > 0))    # in front of both cameras
+    return np.where(valid, depths_ref, np.nan)
+
+
+def depth_uncertainties(f_ref, depths, t_ref_cur, px_error_angle):
+    """
+    Return the standard deviations of the "depths" along the (N, 3) unit rays "f_ref" of the reference frame,
+    when the observation in the current frame, with optical center "t_ref_cur" in reference coordinates,
+    is off by the angle "px_error_angle" (e.g. 1 pixel);
+    "t_ref_cur" is either shared by all rays, or an (N, 3) array (e.g. when each ray has its own reference frame).
+    Depths of which the shifted ray no longer intersects the reference ray (too small parallax) have an infinite uncertainty.
+    """
+    t = np.asarray(t_ref_cur, dtype=float).reshape(-1, 3)
+    t_norm = np.sqrt((t**2).sum(axis=1))
+    a = f_ref * depths[:, None] - t
+    a_norm = np.sqrt((a**2).sum(axis=1))
+    with np.errstate(divide="ignore", invalid="ignore"):    # no baseline: NaN angles, hence an infinite uncertainty
+        alpha = np.arccos(np.clip((f_ref * t).sum(axis=1) / t_norm, -1., 1.))
+        beta = np.arccos(np.clip(-(a * t).sum(axis=1) / (t_norm * a_norm), -1., 1.))
+        beta_plus = beta + px_error_angle
+        gamma_plus = np.pi - alpha - beta_plus
+        depths_plus = t_norm * np.sin(beta_plus) / np.sin(gamma_plus)    # law of sines
+    return np.where(gamma_plus > 0, depths_plus - depths, np.inf)
+
+
+def update_seeds(seeds, depths, taus):
+    """
+    Update the "seeds" (in-place) with the depth measurements "depths" with standard deviations "taus";
+    rows with a NaN depth or an infinite standard deviation are not updated.
+    """
+    rows = np.where(np.isfinite(depths) & np.isfinite(taus))[0]
+    seeds_, z, tau = seeds[rows], depths[rows], taus[rows]
+    mu, sigma2, a, b, z_range = [seeds_[:, column] for column in range(num_seed_columns)]
+    
+    # The measurement in inverse depth
+    x = 1. / z
+    tau_inverse = 0.5 * (1. / np.maximum(z - tau, 1e-7) - 1. / (z + tau))
+    tau2 = tau_inverse**2
+    
+    # Posterior of the Gaussian part, and the probabilities of the measurement being an inlier or an outlier
+    s2 = 1. / (1. / sigma2 + 1. / tau2)
+    m = s2 * (mu / sigma2 + x / tau2)
+    norm_scale2 = sigma2 + tau2
+    C1 = a / (a + b) * np.exp(-0.5 * (x - mu)**2 / norm_scale2) / np.sqrt(2 * np.pi * norm_scale2)
+    C2 = b / (a + b) / z_range
+    C1, C2 = C1 / (C1 + C2), C2 / (C1 + C2)
+    
+    # Moment-matching of the mixture and of the Beta distribution
+    f = C1 * (a + 1) / (a + b + 1) + C2 * a / (a + b + 1)
+    e = C1 * (a + 1) * (a + 2) / ((a + b + 1) * (a + b + 2)) + C2 * a * (a + 1) / ((a + b + 1) * (a + b + 2))
+    mu_new = C1 * m + C2 * mu
+    seeds[rows, SIGMA2] = C1 * (s2 + m**2) + C2 * (sigma2 + mu**2) - mu_new**2
+    seeds[rows, MU] = mu_new
+    seeds[rows, A] = (e - f) / (f - e / f)
+    seeds[rows, B] = seeds[rows, A] * (1 - f) / f
+
+
+def converged_seeds(seeds, convergence_ratio=200.):
+    """
+    Return the boolean mask of the "seeds" of which the standard deviation of the inverse depth
+    is "convergence_ratio" times smaller than their range of inverse depths.
+    """
+    return np.sqrt(seeds[:, SIGMA2]) < seeds[:, Z_RANGE] / convergence_ratio
+
+
+def outlier_seeds(seeds, min_inlier_ratio=0.1):
+    """
+    Return the boolean mask of the "seeds" of which the expected inlier ratio of the measurements
+    dropped below "min_inlier_ratio", their point is most likely a bad track (as in SVO);
+    seeds that are not initialized (NaN) are not outliers.
+    """
+    return seeds[:, A] / (seeds[:, A] + seeds[:, B]) < min_inlier_ratio
@@ -0,0 +1,101 @@
+import numpy as np
+import cv2
+
+
+
+""" Motion models """
+
+
+class ConstantVelocityModel:
+    """
+    Predicts the camera pose of a frame from the last two accepted poses,
+    assuming the camera keeps the same (rotational and translational) velocity per frame.
+    
+    Poses are given as OpenCV's "rvec" and "tvec" (world to camera),
+    the velocity is the relative pose between the last two accepted frames, divided by their frame index difference.
+    """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """Forget all poses, e.g. after tracking got lost, no prediction is available until two poses are added."""
+        self.poses = []    # last two accepted (frame_idx, R, t)
+    
+    def update(self, frame_idx, rvec, tvec):
+        """Add the accepted pose ("rvec", "tvec") of frame "frame_idx"."""
+        R = cv2.Rodrigues(np.asarray(rvec, dtype=float))[0]
+        t = np.asarray(tvec, dtype=float).reshape(3, 1)
+        self.poses = self.poses[-1:] + [(frame_idx, R, t)]
+    
+    @property
+    def has_prediction(self):
+        """True if enough poses have been added to predict a new one."""
+        return len(self.poses) == 2
+    
+    def initial_pose(self, frame_idx):
+        """
+        Returns the predicted pose ("rvec", "tvec") of frame "frame_idx" if available,
+        otherwise the last added pose, as a starting point for pose estimation.
+        """
+        if self.has_prediction:
+            return self.predict(frame_idx)
+        frame_idx_last, R_last, t_last = self.poses[-1]
+        return cv2.Rodrigues(R_last)[0], np.array(t_last)
+    
+    def predict(self, frame_idx):
+        """
+        Returns the predicted pose ("rvec", "tvec") of frame "frame_idx", which should come after the last added frame.
+        Frames in between that were not accepted simply extend the extrapolation.
+        """
+        (frame_idx_prev, R_prev, t_prev), (frame_idx_last, R_last, t_last) = self.poses
+        
+        # Relative pose between the last two poses: P_last = P_delta * P_prev, ...
+        R_delta = R_last.dot(R_prev.T)
+        t_delta = t_last - R_delta.dot(t_prev)
+        
+        # ... spread over the frames in between them (first-order approximation for the translation), ...
+        frames_between = frame_idx_last - frame_idx_prev
+        if frames_between > 1:
+            R_delta = cv2.Rodrigues(cv2.Rodrigues(R_delta)[0] / frames_between)[0]
+            t_delta = t_delta / frames_between
+        
+        # ... and applied once for each frame to predict
+        R, t = R_last, t_last
+        for i in range(frame_idx - frame_idx_last):
+            R, t = R_delta.dot(R), R_delta.dot(t) + t_delta
+        return cv2.Rodrigues(R)[0], t
+    
+    def predict_imgp(self, frame_idx, objp, cameraMatrix, distCoeffs):
+        """
+        Returns the predicted pose ("rvec", "tvec") of frame "frame_idx",
+        and the projections of the 3D points "objp" in that frame, given the camera intrinsics.
+        """
+        rvec, tvec = self.predict(frame_idx)
+        if not len(objp):
+            return rvec, tvec, np.zeros((0, 2), dtype=np.float32)
+        imgp = cv2.projectPoints(np.asarray(objp, dtype=np.float32), rvec, tvec, cameraMatrix, distCoeffs)[0]
+        return rvec, tvec, imgp.reshape(-1, 2).astype(np.float32)
+
+
+def initial_flow(prev_imgp, predicted_imgp, predicted):
+    """
+    Returns the initial guess of the new 2D positions of points "prev_imgp", to seed the optical flow with.
+    
+    "predicted" is a boolean mask of the points of which a predicted position is available in "predicted_imgp"
+    (which has the same length as "prev_imgp"); the other points are moved by the median displacement of the predicted ones.
+    """
+    next_imgp = np.array(prev_imgp, dtype=np.float32).reshape(-1, 2)
+    if np.count_nonzero(predicted):
+        median_flow = np.median(predicted_imgp[predicted] - next_imgp[predicted], axis=0)
+        next_imgp[~predicted] += median_flow
+        next_imgp[predicted] = predicted_imgp[predicted]
+    return next_imgp
+
+
+def gate(imgp, predicted_imgp, max_dist):
+    """
+    Returns a boolean mask of the 2D points "imgp" that are located
+    at most "max_dist" pixels away from their predicted positions "predicted_imgp".
+    """
+    return (((imgp - predicted_imgp)**2).sum(axis=1) <= max_dist**2)
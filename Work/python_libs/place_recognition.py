@@ -0,0 +1,371 @@
+import numpy as np
+
+from relocalization import hamming_distances
+
+
+
+""" Binary descriptor matching """
+
+
+def hamming_distance_matrix(descr1, descr2):
+    """
+    Return the (N1, N2) matrix of Hamming distances between all binary descriptors "descr1" and "descr2",
+    (N1, num_bytes) and (N2, num_bytes) uint8 arrays respectively.
+    Uses: popcount(a xor b) = popcount(a) + popcount(b) - 2 * popcount(a and b), the last term as a matrix product.
+    """
+    bits1 = np.unpackbits(descr1, axis=1).astype(np.float32)
+    bits2 = np.unpackbits(descr2, axis=1).astype(np.float32)
+    common = bits1.dot(bits2.T)
+    return (bits1.sum(axis=1)[:, None] + bits2.sum(axis=1)[None, :] - 2 * common).astype(int)
+
+
+def match_descriptors(descr1, descr2, max_distance=64, max_ratio=0.8):
+    """
+    Match each of the binary descriptors "descr1" to its nearest neighbour in "descr2",
+    if it's at most "max_distance" bits away and passes the ratio test with the second nearest neighbour.
+    Returns the idxs in "descr1" and the idxs in "descr2" of the matches.
+    """
+    if len(descr1) == 0 or len(descr2) < 2:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    distances = hamming_distance_matrix(descr1, descr2)
+    nearest2 = np.argpartition(distances, 1, axis=1)[:, 0:2]
+    d = distances[np.arange(len(descr1))[:, None], nearest2]
+    order = np.argsort(d, axis=1)
+    nearest, d = nearest2[np.arange(len(descr1)), order[:, 0]], np.sort(d, axis=1)
+    good = np.logical_and(d[:, 0] <= max_distance, d[:, 0] < max_ratio * d[:, 1])
+    return np.where(good)[0], nearest[good]
+
+
+
+""" Vocabulary tree (bag of binary words) """
+
+
+def _k_majority(descriptors, k, rng, max_iterations=10):
+    """
+    Cluster the binary descriptors "descriptors" in "k" clusters, using the k-majority algorithm
+    (k-means with Hamming distance, of which the centers are the bitwise majority of their members).
+    Returns the cluster centers, and the cluster label of each descriptor.
+    """
+    bits = np.unpackbits(descriptors, axis=1)
+    centers = descriptors[rng.choice(len(descriptors), k, replace=False)]
+    labels = None
+    for iteration in range(max_iterations):
+        new_labels = hamming_distance_matrix(descriptors, centers).argmin(axis=1)
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+        for c in range(k):
+            members = (labels == c)
+            if members.any():
+                centers[c] = np.packbits(2 * bits[members].sum(axis=0) >= np.count_nonzero(members))
+    return centers, labels
+
+
+class BinaryVocabularyTree:
+    """
+    Hierarchical vocabulary of binary descriptors (bag of binary words), as in DBoW2:
+    each node has at most "branching" children, obtained by k-majority clustering, up to a depth of "depth" levels;
+    the leaves are the words, each with an inverse document frequency (idf) weight.
+    
+    The tree is stored as flat arrays, such that converting descriptors to words
+    only takes one vectorized step per level.
+    """
+    
+    def __init__(self, centers, children, word_ids, idf):
+        self.centers = centers    # (num_nodes, num_bytes) uint8, center of each node (root's center is unused)
+        self.children = children    # (num_nodes, branching) int, node idx of each child, or -1
+        self.word_ids = word_ids    # (num_nodes) int, word id of each leaf node, or -1
+        self.idf = idf    # (num_words) float, idf weight of each word
+    
+    @property
+    def num_words(self):
+        return len(self.idf)
+    
+    @staticmethod
+    def train(descriptors_per_image, branching=10, depth=4, seed=0):
+        """
+        Train a vocabulary tree on the binary descriptors of a set of training images,
+        "descriptors_per_image" is a list of (N_i, num_bytes) uint8 arrays, one per image.
+        """
+        rng = np.random.RandomState(seed)
+        descriptors = np.concatenate(descriptors_per_image)
+        centers, children = [np.zeros(descriptors.shape[1], dtype=np.uint8)], [[-1] * branching]
+        node_members = {0: np.arange(len(descriptors))}
+        level_nodes = [0]
+        
+        # Build the tree breadth-first, a node is split if it has more members than branches
+        for level in range(depth):
+            next_level_nodes = []
+            for node in level_nodes:
+                members = node_members.pop(node)
+                if len(members) <= branching:
+                    continue
+                child_centers, labels = _k_majority(descriptors[members], branching, rng)
+                for c in range(branching):
+                    child = len(centers)
+                    centers.append(child_centers[c])
+                    children.append([-1] * branching)
+                    children[node][c] = child
+                    node_members[child] = members[labels == c]
+                    next_level_nodes.append(child)
+            level_nodes = next_level_nodes
+        
+        # The leaves become the words
+        children = np.array(children, dtype=int)
+        leaves = np.where((children < 0).all(axis=1))[0]
+        word_ids = -np.ones(len(children), dtype=int)
+        word_ids[leaves] = np.arange(len(leaves))
+        vocabulary = BinaryVocabularyTree(np.array(centers), children, word_ids, np.ones(len(leaves)))
+        
+        # Inverse document frequency of each word: log(N / number of training images containing the word)
+        num_images_per_word = np.zeros(len(leaves))
+        for image_descriptors in descriptors_per_image:
+            num_images_per_word[np.unique(vocabulary.words(image_descriptors))] += 1
+        vocabulary.idf = np.log(len(descriptors_per_image) / np.maximum(num_images_per_word, 1))
+        return vocabulary
+    
+    def save(self, filepath):
+        """Save the vocabulary to a NumPy ".npz" file."""
+        np.savez_compressed(filepath,
+                            centers=self.centers, children=self.children, word_ids=self.word_ids, idf=self.idf)
+    
+    @staticmethod
+    def load(filepath):
+        """Load a vocabulary saved by "save()"."""
+        data = np.load(filepath)
+        return BinaryVocabularyTree(data["centers"], data["children"], data["word_ids"], data["idf"])
+    
+    def words(self, descriptors):
+        """Return the word id of each of the binary descriptors "descriptors"."""
+        nodes = np.zeros(len(descriptors), dtype=int)    # start at the root
+        all_rows = np.arange(len(descriptors))
+        while True:
+            children = self.children[nodes]
+            has_children = (children[:, 0] >= 0)
+            if not has_children.any():
+                break
+            rows = all_rows[has_children]
+            children = children[has_children]
+            valid = (children >= 0)
+            distances = hamming_distances(descriptors[rows, None, :], self.centers[np.maximum(children, 0)])
+            distances[~valid] = np.iinfo(distances.dtype).max
+            nodes[rows] = children[np.arange(len(rows)), distances.argmin(axis=1)]
+        return self.word_ids[nodes]
+    
+    def bow_vector(self, descriptors):
+        """
+        Return the bag-of-words vector of the binary descriptors "descriptors" of an image,
+        as a sparse (word_ids, weights) pair: tf-idf weights, L1-normalized.
+        """
+        word_ids, counts = np.unique(self.words(descriptors), return_counts=True)
+        weights = counts * self.idf[word_ids]
+        total = weights.sum()
+        if total > 0:
+            weights /= total
+        return word_ids, weights
+
+
+
+""" Inverted index """
+
+
+class BowDatabase:
+    """
+    Inverted index of the bag-of-words vectors of images (e.g. keyframes):
+    for each word, the images containing it, with its weight.
+    A query only visits the images that share words with the query, and scores them with the L1 score of DBoW2.
+    """
+    
+    def __init__(self, num_words, capacity=16):
+        # Per word: buffers of the image idxs and weights (grown by doubling their capacity), and their used size
+        self.postings_images = [np.empty(capacity, dtype=np.int32) for word_id in range(num_words)]
+        self.postings_weights = [np.empty(capacity, dtype=np.float32) for word_id in range(num_words)]
+        self.postings_sizes = np.zeros(num_words, dtype=int)
+        self.num_images = 0
+    
+    def __len__(self):
+        return self.num_images
+    
+    def add(self, bow_vector):
+        """Add the image with bag-of-words vector "bow_vector", returns its idx."""
+        image_idx = self.num_images
+        for word_id, weight in zip(*bow_vector):
+            size = self.postings_sizes[word_id]
+            if size == len(self.postings_images[word_id]):
+                for postings in (self.postings_images, self.postings_weights):
+                    grown = np.empty(2 * size, dtype=postings[word_id].dtype)
+                    grown[:size] = postings[word_id]
+                    postings[word_id] = grown
+            self.postings_images[word_id][size] = image_idx
+            self.postings_weights[word_id][size] = weight
+            self.postings_sizes[word_id] = size + 1
+        self.num_images += 1
+        return image_idx
+    
+    def query(self, bow_vector, max_results=5, max_image_idx=None, min_score=0.):
+        """
+        Find the images most similar to the image with bag-of-words vector "bow_vector",
+        only considering images with an idx lower than "max_image_idx" if given (e.g. to exclude the recent ones).
+        The L1 score is in [0, 1]: sum over the common words of (|v_w| + |q_w| - |v_w - q_w|) / 2.
+        
+        Returns a list of at most "max_results" (image_idx, score) tuples, with a score of at least "min_score", best first.
+        """
+        word_ids, query_weights = bow_vector
+        sizes = self.postings_sizes[word_ids]
+        if not sizes.sum():
+            return []
+        image_idxs = np.concatenate([self.postings_images[w][:n] for w, n in zip(word_ids, sizes)])
+        weights = np.concatenate([self.postings_weights[w][:n] for w, n in zip(word_ids, sizes)])
+        query_weights = np.repeat(query_weights, sizes)
+        
+        if max_image_idx is not None:
+            keep = (image_idxs < max_image_idx)
+            image_idxs, weights, query_weights = image_idxs[keep], weights[keep], query_weights[keep]
+        scores = np.bincount(image_idxs, (weights + query_weights - abs(weights - query_weights)) / 2, minlength=self.num_images)
+        
+        best = np.argsort(-scores, kind="mergesort")[:max_results]    # stable: earlier images win ties
+        return [(i, scores[i]) for i in best if scores[i] >= min_score and scores[i] > 0]
+
+
+
+""" Geometric verification """
+
+
+def _normalizing_transform(points):
+    """Return the 3x3 (Hartley) transformation that moves "points" to their centroid and scales them to a mean distance of sqrt(2)."""
+    centroid = points.mean(axis=0)
+    scale = np.sqrt(2) / max(np.sqrt(((points - centroid)**2).sum(axis=1)).mean(), 1e-12)
+    return np.array([[scale, 0, -scale * centroid[0]],
+                     [0, scale, -scale * centroid[1]],
+                     [0,     0,                    1]])
+
+
+def _eight_point(points1, points2):
+    """
+    Batched (normalized) 8-point algorithm, "points1" and "points2" are (H, M, 2) arrays of M >= 8 matches each.
+    Returns the (H, 3, 3) rank-2 fundamental matrices.
+    """
+    x1, y1 = points1[..., 0], points1[..., 1]
+    x2, y2 = points2[..., 0], points2[..., 1]
+    A = np.stack((x2 * x1, x2 * y1, x2, y2 * x1, y2 * y1, y2, x1, y1, np.ones_like(x1)), axis=-1)
+    F = np.linalg.svd(A)[2][:, -1, :].reshape(-1, 3, 3)
+    
+    # Enforce rank 2
+    U, S, Vt = np.linalg.svd(F)
+    S[:, 2] = 0
+    return np.einsum("hij,hj,hjk->hik", U, S, Vt)
+
+
+def sampson_distances(F, points1, points2):
+    """
+    Return the (H, N) first-order geometric (Sampson) errors, in squared pixels,
+    of the N matches ("points1", "points2") w.r.t. each of the (H, 3, 3) fundamental matrices "F".
+    """
+    x1 = np.concatenate((points1, np.ones((len(points1), 1))), axis=1)
+    x2 = np.concatenate((points2, np.ones((len(points2), 1))), axis=1)
+    Fx1 = np.einsum("hij,nj->hni", F, x1)
+    Ftx2 = np.einsum("hji,nj->hni", F, x2)
+    numerators = np.einsum("nj,hnj->hn", x2, Fx1)**2
+    denominators = Fx1[..., 0]**2 + Fx1[..., 1]**2 + Ftx2[..., 0]**2 + Ftx2[..., 1]**2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        distances = numerators / denominators
+    return np.where(np.isfinite(distances), distances, np.inf)
+
+
+def fundamental_matrix_ransac(points1, points2, threshold=1., num_hypotheses=256, seed=0):
+    """
+    Robustly estimate the fundamental matrix F of the matches ("points1", "points2"), with x2.T * F * x1 = 0,
+    evaluating all "num_hypotheses" RANSAC hypotheses at once:
+    minimal 8-point samples are solved with the batched 8-point algorithm,
+    and scored by the amount of matches with a Sampson error below "threshold" pixels.
+    The best hypothesis is refined on all its inliers.
+    
+    Returns F and the boolean inlier mask, or (None, all-False mask) if there are less than 8 matches.
+    """
+    points1 = np.asarray(points1, dtype=float).reshape(-1, 2)
+    points2 = np.asarray(points2, dtype=float).reshape(-1, 2)
+    num_points = len(points1)
+    if num_points < 8:
+        return None, np.zeros(num_points, dtype=bool)
+    
+    # Work in normalized coordinates for numerical stability
+    T1, T2 = _normalizing_transform(points1), _normalizing_transform(points2)
+    points1_nrm = points1.dot(T1[0:2, 0:2].T) + T1[0:2, 2]
+    points2_nrm = points2.dot(T2[0:2, 0:2].T) + T2[0:2, 2]
+    def denormalize(F):
+        return np.einsum("ji,hjk,kl->hil", T2, F, T1)    # T2.T * F * T1
+    
+    # Random minimal samples (8 distinct matches each), and score all hypotheses at once
+    rng = np.random.RandomState(seed)
+    samples = np.argpartition(rng.rand(num_hypotheses, num_points), 7, axis=1)[:, 0:8]
+    F = denormalize(_eight_point(points1_nrm[samples], points2_nrm[samples]))
+    num_inliers = (sampson_distances(F, points1, points2) <= threshold**2).sum(axis=1)
+    best = num_inliers.argmax()
+    inliers = (sampson_distances(F[best:best+1], points1, points2)[0] <= threshold**2)
+    
+    # Refine on all inliers
+    if np.count_nonzero(inliers) >= 8:
+        F_refined = denormalize(_eight_point(points1_nrm[None, inliers], points2_nrm[None, inliers]))
+        inliers_refined = (sampson_distances(F_refined, points1, points2)[0] <= threshold**2)
+        if np.count_nonzero(inliers_refined) >= np.count_nonzero(inliers):
+            return F_refined[0], inliers_refined
+    return F[best], inliers
+
+
+
+""" Loop detection """
+
+
+class LoopDetector:
+    """
+    Finds earlier keyframes that show the same place as a new keyframe (loop-closure candidates):
+    keyframes are retrieved by their bag-of-binary-words vector from an inverted index,
+    and verified geometrically by matching their descriptors and fitting a fundamental matrix.
+    """
+    
+    def __init__(self, vocabulary, exclude_recent=20, min_score=0.05, max_candidates=3, min_inliers=30, max_epipolar_error=2.):
+        """
+        "exclude_recent" : amount of most recent keyframes that are not considered, they trivially look similar
+        "min_score" : min L1 score of a candidate keyframe
+        "max_candidates" : max amount of candidate keyframes that are verified geometrically
+        "min_inliers" : min amount of fundamental matrix inliers of a verified candidate
+        "max_epipolar_error" : max Sampson error (in pixels) of an inlier
+        """
+        self.vocabulary = vocabulary
+        self.database = BowDatabase(vocabulary.num_words)
+        self.exclude_recent = exclude_recent
+        self.min_score = min_score
+        self.max_candidates = max_candidates
+        self.min_inliers = min_inliers
+        self.max_epipolar_error = max_epipolar_error
+        self.keyframes = []    # (frame_idx, imgp, descriptors) of each keyframe
+    
+    def add_keyframe(self, frame_idx, imgp, descriptors, bow_vector=None):
+        """Add keyframe "frame_idx" with features at 2D points "imgp", and their binary descriptors "descriptors"."""
+        if bow_vector is None:
+            bow_vector = self.vocabulary.bow_vector(descriptors)
+        self.database.add(bow_vector)
+        self.keyframes.append((frame_idx, imgp, descriptors))
+    
+    def detect(self, imgp, descriptors):
+        """
+        Find the earlier keyframes that show the same place as the image with features "imgp" and "descriptors".
+        Returns the bag-of-words vector of the image (to reuse in "add_keyframe()"),
+        and a list of (frame_idx, score, F, num_inliers) tuples of the verified keyframes, best score first.
+        """
+        bow_vector = self.vocabulary.bow_vector(descriptors)
+        max_image_idx = len(self.database) - self.exclude_recent
+        if max_image_idx <= 0:
+            return bow_vector, []
+        
+        loops = []
+        for image_idx, score in self.database.query(bow_vector, self.max_candidates, max_image_idx, self.min_score):
+            frame_idx, imgp_candidate, descriptors_candidate = self.keyframes[image_idx]
+            idxs, idxs_candidate = match_descriptors(descriptors, descriptors_candidate)
+            if len(idxs) < self.min_inliers:
+                continue
+            F, inliers = fundamental_matrix_ransac(imgp_candidate[idxs_candidate], imgp[idxs], self.max_epipolar_error)
+            num_inliers = np.count_nonzero(inliers)
+            if num_inliers >= self.min_inliers:
+                loops.append((frame_idx, score, F, num_inliers))
+        return bow_vector, loops
@@ -0,0 +1,282 @@
+import numpy as np
+
+import transforms as trfm
+
+
+
+""" Similarity transformations (Sim3) """
+
+
+def _sim3_parts(sims):
+    """Return the rotation matrices, translations and scales of the (N, 7) Sim3 transformations "sims"."""
+    return trfm.R_from_rvecs(sims[:, 0:3]), sims[:, 3:6], np.exp(sims[:, 6])
+
+
+def _sim3_from_parts(R, t, s):
+    """Return the (N, 7) Sim3 transformations of rotation matrices "R", translations "t" and scales "s"."""
+    return np.concatenate((trfm.rvecs_from_R(R), t, np.log(s)[:, None]), axis=1)
+
+
+def sim3_from_poses(rvecs, tvecs):
+    """
+    Return the (N, 7) Sim3 representations of the camera poses ("rvecs", "tvecs"), with unit scale.
+    
+    A Sim3 transformation is represented as a row (rvec, tvec, log(scale)),
+    and transforms a point x to: scale * R(rvec) * x + tvec.
+    """
+    rvecs, tvecs = np.asarray(rvecs, dtype=float).reshape(-1, 3), np.asarray(tvecs, dtype=float).reshape(-1, 3)
+    return np.concatenate((rvecs, tvecs, np.zeros((len(rvecs), 1))), axis=1)
+
+
+def poses_from_sim3(sims):
+    """
+    Return the camera poses ("rvecs", "tvecs") of the (N, 7) Sim3 transformations "sims" from world to camera:
+    the same camera orientations and centers, but without the scale factor.
+    """
+    return sims[:, 0:3], sims[:, 3:6] / np.exp(sims[:, 6:7])
+
+
+def _sim3_compose_parts(parts2, parts1):
+    """Return the parts (see "_sim3_parts()") of the Sim3 transformations "parts2" * "parts1", given as parts."""
+    (R2, t2, s2), (R1, t1, s1) = parts2, parts1
+    return np.matmul(R2, R1), s2[..., None] * np.matmul(R2, t1[..., None])[..., 0] + t2, s2 * s1
+
+
+def _sim3_inverse_parts(parts):
+    """Return the parts (see "_sim3_parts()") of the inverses of the Sim3 transformations "parts", given as parts."""
+    R, t, s = parts
+    R_inv = np.swapaxes(R, -1, -2)
+    return R_inv, -np.matmul(R_inv, t[..., None])[..., 0] / s[..., None], 1. / s
+
+
+def sim3_compose(sims2, sims1):
+    """Return the (N, 7) Sim3 transformations "sims2" * "sims1" (first "sims1", then "sims2")."""
+    return _sim3_from_parts(*_sim3_compose_parts(_sim3_parts(sims2), _sim3_parts(sims1)))
+
+
+def sim3_inverse(sims):
+    """Return the inverses of the (N, 7) Sim3 transformations "sims"."""
+    return _sim3_from_parts(*_sim3_inverse_parts(_sim3_parts(sims)))
+
+
+def sim3_transform_points(sims, points):
+    """Return the (N, 3) "points", each transformed by the corresponding Sim3 transformation of "sims"."""
+    R, t, s = _sim3_parts(sims)
+    return s[:, None] * np.matmul(R, points[:, :, None])[:, :, 0] + t
+
+
+
+""" Similarity transformation from 3D-3D correspondences """
+
+
+def _umeyama(points1, points2):
+    """
+    Return the (H, 7) least-squares Sim3 transformations that map the (H, M, 3) "points1" to "points2",
+    batched over H sets of M points (Umeyama's method).
+    """
+    mean1, mean2 = points1.mean(axis=1), points2.mean(axis=1)
+    centered1, centered2 = points1 - mean1[:, None], points2 - mean2[:, None]
+    covariances = np.matmul(centered2.transpose(0, 2, 1), centered1) / points1.shape[1]
+    U, D, Vt = np.linalg.svd(covariances)
+    signs = np.ones((len(points1), 3))
+    signs[:, 2] = np.sign(np.linalg.det(U) * np.linalg.det(Vt))    # avoid reflections
+    R = np.matmul(U * signs[:, None, :], Vt)
+    variances1 = (centered1**2).sum(axis=2).mean(axis=1)
+    s = (D * signs).sum(axis=1) / np.maximum(variances1, 1e-300)
+    t = mean2 - s[:, None] * np.matmul(R, mean1[:, :, None])[:, :, 0]
+    return _sim3_from_parts(R, t, np.maximum(s, 1e-300))
+
+
+def _projection_errors(points, points_observed):
+    """Return the distances between the projections (on the z = 1 plane) of "points" and "points_observed"."""
+    depths = np.maximum(points[..., 2:3], 1e-12)
+    return np.sqrt(((points[..., 0:2] / depths - points_observed[..., 0:2] / points_observed[..., 2:3])**2).sum(axis=-1))
+
+
+def sim3_ransac(points1, points2, threshold=1e-2, num_hypotheses=256, seed=0):
+    """
+    Robustly estimate the Sim3 transformation that maps the (N, 3) "points1" to the corresponding "points2",
+    both in camera coordinates (of a different camera each), e.g. the map points observed in two keyframes.
+    
+    Hypotheses are fitted on random triplets of correspondences, all at once.
+    A correspondence is an inlier if each point projects at most "threshold" (in normalized image coordinates)
+    from where the other point projects after transforming it to its camera, in both directions;
+    the best hypothesis is refined on its inliers.
+    Returns the (7, ) Sim3 transformation and the boolean inlier mask, or (None, all False) if N < 3.
+    """
+    points1, points2 = np.asarray(points1, dtype=float), np.asarray(points2, dtype=float)
+    num_points = len(points1)
+    if num_points < 3:
+        return None, np.zeros(num_points, dtype=bool)
+    rng = np.random.RandomState(seed)
+    samples = np.argsort(rng.rand(num_hypotheses, num_points), axis=1)[:, 0:3]
+    
+    def inliers_of(sims):
+        """Return the (H, N) inlier masks of the (H, 7) hypotheses "sims"."""
+        sims_inv = sim3_inverse(sims)
+        errors = []
+        with np.errstate(over="ignore", invalid="ignore"):    # hypotheses of degenerate triplets can have a huge scale
+            for sims_, points_from, points_to in ((sims, points1, points2), (sims_inv, points2, points1)):
+                R, t, s = _sim3_parts(sims_)
+                transformed = s[:, None, None] * np.matmul(points_from, R.transpose(0, 2, 1)) + t[:, None, :]
+                errors.append(_projection_errors(transformed, points_to[None]))
+            return np.logical_and(errors[0] <= threshold, errors[1] <= threshold)
+    
+    hypotheses = _umeyama(points1[samples], points2[samples])
+    inliers = inliers_of(hypotheses)
+    best = np.argmax(inliers.sum(axis=1))
+    sim3, inliers = hypotheses[best], inliers[best]
+    
+    # Refine on the inliers, keep the refinement if it doesn't lose inliers
+    if np.count_nonzero(inliers) >= 3:
+        refined = _umeyama(points1[inliers][None], points2[inliers][None])
+        refined_inliers = inliers_of(refined)[0]
+        if np.count_nonzero(refined_inliers) >= np.count_nonzero(inliers):
+            sim3, inliers = refined[0], refined_inliers
+    return sim3, inliers
+
+
+
+""" Pose-graph optimization """
+
+
+def _index_parts(parts, idxs):
+    """Return the parts (see "_sim3_parts()") of the Sim3 transformations "parts" at indices "idxs"."""
+    return tuple(part[idxs] for part in parts)
+
+
+def _so3_right_jacobians_inv(rvecs):
+    """
+    Return the (N, 3, 3) inverse right Jacobians of SO(3) at the (N, 3) axis-angle rotations "rvecs":
+    the rotation R(rvec) * R(w) has axis-angle representation rvec + J_r^-1 * w, for a small rotation w.
+    """
+    angles = np.sqrt((rvecs**2).sum(axis=1))
+    
+    # Use the Taylor expansion of the coefficient near zero, to avoid illegal expressions
+    small = (angles < 1e-4)
+    angles_safe = np.where(small, 1., angles)
+    c = np.where(small, 1. / 12 + angles**2 / 720,
+                 1. / angles_safe**2 - (1. + np.cos(angles_safe)) / (2 * angles_safe * np.sin(angles_safe)))
+    
+    K = trfm.skew_matrices(rvecs)
+    return np.eye(3) + 0.5 * K + c[:, None, None] * np.matmul(K, K)
+
+
+def _edge_jacobians(A, poses_from_inv, residuals):
+    """
+    Return the (E, 7, 7) Jacobians of the edge residuals w.r.t. a Sim3 update (right-multiplied) of their pose S_to,
+    in closed form, batched over all edges.
+    
+    "A" : parts (see "_sim3_parts()") of M^-1 * S_to of the edges
+    "poses_from_inv" : parts of S_from^-1 of the edges
+    "residuals" : (E, 7) Sim3 errors M^-1 * S_to * S_from^-1 of the edges
+    
+    Updating S_to to S_to * D changes the Sim3 error M^-1 * S_to * S_from^-1 of an edge to A * D * S_from^-1,
+    and updating S_from to S_from * D changes it to A * D^-1 * S_from^-1,
+    so the Jacobian w.r.t. S_from is minus the one w.r.t. S_to, and the update D is shared by all edges.
+    With D = (R(w), v, exp(sigma)) and S_from^-1 = (R_b, t_b, s_b), the error A * D * S_from^-1 has
+    rotation R_a * R(w) * R_b = R_err * R(R_b^T * w), translation s_a * R_a * (exp(sigma) * R(w) * t_b + v) + t_a,
+    and log-scale log(s_a) + sigma + log(s_b).
+    """
+    (R_a, _, s_a), (R_b, t_b, _) = A, poses_from_inv
+    sR_a = s_a[:, None, None] * R_a
+    J = np.zeros((len(R_a), 7, 7))
+    J[:, 0:3, 0:3] = np.matmul(_so3_right_jacobians_inv(residuals[:, 0:3]), np.swapaxes(R_b, 1, 2))
+    J[:, 3:6, 0:3] = -np.matmul(sR_a, trfm.skew_matrices(t_b))
+    J[:, 3:6, 3:6] = sR_a
+    J[:, 3:6, 6] = np.matmul(sR_a, t_b[:, :, None])[:, :, 0]
+    J[:, 6, 6] = 1.
+    return J
+
+
+def optimize_pose_graph(poses, edges_from, edges_to, measurements, information=None,
+                        num_fixed_poses=1, max_iterations=20, tolerance=1.e-6):
+    """
+    Optimize the (N, 7) Sim3 poses "poses" (see "sim3_from_poses()") of the nodes of a pose graph,
+    such that the relative transformations S_to * S_from^-1 of the edges ("edges_from" -> "edges_to")
+    agree with their (E, 7) Sim3 measurements "measurements",
+    e.g. the relative poses between consecutive keyframes (odometry) and loop closures.
+    Since the poses include a scale, also the scale drift of monocular odometry gets corrected.
+    
+    "information" : optional (E, 7) weights of the residual components of each edge, ones by default
+    "num_fixed_poses" : amount of first poses that are held fixed, to fix the gauge freedom
+    
+    The poses are updated in world coordinates (S * D), such that moving a part of the graph rigidly
+    is the same update for all its poses; in camera coordinates (D * S) the long chains of a keyframe graph
+    make the problem far more non-linear.
+    Each Levenberg-Marquardt iteration solves the (block) sparse normal equations with a sparse direct solver,
+    using a fill-reducing ordering for symmetric matrices and no pivoting (the damped normal matrix is positive definite):
+    in a graph of keyframes (a chain with a few loops) the cost grows about linearly with the amount of poses.
+    The optimization stops early if the cost decreases by less than a fraction "tolerance".
+    
+    Returns the optimized poses, and the RMS residual before and after the optimization.
+    """
+    from scipy import sparse
+    from scipy.sparse.linalg import splu
+    poses = np.array(poses, dtype=float).reshape(-1, 7)
+    edges_from, edges_to = np.asarray(edges_from, dtype=int), np.asarray(edges_to, dtype=int)
+    measurements_inv = _sim3_inverse_parts(_sim3_parts(np.asarray(measurements, dtype=float).reshape(-1, 7)))
+    information = np.ones((len(edges_from), 7)) if information is None else np.asarray(information, dtype=float)
+    num_poses = len(poses)
+    if not (0 <= num_fixed_poses <= num_poses):
+        raise ValueError("Can't hold %s poses fixed, only %s poses are given" % (num_fixed_poses, num_poses))
+    
+    def evaluate(poses):
+        """Return the arguments of "_edge_jacobians()", the residuals of the edges, and the cost."""
+        parts = _sim3_parts(poses)
+        A = _sim3_compose_parts(measurements_inv, _index_parts(parts, edges_to))
+        poses_from_inv = _sim3_inverse_parts(_index_parts(parts, edges_from))
+        residuals = _sim3_from_parts(*_sim3_compose_parts(A, poses_from_inv))
+        return (A, poses_from_inv, residuals), residuals, (information * residuals**2).sum()
+    
+    # The sparsity pattern of the normal equations doesn't change: the blocks of both poses of each edge, summed per pose pair
+    block_rows = np.concatenate((edges_from, edges_to, edges_from, edges_to))
+    block_cols = np.concatenate((edges_from, edges_to, edges_to, edges_from))
+    blocks_pattern, blocks_slots = np.unique(block_rows * num_poses + block_cols, return_inverse=True)
+    blocks_elements = (blocks_slots.reshape(-1)[:, None] * 49 + np.arange(49)).ravel()
+    blocks_offsets = np.concatenate(([0], np.cumsum(np.bincount(blocks_pattern // num_poses, minlength=num_poses))))
+    
+    linearization, residuals, cost = evaluate(poses)
+    rms_before = np.sqrt((residuals**2).sum(axis=1).mean())
+    free = 7 * num_fixed_poses
+    damping = 1.e-4
+    for iteration in range(max_iterations):
+        if free == 7 * num_poses:
+            break
+        J = _edge_jacobians(*linearization)
+        J_weighted_T = (information[:, :, None] * J).transpose(0, 2, 1)
+        
+        # Weighted normal equations, the Jacobians w.r.t. both poses of an edge only differ in sign
+        JTJ = np.matmul(J_weighted_T, J)
+        blocks = np.bincount(blocks_elements, np.concatenate((JTJ, JTJ, -JTJ, -JTJ)).ravel(),
+                             minlength=49 * len(blocks_pattern)).reshape(-1, 7, 7)
+        H = sparse.bsr_matrix((blocks, blocks_pattern % num_poses, blocks_offsets),
+                              shape=(7 * num_poses, 7 * num_poses)).tocsc()[free:, free:]
+        JTr = np.matmul(J_weighted_T, residuals[:, :, None])[:, :, 0]
+        edge_elements = lambda edges: (edges[:, None] * 7 + np.arange(7)).ravel()
+        g = np.bincount(edge_elements(edges_to), JTr.ravel(), minlength=7 * num_poses) - \
+            np.bincount(edge_elements(edges_from), JTr.ravel(), minlength=7 * num_poses)
+        g = g[free:]
+        
+        # Increase the damping until the cost decreases
+        diag_H = sparse.diags(H.diagonal() + 1.e-12)
+        while damping < 1.e8:
+            delta = np.zeros((num_poses, 7))
+            delta.ravel()[free:] = splu(sparse.csc_matrix(H + damping * diag_H), permc_spec="MMD_AT_PLUS_A",
+                                        diag_pivot_thresh=0.).solve(-g)
+            poses_new = sim3_compose(poses, delta)
+            linearization_new, residuals_new, cost_new = evaluate(poses_new)
+            if cost_new <= cost:
+                break
+            damping *= 10
+        else:
+            break    # no further decrease possible, we're at a minimum
+        
+        converged = (cost - cost_new <= tolerance * cost)
+        poses, linearization, residuals, cost = poses_new, linearization_new, residuals_new, cost_new
+        damping /= 10    # no lower bound: the slowest modes of a long loop need a (nearly) undamped step
+        if converged:
+            break
+    
+    rms_after = np.sqrt((residuals**2).sum(axis=1).mean())
+    return poses, rms_before, rms_after
@@ -0,0 +1,126 @@
+import numpy as np
+
+import transforms as trfm
+
+
+
+""" Robust kernels """
+
+
+def huber_weights(residuals, threshold):
+    """
+    Return the IRLS weights of the Huber kernel, for the residual norms "residuals":
+    1 for residuals up to "threshold", decreasing as threshold / residual beyond.
+    """
+    return threshold / np.maximum(residuals, threshold)
+
+def huber_cost(residuals, threshold):
+    """Return the Huber cost of each of the residual norms "residuals"."""
+    return np.where(residuals <= threshold,
+                    residuals**2 / 2, threshold * (residuals - threshold / 2))
+
+def cauchy_weights(residuals, threshold):
+    """Return the IRLS weights of the Cauchy kernel, with scale "threshold", for the residual norms "residuals"."""
+    return 1. / (1. + (residuals / threshold)**2)
+
+def cauchy_cost(residuals, threshold):
+    """Return the Cauchy cost of each of the residual norms "residuals"."""
+    return threshold**2 / 2 * np.log1p((residuals / threshold)**2)
+
+robust_kernels = {
+    "huber"  : (huber_weights, huber_cost),
+    "cauchy" : (cauchy_weights, cauchy_cost) }
+
+
+
+""" Pose optimization """
+
+
+def _project(objp, R, t, imgpnrm):
+    """
+    Return the 3D points "objp" in camera coordinates, the reprojection residual vectors w.r.t. "imgpnrm",
+    and the mask of points in front of the camera.
+    """
+    objp_cam = objp.dot(R.T) + t
+    in_front = (objp_cam[:, 2] > 0)
+    depths = np.where(in_front, objp_cam[:, 2], 1.)    # avoid division by zero, these points are masked out anyway
+    return objp_cam, objp_cam[:, 0:2] / depths[:, None] - imgpnrm, in_front
+
+
+def optimize_pose(objp, imgpnrm, rvec, tvec,
+                  kernel="huber", threshold=1.e-3, max_iterations=10, tolerance=1.e-8, cost_tolerance=1.e-6):
+    """
+    Robust Levenberg-Marquardt optimization of the camera pose ("rvec", "tvec"),
+    starting from the given pose, minimizing the reprojection error of 3D points "objp" on the image-points "imgpnrm".
+    
+    "imgpnrm" should be undistorted and normalized (see OpenCV's "undistortPoints()"),
+    "threshold" is the scale of the robust kernel "kernel" ("huber" or "cauchy"), in normalized image coordinates.
+    Each iteration re-weights all points at once (IRLS), and solves the 6x6 damped normal equations;
+    the optimization stops early if the update of the pose is smaller than "tolerance",
+    or if it decreases the cost by less than a fraction "cost_tolerance"
+    (IRLS with a redescending kernel, such as "cauchy", only converges linearly, its updates shrink slowly).
+    Points behind the camera get a zero weight and a fixed penalty cost.
+    
+    Returns the optimized "rvec" and "tvec",
+    the reprojection error of each point (Inf if behind the camera), its robust weight in [0, 1],
+    and whether the optimization converged; all evaluated at the returned pose.
+    """
+    if kernel not in robust_kernels:
+        raise ValueError("Unknown robust kernel '%s', choose from: %s" % (kernel, sorted(robust_kernels)))
+    kernel_weights, kernel_cost = robust_kernels[kernel]
+    behind_cost = kernel_cost(np.array([1.e3 * threshold]), threshold)[0]    # penalty of a point behind the camera
+    
+    objp = np.asarray(objp, dtype=float).reshape(-1, 3)
+    imgpnrm = np.asarray(imgpnrm, dtype=float).reshape(-1, 2)
+    R = trfm.R_from_rvecs(rvec)[0]
+    t = np.asarray(tvec, dtype=float).reshape(3)
+    
+    def evaluate(R, t):
+        objp_cam, errors, in_front = _project(objp, R, t, imgpnrm)
+        residuals = np.where(in_front, np.sqrt((errors**2).sum(axis=1)), np.inf)
+        cost = kernel_cost(residuals[in_front], threshold).sum() + behind_cost * (len(objp) - np.count_nonzero(in_front))
+        return objp_cam, errors, in_front, residuals, cost
+    
+    objp_cam, errors, in_front, residuals, cost = evaluate(R, t)
+    damping = 1.e-3
+    converged = False
+    for iteration in range(max_iterations):
+        weights = np.where(in_front, kernel_weights(residuals, threshold), 0.)
+        
+        # Jacobian of the residuals w.r.t. a left-multiplied pose update (omega, upsilon):
+        # objp_cam' = exp(omega) * objp_cam + upsilon
+        inv_depths = 1. / np.where(in_front, objp_cam[:, 2], 1.)
+        J_proj = np.zeros((len(objp), 2, 3))    # d(x/z, y/z) / d(objp_cam)
+        J_proj[:, 0, 0] = J_proj[:, 1, 1] = inv_depths
+        J_proj[:, :, 2] = -objp_cam[:, 0:2] * inv_depths[:, None]**2
+        J = np.empty((len(objp), 2, 6))
+        J[:, :, 0:3] = -np.einsum("nij,njk->nik", J_proj, trfm.skew_matrices(objp_cam))
+        J[:, :, 3:6] = J_proj
+        
+        # Weighted normal equations
+        H = np.einsum("n,nri,nrj->ij", weights, J, J)
+        g = np.einsum("n,nri,nr->i", weights, J, errors)
+        
+        # Increase the damping until the cost decreases
+        while damping < 1.e8:
+            delta = -np.linalg.solve(H + damping * np.diag(np.diag(H) + 1.e-12), g)
+            R_delta = trfm.R_from_rvecs(delta[0:3])[0]
+            R_new, t_new = R_delta.dot(R), R_delta.dot(t) + delta[3:6]
+            evaluation = evaluate(R_new, t_new)
+            if evaluation[-1] <= cost:
+                break
+            damping *= 10
+        else:
+            converged = True    # no further decrease possible, we're at a minimum
+            break
+        
+        cost_decrease = cost - evaluation[-1]
+        R, t = R_new, t_new
+        objp_cam, errors, in_front, residuals, cost = evaluation
+        damping = max(damping / 10, 1.e-7)
+        if np.sqrt((delta**2).sum()) < tolerance or cost_decrease <= cost_tolerance * cost:
+            converged = True
+            break
+    
+    weights = np.where(in_front, kernel_weights(residuals, threshold), 0.)
+    return trfm.rvecs_from_R(R).reshape(3, 1), t.reshape(3, 1), residuals, weights, converged
@@ -0,0 +1,263 @@
+import numpy as np
+import cv2
+
+from pose_optimization import optimize_pose
+
+
+
+""" Binary descriptor helpers """
+
+
+_popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def hamming_distances(descr1, descr2):
+    """
+    Return the Hamming distances between the corresponding rows of the binary descriptors "descr1" and "descr2",
+    both (N, num_bytes) uint8 arrays.
+    """
+    return _popcount_table[np.bitwise_xor(descr1, descr2)].sum(axis=-1, dtype=int)
+
+
+def create_ORB(num_features=1000):
+    """Return an ORB feature detector and descriptor extractor, for both the OpenCV 2.4 and 3.x API."""
+    if hasattr(cv2, "ORB_create"):
+        return cv2.ORB_create(num_features)
+    return cv2.ORB(num_features)
+
+
+def compute_descriptors(extractor, img_gray, imgp, keypoint_size=31.):
+    """
+    Compute the binary descriptors of "img_gray" at the 2D points "imgp".
+    
+    Returns the descriptors, and the indices in "imgp" of the points they belong to;
+    points too close to the image border get no descriptor.
+    """
+    keypoints = [cv2.KeyPoint(float(p[0]), float(p[1]), keypoint_size, -1, 0, 0, i) for i, p in enumerate(imgp)]
+    keypoints, descriptors = extractor.compute(img_gray, keypoints)
+    if descriptors is None or not len(keypoints):
+        return np.zeros((0, 32), dtype=np.uint8), np.zeros(0, dtype=int)
+    return descriptors, np.array([kp.class_id for kp in keypoints], dtype=int)
+
+
+
+""" Locality Sensitive Hashing """
+
+
+class BinaryLSHIndex:
+    """
+    Multi-table bit-sampling LSH index of binary descriptors, each with an integer payload.
+    
+    Each table hashes a descriptor to the value of "key_bits" randomly chosen bits of it,
+    similar descriptors (small Hamming distance) end up in the same bucket in at least one of the "num_tables" tables.
+    A query only compares against the descriptors in its buckets,
+    so its cost depends on the bucket sizes, not on the total amount of indexed descriptors.
+    """
+    
+    def __init__(self, num_bytes=32, num_tables=8, key_bits=16, seed=0, capacity=1024):
+        rng = np.random.RandomState(seed)
+        self.bit_idxs = np.array([rng.choice(8 * num_bytes, key_bits, replace=False) for table in range(num_tables)])
+        self.bit_weights = (1 << np.arange(key_bits)).astype(np.int64)
+        self.tables = [{} for table in range(num_tables)]    # per table: key -> list of entry idxs
+        
+        self._descriptors = np.empty((capacity, num_bytes), dtype=np.uint8)
+        self._payloads = np.empty(capacity, dtype=int)
+        self._size = 0
+    
+    def __len__(self):
+        return self._size
+    
+    @property
+    def descriptors(self):
+        return self._descriptors[:self._size]
+    
+    @property
+    def payloads(self):
+        return self._payloads[:self._size]
+    
+    def keys(self, descriptors):
+        """Return the (N, num_tables) hash keys of the descriptors "descriptors"."""
+        bits = np.unpackbits(descriptors, axis=1)
+        return np.einsum("ntk,k->nt", bits[:, self.bit_idxs], self.bit_weights)
+    
+    def add(self, descriptors, payloads):
+        """Add the descriptors "descriptors" with corresponding integer payloads "payloads"."""
+        num_extra = len(descriptors)
+        if self._size + num_extra > len(self._descriptors):    # grow the buffers by doubling their capacity
+            capacity = max(2 * len(self._descriptors), self._size + num_extra)
+            for name in ("_descriptors", "_payloads"):
+                buffer = getattr(self, name)
+                grown = np.empty((capacity, ) + buffer.shape[1:], dtype=buffer.dtype)
+                grown[:self._size] = buffer[:self._size]
+                setattr(self, name, grown)
+        entry_idxs = np.arange(self._size, self._size + num_extra)
+        self._descriptors[entry_idxs] = descriptors
+        self._payloads[entry_idxs] = payloads
+        self._size += num_extra
+        
+        for table, keys in zip(self.tables, self.keys(descriptors).T):
+            for key, entry_idx in zip(keys.tolist(), entry_idxs.tolist()):
+                table.setdefault(key, []).append(entry_idx)
+    
+    def query(self, descriptors, max_distance=64):
+        """
+        Find the indexed descriptors that share a bucket with each of the descriptors "descriptors",
+        and are at most "max_distance" bits away from it.
+        
+        Returns the query idxs, the matching entry idxs and their Hamming distances, as 1D arrays.
+        """
+        query_idxs, entry_idxs = [], []
+        for table, keys in zip(self.tables, self.keys(descriptors).T):
+            for query_idx, key in enumerate(keys.tolist()):
+                bucket = table.get(key)
+                if bucket:
+                    entry_idxs.append(bucket)
+                    query_idxs.append([query_idx] * len(bucket))
+        if not entry_idxs:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        
+        # Remove the duplicate candidates (found in multiple tables), then compare them
+        pairs = np.unique(np.concatenate(query_idxs) * len(self) + np.concatenate(entry_idxs))
+        query_idxs, entry_idxs = pairs // len(self), pairs % len(self)
+        distances = hamming_distances(descriptors[query_idxs], self._descriptors[entry_idxs])
+        close = (distances <= max_distance)
+        return query_idxs[close], entry_idxs[close], distances[close]
+
+
+
+""" Keyframe database """
+
+
+class KeyframeRecord:
+    def __init__(self, frame_idx, rvec, tvec, objp_idxs):
+        self.frame_idx = frame_idx
+        self.rvec = rvec    # pose of the keyframe
+        self.tvec = tvec
+        self.objp_idxs = objp_idxs    # 3D points observed in the keyframe, that got a descriptor
+
+
+class KeyframeDatabase:
+    """
+    Stores a record of each keyframe, and indexes the binary descriptors of its observations of 3D map points,
+    to find the keyframes (and the 3D points) that look similar to a new frame, e.g. to relocalize after tracking loss.
+    """
+    
+    def __init__(self, extractor=None, **lsh_params):
+        """
+        "extractor" : descriptor extractor to use, ORB by default
+        "lsh_params" : passed to "BinaryLSHIndex()"
+        """
+        self.extractor = extractor or create_ORB()
+        self.keyframes = []    # "KeyframeRecord"s
+        self.index = BinaryLSHIndex(**lsh_params)    # payload is the idx of the keyframe
+    
+    def __len__(self):
+        return len(self.keyframes)
+    
+    def add_keyframe(self, frame_idx, rvec, tvec, img_gray, imgp, objp_idxs):
+        """
+        Add keyframe "frame_idx" with pose ("rvec", "tvec"),
+        in which the 3D points "objp_idxs" are observed at 2D points "imgp" of the image "img_gray".
+        """
+        descriptors, rows = compute_descriptors(self.extractor, img_gray, imgp)
+        keyframe_idx = len(self.keyframes)
+        self.keyframes.append(KeyframeRecord(frame_idx, rvec, tvec, np.asarray(objp_idxs)[rows]))
+        self.index.add(descriptors, np.repeat(keyframe_idx, len(rows)))
+    
+    def keyframe_descriptors(self, keyframe_idx):
+        """Return the descriptors of keyframe "keyframe_idx", in order of its objp_idxs."""
+        keyframe_offset = np.searchsorted(self.index.payloads, keyframe_idx)    # the entries of a keyframe are stored contiguously
+        return self.index.descriptors[keyframe_offset : keyframe_offset + len(self.keyframes[keyframe_idx].objp_idxs)]
+    
+    def remap_objp_idxs(self, new_idxs):
+        """
+        Replace each 3D point idx "i" of the keyframes by "new_idxs[i]", e.g. after the map got compacted;
+        points that got removed (a new idx of -1) keep their descriptors in the index, but are never returned by "query()".
+        """
+        for keyframe in self.keyframes:
+            keyframe.objp_idxs = np.where(keyframe.objp_idxs >= 0, new_idxs[keyframe.objp_idxs], -1)
+    
+    def query(self, descriptors, max_distance=64, max_candidates=3, min_matches=12):
+        """
+        Find the keyframes with the most descriptors similar to "descriptors".
+        
+        Returns a list of at most "max_candidates" (keyframe_idx, query_idxs, objp_idxs) tuples, best first,
+        where "query_idxs" are the rows of "descriptors" matched to 3D points "objp_idxs" of that keyframe
+        (only the closest match of each query descriptor is kept per keyframe),
+        and at least "min_matches" matches are required.
+        """
+        query_idxs, entry_idxs, distances = self.index.query(descriptors, max_distance)
+        if not len(query_idxs):
+            return []
+        keyframe_idxs = self.index.payloads[entry_idxs]
+        
+        # Keep only the closest match per (query descriptor, keyframe) pair
+        order = np.lexsort((distances, query_idxs, keyframe_idxs))
+        query_idxs, entry_idxs, keyframe_idxs = query_idxs[order], entry_idxs[order], keyframe_idxs[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = np.logical_or(keyframe_idxs[1:] != keyframe_idxs[:-1], query_idxs[1:] != query_idxs[:-1])
+        query_idxs, entry_idxs, keyframe_idxs = query_idxs[first], entry_idxs[first], keyframe_idxs[first]
+        
+        # Vote for keyframes, only the ones that got matches are considered
+        voted_keyframe_idxs, votes = np.unique(keyframe_idxs, return_counts=True)
+        order = np.argsort(-votes, kind="mergesort")[:max_candidates]
+        candidates = voted_keyframe_idxs[order][votes[order] >= min_matches]
+        
+        results = []
+        for k in candidates:
+            rows = (keyframe_idxs == k)
+            keyframe_offset = np.searchsorted(self.index.payloads, k)    # the entries of a keyframe are stored contiguously, in order of its objp_idxs
+            objp_idxs = self.keyframes[k].objp_idxs[entry_idxs[rows] - keyframe_offset]
+            valid = (objp_idxs >= 0)    # skip removed points
+            if np.count_nonzero(valid) >= min_matches:
+                results.append((k, query_idxs[rows][valid], objp_idxs[valid]))
+        return results
+
+
+
+""" Relocalization """
+
+
+def relocalize(keyframe_db, objp, img_gray, cameraMatrix, distCoeffs,
+               max_reproj_error=2., min_inliers=20, max_distance=64, max_candidates=3):
+    """
+    Try to recover the pose of the image "img_gray" after tracking got lost,
+    by matching its ORB features against the candidate keyframes of "keyframe_db",
+    and estimating the pose w.r.t. their 3D points (of which the coordinates are given by "objp") with PnP.
+    
+    Returns None if no candidate keyframe gives at least "min_inliers" inliers (at most "max_reproj_error" pixels off),
+    otherwise returns ("rvec", "tvec", "imgp", "objp_idxs") of the best candidate:
+    the recovered pose, and the inlier 2D features with the 3D points they observe, to restart tracking with.
+    """
+    if not len(keyframe_db):
+        return None
+    keypoints, descriptors = keyframe_db.extractor.detectAndCompute(img_gray, None)
+    if descriptors is None or not len(keypoints):
+        return None
+    imgp = np.array([kp.pt for kp in keypoints], dtype=np.float32)
+    imgpnrm = cv2.undistortPoints(np.array([imgp]), cameraMatrix, distCoeffs)[0]
+    focal_length = abs(cameraMatrix[0, 0])
+    
+    best = None
+    for keyframe_idx, query_idxs, objp_idxs in keyframe_db.query(descriptors, max_distance, max_candidates, min_inliers):
+        # Unique 2D features only, since ORB can detect multiple keypoints (on different scales) at the same location
+        query_idxs, first = np.unique(query_idxs, return_index=True)
+        objp_idxs = objp_idxs[first]
+        if len(query_idxs) < min_inliers:
+            continue
+        objp_matched = np.asarray(objp[objp_idxs], dtype=np.float32)
+        rvec, tvec, inliers = cv2.solvePnPRansac(
+                objp_matched, imgp[query_idxs], cameraMatrix, distCoeffs, reprojectionError=max_reproj_error )
+        if inliers is None or len(inliers) < min_inliers:
+            continue
+        
+        # Refine the pose on all matches, then recount the inliers
+        rvec, tvec, residuals, weights, converged = optimize_pose(
+                objp_matched, imgpnrm[query_idxs], rvec, tvec, threshold=max_reproj_error / focal_length )
+        inliers = np.where(residuals * focal_length <= max_reproj_error)[0]
+        print ("Relocalization candidate: keyframe", keyframe_db.keyframes[keyframe_idx].frame_idx,
+               "with", len(inliers), "/", len(query_idxs), "inliers")
+        if len(inliers) >= min_inliers and (best is None or len(inliers) > len(best[2])):
+            inliers = inliers[np.unique(objp_idxs[inliers], return_index=True)[1]]    # each 3D point only once
+            best = (rvec, tvec, imgp[query_idxs[inliers]], objp_idxs[inliers])
+    
+    return best
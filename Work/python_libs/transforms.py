@@ -119,6 +119,33 @@ def rvec_from_quat(qwt):
     return rvec * angle
 
 
+def quats_from_rvecs(rvecs):
+    """
+    Vectorized version of "quat_from_rvec()":
+    return the (N, 4) quaternions (qx, qy, qz, qw) of the (N, 3) axis-angle represented 'rvecs'.
+    """
+    rvecs = np.asarray(rvecs, dtype=float).reshape(-1, 3)
+    angles = np.sqrt((rvecs**2).sum(axis=1))
+    small = (angles < 1e-6)
+    factors = np.where(small, 0.5 - angles**2 / 48, np.sin(angles / 2) / np.where(small, 1., angles))    # sin(x/2) / x
+    return np.concatenate((rvecs * factors[:, None], np.cos(angles / 2)[:, None]), axis=1)
+
+
+def rvecs_from_quats(quats):
+    """
+    Vectorized version of "rvec_from_quat()":
+    return the (N, 3) axis-angle representations of the (N, 4) quaternions (qx, qy, qz, qw) 'quats'.
+    """
+    quats = np.asarray(quats, dtype=float).reshape(-1, 4)
+    quats = quats / np.sqrt((quats**2).sum(axis=1))[:, None]
+    quats = quats * np.where(quats[:, 3] < 0, -1., 1.)[:, None]    # same rotation, with an angle <= pi
+    sin_half_angles = np.sqrt((quats[:, 0:3]**2).sum(axis=1))
+    angles = 2 * np.arctan2(sin_half_angles, quats[:, 3])
+    small = (sin_half_angles < 1e-6)
+    factors = np.where(small, 2., angles / np.where(small, 1., sin_half_angles))
+    return quats[:, 0:3] * factors[:, None]
+
+
 def axis_and_angle_from_rvec(rvec):
     """
     Return the axis vector and angle of the axis-angle represented 'rvec'.
@@ -150,6 +177,64 @@ def delta_rvec(r2, r1):
             quat_from_rvec(r1) ))
 
 
+def R_from_rvecs(rvecs):
+    """
+    Vectorized version of "cv2.Rodrigues()" for axis-angle to rotation matrix conversion:
+    return the (N, 3, 3) rotation matrices of the (N, 3) axis-angle represented 'rvecs'.
+    """
+    rvecs = np.asarray(rvecs, dtype=float).reshape(-1, 3)
+    angles = np.sqrt((rvecs**2).sum(axis=1))
+    
+    # Use the Taylor expansions of the coefficients near zero, to avoid illegal expressions
+    small = (angles < 1e-6)
+    angles_safe = np.where(small, 1., angles)
+    a = np.where(small, 1. - angles**2 / 6, np.sin(angles_safe) / angles_safe)    # sin(x) / x
+    b = np.where(small, 0.5 - angles**2 / 24, (1. - np.cos(angles_safe)) / angles_safe**2)    # (1 - cos(x)) / x^2
+    
+    K = skew_matrices(rvecs)
+    return np.eye(3) + a[:, None, None] * K + b[:, None, None] * np.einsum("nij,njk->nik", K, K)
+
+
+def rvecs_from_R(Rs):
+    """
+    Vectorized version of "cv2.Rodrigues()" for rotation matrix to axis-angle conversion:
+    return the (N, 3) axis-angle representations of the (N, 3, 3) rotation matrices 'Rs'.
+    """
+    Rs = np.asarray(Rs, dtype=float).reshape(-1, 3, 3)
+    cos_angles = np.clip((np.trace(Rs, axis1=1, axis2=2) - 1) / 2, -1., 1.)
+    angles = np.arccos(cos_angles)
+    v = np.stack((Rs[:, 2, 1] - Rs[:, 1, 2], Rs[:, 0, 2] - Rs[:, 2, 0], Rs[:, 1, 0] - Rs[:, 0, 1]), axis=1)    # 2 * sin(angle) * axis
+    sin_angles = np.sqrt((v**2).sum(axis=1)) / 2
+    
+    # General case, using the Taylor expansion of angle / sin(angle) near zero
+    small = (sin_angles < 1e-6)
+    factors = np.where(small, 0.5 + angles**2 / 12, angles / (2 * np.where(small, 1., sin_angles)))
+    rvecs = v * factors[:, None]
+    
+    # Angles close to pi: take the axis from the dominant column of the symmetric part, (R + I) / 2 = axis * axis.T
+    near_pi = np.where(np.logical_and(small, cos_angles < 0))[0]
+    if len(near_pi):
+        B = (Rs[near_pi] + np.eye(3)) / 2
+        k = np.argmax(np.diagonal(B, axis1=1, axis2=2), axis=1)
+        axes = B[np.arange(len(near_pi)), :, k] / np.sqrt(B[np.arange(len(near_pi)), k, k])[:, None]
+        rvecs[near_pi] = axes * angles[near_pi, None]
+    
+    return rvecs
+
+
+def skew_matrices(vecs):
+    """
+    Return the (N, 3, 3) skew-symmetric cross-product matrices of the (N, 3) vectors 'vecs',
+    such that skew_matrices(a)[i].dot(b) == np.cross(a[i], b).
+    """
+    vecs = np.asarray(vecs, dtype=float).reshape(-1, 3)
+    K = np.zeros((len(vecs), 3, 3))
+    K[:, 0, 1], K[:, 0, 2] = -vecs[:, 2], vecs[:, 1]
+    K[:, 1, 0], K[:, 1, 2] = vecs[:, 2], -vecs[:, 0]
+    K[:, 2, 0], K[:, 2, 1] = -vecs[:, 1], vecs[:, 0]
+    return K
+
+
 """ Perspective transformations """
 
 
@@ -1,213 +1,309 @@
+from __future__ import print_function    # Python 3 compatibility
 import numpy as np
 import cv2
 
 
 
-def linear_eigen_triangulation(u1, P1, u2, P2, max_coordinate_value=1.e16):
+def linear_eigen_triangulation(u1, P1, u2, P2, max_coordinate_value=1.e16, dtype=float):
     """
     Linear Eigenvalue based (using SVD) triangulation.
-    Wrapper to OpenCV's "triangulatePoints()" function.
+    Wrapper to OpenCV's "triangulatePoints()" function, which already solves all points in one call
+    (a batched NumPy SVD of the (N, 4, 4) systems is about 5 times slower).
     Relative speed: 1.0
     
     (u1, P1) is the reference pair containing normalized image coordinates (x, y) and the corresponding camera matrix.
     (u2, P2) is the second pair.
     "max_coordinate_value" is a threshold to decide whether points are at infinity
+    "dtype" is the datatype of the returned 3D points.
     
     u1 and u2 are matrices: amount of points equals #rows and should be equal for u1 and u2.
     
     The status-vector is based on the assumption that all 3D points have finite coordinates.
     """
-    x = cv2.triangulatePoints(P1[0:3, 0:4], P2[0:3, 0:4], u1.T, u2.T)    # OpenCV's Linear-Eigen triangl
+    u1 = np.asarray(u1, dtype=float).reshape(-1, 2)
+    u2 = np.asarray(u2, dtype=float).reshape(-1, 2)
+    if not len(u1):
+        return np.empty((0, 3), dtype=dtype), np.ones(0, dtype=bool)
     
-    x[0:3, :] /= x[3:4, :]    # normalize coordinates
-    x_status = (np.max(abs(x[0:3, :]), axis=0) <= max_coordinate_value)    # NaN or Inf will receive status False
+    x = cv2.triangulatePoints(P1[0:3, 0:4], P2[0:3, 0:4], u1.T, u2.T).T    # OpenCV's Linear-Eigen triangl
     
-    return x[0:3, :].T.astype(output_dtype), x_status
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = x[:, 0:3] / x[:, 3:4]    # normalize coordinates
+        x_status = (np.max(abs(x), axis=1) <= max_coordinate_value)    # NaN or Inf will receive status False
+    
+    return x.astype(dtype), x_status
 
 
-# Initialize consts to be used in linear_LS_triangulation()
-linear_LS_triangulation_C = -np.eye(2, 3)
+def _LS_triangulation_system(u1, P1, u2, P2):
+    """
+    Returns the stacked A matrices and b vectors of the Linear Least Squares triangulation of all points,
+    of shape (N, 4, 3) and (N, 4) respectively.
+    
+    Derivation of matrices A and b:
+    for each camera following equations hold in case of perfect point matches:
+        u.x * (P[2,:] * x)     =     P[0,:] * x
+        u.y * (P[2,:] * x)     =     P[1,:] * x
+    and imposing the constraint:
+        x = [x.x, x.y, x.z, 1]^T
+    yields:
+        (u.x * P[2, 0:3] - P[0, 0:3]) * [x.x, x.y, x.z]^T     +     (u.x * P[2, 3] - P[0, 3]) * 1     =     0
+        (u.y * P[2, 0:3] - P[1, 0:3]) * [x.x, x.y, x.z]^T     +     (u.y * P[2, 3] - P[1, 3]) * 1     =     0
+    and since we have to do this for 2 cameras, and since we imposed the constraint,
+    we have to solve 4 equations in 3 unknowns (in LS sense).
+    """
+    u1 = np.asarray(u1, dtype=float).reshape(-1, 2)
+    u2 = np.asarray(u2, dtype=float).reshape(-1, 2)
+    
+    # Build A matrices:
+    # [
+    #     [ u1.x * P1[2,0] - P1[0,0],    u1.x * P1[2,1] - P1[0,1],    u1.x * P1[2,2] - P1[0,2] ],
+    #     [ u1.y * P1[2,0] - P1[1,0],    u1.y * P1[2,1] - P1[1,1],    u1.y * P1[2,2] - P1[1,2] ],
+    #     [ u2.x * P2[2,0] - P2[0,0],    u2.x * P2[2,1] - P2[0,1],    u2.x * P2[2,2] - P2[0,2] ],
+    #     [ u2.y * P2[2,0] - P2[1,0],    u2.y * P2[2,1] - P2[1,1],    u2.y * P2[2,2] - P2[1,2] ]
+    # ]
+    A = np.empty((len(u1), 4, 3))
+    A[:, 0:2, :] = u1[:, :, np.newaxis] * P1[2, 0:3] - P1[0:2, 0:3]
+    A[:, 2:4, :] = u2[:, :, np.newaxis] * P2[2, 0:3] - P2[0:2, 0:3]
+    
+    # Build b vectors:
+    # [
+    #     [ -(u1.x * P1[2,3] - P1[0,3]) ],
+    #     [ -(u1.y * P1[2,3] - P1[1,3]) ],
+    #     [ -(u2.x * P2[2,3] - P2[0,3]) ],
+    #     [ -(u2.y * P2[2,3] - P2[1,3]) ]
+    # ]
+    b = np.empty((len(u1), 4))
+    b[:, 0:2] = P1[0:2, 3] - u1 * P1[2, 3]
+    b[:, 2:4] = P2[0:2, 3] - u2 * P2[2, 3]
+    
+    return A, b
 
-def linear_LS_triangulation(u1, P1, u2, P2):
+def _solve_LS_systems(A, b):
+    """
+    Solves each of the stacked overdetermined systems "A[n] * x[n] = b[n]" in LS sense,
+    by solving the 3x3 normal equations "(A^T * A) * x = A^T * b",
+    or by SVD for the systems of which the normal equations are too ill-conditioned.
+    Returns the (N, 3) solutions.
+    """
+    M = np.einsum("nki,nkj->nij", A, A)    # A^T * A
+    r = np.einsum("nki,nk->ni", A, b)    # A^T * b
+    x = np.empty((len(M), 3))
+    x[:, 0], x[:, 1], x[:, 2], well_conditioned = _solve_packed_normal_equations(
+            M[:, 0, 0], M[:, 0, 1], M[:, 0, 2], M[:, 1, 1], M[:, 1, 2], M[:, 2, 2], r[:, 0], r[:, 1], r[:, 2] )
+    
+    ill_conditioned = np.flatnonzero(~well_conditioned)
+    if len(ill_conditioned):
+        x[ill_conditioned] = _solve_LS_systems_by_SVD(A[ill_conditioned], b[ill_conditioned])
+    return x
+
+def _solve_LS_systems_by_SVD(A, b):
+    """
+    Solves each of the stacked overdetermined systems "A[n] * x[n] = b[n]" in LS sense by SVD,
+    as OpenCV's "solve()" with "DECOMP_SVD" (minimum norm solution of rank-deficient systems).
+    Returns the (N, 3) solutions, NaN for systems with non-finite elements.
+    """
+    x = np.full((len(A), 3), np.nan)
+    finite = np.flatnonzero(np.logical_and(np.isfinite(A).all(axis=(1, 2)), np.isfinite(b).all(axis=1)))
+    if len(finite):
+        U, s, Vt = np.linalg.svd(A[finite], full_matrices=False)
+        with np.errstate(divide="ignore"):
+            s_inv = np.where(s > np.finfo(float).eps * s[:, 0:1], 1. / s, 0.)    # ignore the null space
+        x[finite] = np.einsum("nji,nj->ni", Vt, s_inv * np.einsum("nki,nk->ni", U, b[finite]))
+    return x
+
+def _solve_normal_equations(M, r):
+    """
+    Solves each of the stacked symmetric 3x3 systems "M[n] * x[n] = r[n]" in closed form (adjugate over determinant).
+    Returns the (N, 3) solutions.
+    """
+    x = np.empty((len(M), 3))
+    x[:, 0], x[:, 1], x[:, 2] = _solve_packed_normal_equations(
+            M[:, 0, 0], M[:, 0, 1], M[:, 0, 2], M[:, 1, 1], M[:, 1, 2], M[:, 2, 2], r[:, 0], r[:, 1], r[:, 2] )[0:3]
+    return x
+
+# Normal equations "(A^T * A) * x = A^T * b" of which the determinant is smaller than this fraction
+# of the product of the diagonal elements, are too ill-conditioned to solve in closed form:
+# forming them squares the condition number of A, their solution would lose more than 8 significant digits
+normal_equations_min_det_ratio = 1.e-8
+
+def _solve_packed_normal_equations(m00, m01, m02, m11, m12, m22, r0, r1, r2):
+    """
+    Solves the symmetric 3x3 systems "M * x = r" in closed form (adjugate over determinant),
+    given as vectors of the upper triangle elements of all matrices "M" and of the elements of all vectors "r".
+    Returns the 3 vectors of the elements of the solutions,
+    and whether each system is well-conditioned enough (see "normal_equations_min_det_ratio").
+    """
+    # Cofactors of the symmetric matrices
+    c00 = m11 * m22 - m12 * m12
+    c01 = m02 * m12 - m01 * m22
+    c02 = m01 * m12 - m02 * m11
+    c11 = m00 * m22 - m02 * m02
+    c12 = m01 * m02 - m00 * m12
+    c22 = m00 * m11 - m01 * m01
+    
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):    # singular systems result in non-finite solutions
+        det = m00 * c00 + m01 * c01 + m02 * c02
+        inv_det = 1. / det
+        return ((c00 * r0 + c01 * r1 + c02 * r2) * inv_det,
+                (c01 * r0 + c11 * r1 + c12 * r2) * inv_det,
+                (c02 * r0 + c12 * r1 + c22 * r2) * inv_det,
+                det > normal_equations_min_det_ratio * (m00 * m11 * m22))
+
+def _packed_normal_equations(u, P):
+    """
+    Returns the (9, N) contributions of the 2 rows of A and b of one camera (see "_LS_triangulation_system()")
+    to the normal equations "(A^T * A) * x = A^T * b" of each point:
+    the upper triangle elements (00, 01, 02, 11, 12, 22) of A^T * A, followed by the elements of A^T * b.
+    
+    With rows a_x = u.x * P[2, 0:3] - P[0, 0:3] and a_y = u.y * P[2, 0:3] - P[1, 0:3],
+    and elements b_x = P[0, 3] - u.x * P[2, 3] and b_y = P[1, 3] - u.y * P[2, 3],
+    every element is a linear combination of (u.x^2 + u.y^2, u.x, u.y, 1),
+    so the contributions of all points are a single (N, 4) x (4, 9) matrix product.
+    """
+    p, q0, q1 = P[2, 0:3], P[0, 0:3], P[1, 0:3]
+    t0, t1, t2 = P[0, 3], P[1, 3], P[2, 3]
+    upper = (np.array([0, 0, 0, 1, 1, 2]), np.array([0, 1, 2, 1, 2, 2]))
+    
+    coefficients = np.empty((4, 9))
+    coefficients[0, 0:6] = np.outer(p, p)[upper]
+    coefficients[1, 0:6] = -(np.outer(p, q0) + np.outer(q0, p))[upper]
+    coefficients[2, 0:6] = -(np.outer(p, q1) + np.outer(q1, p))[upper]
+    coefficients[3, 0:6] = (np.outer(q0, q0) + np.outer(q1, q1))[upper]
+    coefficients[0, 6:9] = -t2 * p
+    coefficients[1, 6:9] = t0 * p + t2 * q0
+    coefficients[2, 6:9] = t1 * p + t2 * q1
+    coefficients[3, 6:9] = -t0 * q0 - t1 * q1
+    
+    features = np.empty((4, len(u)))
+    features[0] = (u**2).sum(axis=1)
+    features[1:3] = u.T
+    features[3] = 1.
+    return coefficients.T.dot(features)
+
+
+def linear_LS_triangulation(u1, P1, u2, P2, dtype=float):
     """
     Linear Least Squares based triangulation.
-    Relative speed: 0.1
+    Relative speed: 1.2
     
     (u1, P1) is the reference pair containing normalized image coordinates (x, y) and the corresponding camera matrix.
     (u2, P2) is the second pair.
+    "dtype" is the datatype of the returned 3D points.
     
     u1 and u2 are matrices: amount of points equals #rows and should be equal for u1 and u2.
     
     The status-vector will be True for all points.
     """
-    A = np.zeros((4, 3))
-    b = np.zeros((4, 1))
-    
-    # Create array of triangulated points
-    x = np.zeros((3, len(u1)))
-    
-    # Initialize C matrices
-    C1 = np.array(linear_LS_triangulation_C)
-    C2 = np.array(linear_LS_triangulation_C)
-    
-    for i in range(len(u1)):
-        # Derivation of matrices A and b:
-        # for each camera following equations hold in case of perfect point matches:
-        #     u.x * (P[2,:] * x)     =     P[0,:] * x
-        #     u.y * (P[2,:] * x)     =     P[1,:] * x
-        # and imposing the constraint:
-        #     x = [x.x, x.y, x.z, 1]^T
-        # yields:
-        #     (u.x * P[2, 0:3] - P[0, 0:3]) * [x.x, x.y, x.z]^T     +     (u.x * P[2, 3] - P[0, 3]) * 1     =     0
-        #     (u.y * P[2, 0:3] - P[1, 0:3]) * [x.x, x.y, x.z]^T     +     (u.y * P[2, 3] - P[1, 3]) * 1     =     0
-        # and since we have to do this for 2 cameras, and since we imposed the constraint,
-        # we have to solve 4 equations in 3 unknowns (in LS sense).
-
-        # Build C matrices, to construct A and b in a concise way
-        C1[:, 2] = u1[i, :]
-        C2[:, 2] = u2[i, :]
-        
-        # Build A matrix:
-        # [
-        #     [ u1.x * P1[2,0] - P1[0,0],    u1.x * P1[2,1] - P1[0,1],    u1.x * P1[2,2] - P1[0,2] ],
-        #     [ u1.y * P1[2,0] - P1[1,0],    u1.y * P1[2,1] - P1[1,1],    u1.y * P1[2,2] - P1[1,2] ],
-        #     [ u2.x * P2[2,0] - P2[0,0],    u2.x * P2[2,1] - P2[0,1],    u2.x * P2[2,2] - P2[0,2] ],
-        #     [ u2.y * P2[2,0] - P2[1,0],    u2.y * P2[2,1] - P2[1,1],    u2.y * P2[2,2] - P2[1,2] ]
-        # ]
-        A[0:2, :] = C1.dot(P1[0:3, 0:3])    # C1 * R1
-        A[2:4, :] = C2.dot(P2[0:3, 0:3])    # C2 * R2
-        
-        # Build b vector:
-        # [
-        #     [ -(u1.x * P1[2,3] - P1[0,3]) ],
-        #     [ -(u1.y * P1[2,3] - P1[1,3]) ],
-        #     [ -(u2.x * P2[2,3] - P2[0,3]) ],
-        #     [ -(u2.y * P2[2,3] - P2[1,3]) ]
-        # ]
-        b[0:2, :] = C1.dot(P1[0:3, 3:4])    # C1 * t1
-        b[2:4, :] = C2.dot(P2[0:3, 3:4])    # C2 * t2
-        b *= -1
-        
-        # Solve for x vector
-        cv2.solve(A, b, x[:, i:i+1], cv2.DECOMP_SVD)
+    x = _solve_LS_systems(*_LS_triangulation_system(u1, P1, u2, P2))
     
-    return x.T.astype(output_dtype), np.ones(len(u1), dtype=bool)
+    return x.astype(dtype), np.ones(len(x), dtype=bool)
 
 
-# Initialize consts to be used in iterative_LS_triangulation()
-iterative_LS_triangulation_C = -np.eye(2, 3)
+# Amount of points solved together by iterative_LS_triangulation(),
+# small enough to keep the arrays of the iterations in the CPU cache
+iterative_LS_chunk_size = 8192
 
-def iterative_LS_triangulation(u1, P1, u2, P2, tolerance=3.e-5):
+def iterative_LS_triangulation(u1, P1, u2, P2, tolerance=3.e-5, dtype=float):
     """
     Iterative (Linear) Least Squares based triangulation.
     From "Triangulation", Hartley, R.I. and Sturm, P., Computer vision and image understanding, 1997.
-    Relative speed: 0.025
+    Relative speed: 0.4
     
     (u1, P1) is the reference pair containing normalized image coordinates (x, y) and the corresponding camera matrix.
     (u2, P2) is the second pair.
     "tolerance" is the depth convergence tolerance.
+    "dtype" is the datatype of the returned 3D points.
     
     Additionally returns a status-vector to indicate outliers:
-        1: inlier, and in front of both cameras
-        0: outlier, but in front of both cameras
+        1: in front of both cameras
+        0: undefined depths (singular system)
         -1: only in front of second camera
         -2: only in front of first camera
         -3: not in front of any camera
-    Outliers are selected based on non-convergence of depth, and on negativity of depths (=> behind camera(s)).
+    Outliers are selected based on negativity of depths (=> behind camera(s)).
+    As in the former per-point implementation, points that didn't converge within 10 iterations
+    are not marked as outliers (their status isn't 0).
     
     u1 and u2 are matrices: amount of points equals #rows and should be equal for u1 and u2.
+    
+    The points are solved in chunks of "iterative_LS_chunk_size" points at once:
+    the normal equations of each camera are built once, as rows of vectors over all points (see "_packed_normal_equations()"),
+    each iteration only changes the relative weight of both cameras
+    (the solution doesn't depend on a common scale of the weights).
+    The weight of a converged point is no longer changed, so its solution stays the same in the next iterations.
     """
-    A = np.zeros((4, 3))
-    b = np.zeros((4, 1))
+    u1 = np.asarray(u1, dtype=float).reshape(-1, 2)
+    u2 = np.asarray(u2, dtype=float).reshape(-1, 2)
+    num_points = len(u1)
     
     # Create array of triangulated points
-    x = np.empty((4, len(u1))); x[3, :].fill(1)    # create empty array of homogenous 3D coordinates
-    x_status = np.empty(len(u1), dtype=int)
+    x = np.empty((num_points, 3))
+    x_status = np.empty(num_points, dtype=int)
     
-    # Initialize C matrices
-    C1 = np.array(iterative_LS_triangulation_C)
-    C2 = np.array(iterative_LS_triangulation_C)
-    
-    for xi in range(len(u1)):
-        # Build C matrices, to construct A and b in a concise way
-        C1[:, 2] = u1[xi, :]
-        C2[:, 2] = u2[xi, :]
-        
-        # Build A matrix
-        A[0:2, :] = C1.dot(P1[0:3, 0:3])    # C1 * R1
-        A[2:4, :] = C2.dot(P2[0:3, 0:3])    # C2 * R2
-        
-        # Build b vector
-        b[0:2, :] = C1.dot(P1[0:3, 3:4])    # C1 * t1
-        b[2:4, :] = C2.dot(P2[0:3, 3:4])    # C2 * t2
-        b *= -1
-        
-        # Init depths
-        d1 = d2 = 1.
+    for start in range(0, num_points, iterative_LS_chunk_size):
+        chunk = slice(start, min(start + iterative_LS_chunk_size, num_points))
+        normal1, normal2 = _packed_normal_equations(u1[chunk], P1), _packed_normal_equations(u2[chunk], P2)
+        ratios = np.ones(len(normal1[0]))    # squared weight of the rows of the 2nd camera over the one of the 1st camera
+        d1 = d2 = 1.    # init depths
         
         for i in range(10):    # Hartley suggests 10 iterations at most
-            # Solve for x vector
-            #x_old = np.array(x[0:3, xi])    # TODO: remove
-            cv2.solve(A, b, x[0:3, xi:xi+1], cv2.DECOMP_SVD)
+            # Solve for x vectors, the ill-conditioned systems by SVD of their weighted A matrices
+            x0, x1, x2, well_conditioned = _solve_packed_normal_equations(*(normal1 + ratios * normal2))
+            ill_conditioned = np.flatnonzero(~well_conditioned)
+            if len(ill_conditioned):
+                A, b = _LS_triangulation_system(u1[chunk][ill_conditioned], P1, u2[chunk][ill_conditioned], P2)
+                with np.errstate(invalid="ignore"):
+                    weights2 = np.sqrt(ratios[ill_conditioned])
+                A[:, 2:4, :] *= weights2[:, np.newaxis, np.newaxis]
+                b[:, 2:4] *= weights2[:, np.newaxis]
+                x0[ill_conditioned], x1[ill_conditioned], x2[ill_conditioned] = _solve_LS_systems_by_SVD(A, b).T
             
             # Calculate new depths
-            d1_new = P1[2, :].dot(x[:, xi])
-            d2_new = P2[2, :].dot(x[:, xi])
+            d1_new = P1[2, 0] * x0 + P1[2, 1] * x1 + P1[2, 2] * x2 + P1[2, 3]    # P1[2, :].dot([x, 1.])
+            d2_new = P2[2, 0] * x0 + P2[2, 1] * x1 + P2[2, 2] * x2 + P2[2, 3]    # P2[2, :].dot([x, 1.])
             
             # Convergence criterium
-            #print i, d1_new - d1, d2_new - d2, (d1_new > 0 and d2_new > 0)    # TODO: remove
-            #print i, (d1_new - d1) / d1, (d2_new - d2) / d2, (d1_new > 0 and d2_new > 0)    # TODO: remove
-            #print i, np.sqrt(np.sum((x[0:3, xi] - x_old)**2)), (d1_new > 0 and d2_new > 0)    # TODO: remove
-            ##print i, u1[xi, :] - P1[0:2, :].dot(x[:, xi]) / d1_new, u2[xi, :] - P2[0:2, :].dot(x[:, xi]) / d2_new    # TODO: remove
-            #print bool(i) and ((d1_new - d1) / (d1 - d_old), (d2_new - d2) / (d2 - d1_old), (d1_new > 0 and d2_new > 0))    # TODO: remove
-            ##if abs(d1_new - d1) <= tolerance and abs(d2_new - d2) <= tolerance: print "Orig cond met"    # TODO: remove
-            if abs(d1_new - d1) <= tolerance and \
-                    abs(d2_new - d2) <= tolerance:
-            #if i and np.sum((x[0:3, xi] - x_old)**2) <= 0.0001**2:
-            #if abs((d1_new - d1) / d1) <= 3.e-6 and \
-                    #abs((d2_new - d2) / d2) <= 3.e-6: #and \
-                    #abs(d1_new - d1) <= tolerance and \
-                    #abs(d2_new - d2) <= tolerance:
-            #if i and 1 - abs((d1_new - d1) / (d1 - d_old)) <= 1.e-2 and \    # TODO: remove
-                    #1 - abs((d2_new - d2) / (d2 - d1_old)) <= 1.e-2 and \    # TODO: remove
-                    #abs(d1_new - d1) <= tolerance and \    # TODO: remove
-                    #abs(d2_new - d2) <= tolerance:    # TODO: remove
+            with np.errstate(invalid="ignore"):    # points with singular systems never converge
+                converged = ( (abs(d1_new - d1) <= tolerance) & (abs(d2_new - d2) <= tolerance) |
+                              (d1_new == 0) | (d2_new == 0) )
+            if i == 9 or converged.all():
                 break
             
-            # Re-weight A matrix and b vector with the new depths
-            A[0:2, :] *= 1 / d1_new
-            A[2:4, :] *= 1 / d2_new
-            b[0:2, :] *= 1 / d1_new
-            b[2:4, :] *= 1 / d2_new
+            # Re-weight the rows of A and b of the points that didn't converge yet with the new depths,
+            # the normal equations get the squared weights
+            with np.errstate(divide="ignore", over="ignore", invalid="ignore"):    # e.g. zero depths of converged points
+                ratios = np.where(converged, ratios, ratios * (d1_new / d2_new)**2)
             
             # Update depths
-            #d_old = d1    # TODO: remove
-            #d1_old = d2    # TODO: remove
-            d1 = d1_new
-            d2 = d2_new
+            d1, d2 = d1_new, d2_new
+        
+        x[chunk, 0], x[chunk, 1], x[chunk, 2] = x0, x1, x2
         
         # Set status
-        x_status[xi] = ( i < 10 and                       # points should have converged by now
-                         (d1_new > 0 and d2_new > 0) )    # points should be in front of both cameras
-        if d1_new <= 0: x_status[xi] -= 1
-        if d2_new <= 0: x_status[xi] -= 2
+        x_status[chunk] = np.logical_and(d1_new > 0, d2_new > 0)    # points should be in front of both cameras
+        x_status[chunk][d1_new <= 0] -= 1    # behind 1st cam
+        x_status[chunk][d2_new <= 0] -= 2    # behind 2nd cam
     
-    return x[0:3, :].T.astype(output_dtype), x_status
+    return x.astype(dtype), x_status
 
 
-def polynomial_triangulation(u1, P1, u2, P2):
+def polynomial_triangulation(u1, P1, u2, P2, dtype=float):
     """
     Polynomial (Optimal) triangulation.
-    Uses Linear-Eigen for final triangulation.
-    Relative speed: 0.1
+    Uses Linear-LS for final triangulation.
+    Relative speed: 0.01 (dominated by OpenCV's "correctMatches()")
     
     (u1, P1) is the reference pair containing normalized image coordinates (x, y) and the corresponding camera matrix.
     (u2, P2) is the second pair.
+    "dtype" is the datatype of the returned 3D points.
     
     u1 and u2 are matrices: amount of points equals #rows and should be equal for u1 and u2.
     
     The status-vector is based on the assumption that all 3D points have finite coordinates.
     """
+    u1 = np.asarray(u1, dtype=float).reshape(-1, 2)
+    u2 = np.asarray(u2, dtype=float).reshape(-1, 2)
+    
     P1_full = np.eye(4); P1_full[0:3, :] = P1[0:3, :]    # convert to 4x4
     P2_full = np.eye(4); P2_full[0:3, :] = P2[0:3, :]    # convert to 4x4
     P_canon = P2_full.dot(cv2.invert(P1_full)[1])    # find canonical P which satisfies P2 = P_canon * P1
@@ -229,39 +325,143 @@ def polynomial_triangulation(u1, P1, u2, P2):
         u1_new, u2_new = cv2.correctMatches(F, u1.reshape(1, len(u1), 2), u2.reshape(1, len(u1), 2))
     
     # Triangulate using the refined image points
-    return linear_eigen_triangulation(u1_new[0], P1, u2_new[0], P2)    # TODO: replace with linear_LS: better results for points not at Inf
+    x = _solve_LS_systems(*_LS_triangulation_system(u1_new[0], P1, u2_new[0], P2))
+    x_status = np.isfinite(x).all(axis=1)    # NaN or Inf will receive status False
+    
+    return x.astype(dtype), x_status
 
 
 
-# Attempt to load the optimized triangulation functions
-import triangulation_c
-if triangulation_c.loaded:
-    from triangulation_c import linear_LS_triangulation as linear_LS_triangulation_c
-    def linear_LS_triangulation(*args):
-        x, x_status = linear_LS_triangulation_c(*args)
-        if np.finfo(x.dtype) != np.finfo(output_dtype):
-            x = x.astype(output_dtype)
-        return x, x_status
-    linear_LS_triangulation.__doc__ = linear_LS_triangulation_c.__doc__
-    
-    from triangulation_c import iterative_LS_triangulation as iterative_LS_triangulation_c
-    def iterative_LS_triangulation(*args, **kwargs):
-        x, x_status = iterative_LS_triangulation_c(*args, **kwargs)
-        if np.finfo(x.dtype) != np.finfo(output_dtype):
-            x = x.astype(output_dtype)
-        return x, x_status
-    iterative_LS_triangulation.__doc__ = iterative_LS_triangulation_c.__doc__
-else:
-    print 'Warning: failed to load the optimized "triangulation_c" module'
-    print "=> falling back to Python-speed for triangulation."
+def multiview_triangulation(u, Ps, view_idxs, offsets, tolerance=3.e-5, max_iterations=10, dtype=float):
+    """
+    Iterative (Linear) Least Squares based triangulation of points that are observed in a variable amount of views,
+    this generalizes "iterative_LS_triangulation()" to more than 2 views.
+    
+    The observations are given in a ragged (CSR) layout:
+    point i is observed at normalized image coordinates u[offsets[i]:offsets[i+1]],
+    by the cameras Ps[view_idxs[offsets[i]:offsets[i+1]]].
+        "u" : (M, 2) normalized image coordinates (x, y) of all observations
+        "Ps" : (K, 3, 4) (or (K, 4, 4)) camera matrices of all views
+        "view_idxs" : (M,) index in "Ps" of the view of each observation
+        "offsets" : (N + 1,) ascending observation offsets of the N points, each point needs at least 2 observations
+    "tolerance" is the depth convergence tolerance, "max_iterations" the maximum amount of re-weighting iterations.
+    "dtype" is the datatype of the returned 3D points.
+    
+    Returns the 3D points, a status-vector, and the RMS reprojection error of each point (in normalized image coordinates).
+    The status-vector indicates outliers:
+        1: inlier, and in front of all its cameras
+        0: outlier (depths didn't converge), but in front of all its cameras
+        -1: behind at least one of its cameras
+    
+    All points are solved at once, each iteration only re-solves the points that didn't converge yet.
+    """
+    u = np.asarray(u, dtype=float).reshape(-1, 2)
+    Ps = np.asarray(Ps, dtype=float)[:, 0:3, :]
+    offsets = np.asarray(offsets, dtype=int)
+    counts = np.diff(offsets)    # amount of observations of each point
+    num_points = len(counts)
+    if num_points and counts.min() < 2:
+        raise ValueError("Each point should have at least 2 observations.")
+    point_idxs = np.repeat(np.arange(num_points), counts)    # point index of each observation
+    
+    # Build the 2 rows of A and b for each observation, see "_LS_triangulation_system()"
+    P_obs = Ps[view_idxs]
+    A = u[:, :, np.newaxis] * P_obs[:, 2:3, 0:3] - P_obs[:, 0:2, 0:3]
+    b = P_obs[:, 0:2, 3] - u * P_obs[:, 2:3, 3]
+    AtA = np.einsum("mki,mkj->mij", A, A)    # contribution of each observation to the normal equations
+    Atb = np.einsum("mki,mk->mi", A, b)
+    
+    # Create array of triangulated points
+    x = np.zeros((num_points, 3))
+    converged = np.zeros(num_points, dtype=bool)
+    
+    # Init depths and weights of each observation
+    depths = np.ones(len(u))
+    weights = np.ones(len(u))
+    
+    active = np.ones(num_points, dtype=bool)    # points that didn't converge yet
+    for i in range(max_iterations):
+        active_idxs = np.where(active)[0]
+        if not len(active_idxs):
+            break
+        active_obs = active[point_idxs]
+        active_offsets = np.concatenate(([0], np.cumsum(counts[active_idxs])))[:-1]
+        
+        # Solve the weighted normal equations of the active points
+        w = weights[active_obs]
+        x[active_idxs] = x_active = _solve_normal_equations(
+                np.add.reduceat(w[:, np.newaxis, np.newaxis] * AtA[active_obs], active_offsets, axis=0),
+                np.add.reduceat(w[:, np.newaxis] * Atb[active_obs], active_offsets, axis=0) )
+        
+        # Calculate new depths
+        P_obs_active = P_obs[active_obs]
+        x_obs_active = x_active[np.repeat(np.arange(len(active_idxs)), counts[active_idxs])]
+        depths_new = (P_obs_active[:, 2, 0:3] * x_obs_active).sum(axis=1) + P_obs_active[:, 2, 3]
+        
+        # Convergence criterium
+        with np.errstate(invalid="ignore"):
+            done = np.logical_or(
+                    np.maximum.reduceat(abs(depths_new - depths[active_obs]), active_offsets) <= tolerance,
+                    np.minimum.reduceat(abs(depths_new), active_offsets) == 0 )
+        converged[active_idxs[done]] = True
+        active[active_idxs[done]] = False
+        
+        # Re-weight with the new depths, Hartley's weight of each row is "1 / depth"
+        depths[active_obs] = depths_new
+        with np.errstate(divide="ignore"):
+            weights[active_obs] = 1. / depths_new**2
+    
+    # Calculate reprojection errors and depths of final solution
+    x_obs = x[point_idxs]
+    proj = np.einsum("mij,mj->mi", P_obs[:, :, 0:3], x_obs) + P_obs[:, :, 3]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sq_errors = ((proj[:, 0:2] / proj[:, 2:3] - u)**2).sum(axis=1)
+        residuals = np.sqrt(np.add.reduceat(sq_errors, offsets[:-1]) / counts) if num_points else np.zeros(0)
+    
+    # Set status
+    x_status = converged.astype(int)
+    if num_points:
+        x_status[np.minimum.reduceat(proj[:, 2], offsets[:-1]) <= 0] = -1    # behind at least one cam
+    
+    return x.astype(dtype), x_status, residuals
 
 
-output_dtype = float
 
-def set_triangl_output_dtype(output_dtype_):
+triangulation_methods = {
+    "linear_eigen"  : linear_eigen_triangulation,
+    "linear_LS"     : linear_LS_triangulation,
+    "iterative_LS"  : iterative_LS_triangulation,
+    "polynomial"    : polynomial_triangulation }
+
+def triangulate(u1, P1, u2, P2, method="iterative_LS", dtype=float, backend="numpy", **kwargs):
     """
-    Set the datatype of the triangulated 3D point positions.
-    (Default is set to "float")
+    Triangulate the 2D point matches "u1" and "u2" of cameras "P1" and "P2",
+    using triangulation method "method", one of the keys of "triangulation_methods":
+        "linear_eigen", "linear_LS", "iterative_LS" or "polynomial"
+    
+    "backend" selects the implementation:
+        "numpy": the functions of this module
+        "c":     the OpenMP-parallel C extension of the "triangulation_c" package,
+                 only available for the "linear_LS" and "iterative_LS" methods,
+                 raises an ImportError if the extension is not built,
+                 uses C-contiguous float32/float64 inputs in place and accepts an "out" array (see "triangulation_c")
+    
+    Returns the 3D points, of datatype "dtype", and the status-vector of the selected method.
+    Extra keyword arguments "kwargs" are passed to the selected method.
+    
+    See the documentation of the "<method>_triangulation()" functions for details.
     """
-    global output_dtype
-    output_dtype = output_dtype_
+    if method not in triangulation_methods:
+        raise ValueError("Unknown triangulation method '%s', choose from: %s" % (method, sorted(triangulation_methods)))
+    
+    if backend == "numpy":
+        triangulation_method = triangulation_methods[method]
+    elif backend == "c":
+        import triangulation_c    # fails loudly if the extension is not built
+        if not hasattr(triangulation_c, "%s_triangulation" % method):
+            raise ValueError("Triangulation method '%s' has no C implementation" % method)
+        triangulation_method = getattr(triangulation_c, "%s_triangulation" % method)
+    else:
+        raise ValueError("Unknown triangulation backend '%s', choose from: ['c', 'numpy']" % backend)
+    
+    return triangulation_method(u1, P1, u2, P2, dtype=dtype, **kwargs)
@@ -1,16 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import os
-import sys; sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))    # path to "python_libs" directory
+"""
+Builds the "triangulation_ext" C Python extension from the "triangulation.c" source file.
 
-import convert_c_to_ext_lib
+Run (in this directory):
+    python setup.py build_ext --inplace
+"""
+from setuptools import setup, Extension
+import numpy as np
 
 
 
+triangulation_ext = Extension(
+        "triangulation_ext",
+        sources=["triangulation.c"],
+        include_dirs=[np.get_include()],
+        extra_compile_args=["-O3", "-fopenmp"],    # OpenMP "parallel for" over the points
+        extra_link_args=["-fopenmp"] )
+
 def main():
-    # Create the "triangulation_ext" module from the "triangulation.c" source file;
-    # disable openmp because cpu-usage x4 and perf only x1.5
-    convert_c_to_ext_lib.create_ext_lib("triangulation.c", openmp=False)
+    setup(name="triangulation_ext", ext_modules=[triangulation_ext])
 
 
 if __name__ == "__main__":
@@ -1,21 +1,26 @@
 /*
- * Warning, this C file is not directly compilable on its own,
- * run the "setup.py" file to generate the library.
- * It only serves to properly highlight the syntax.
+ * C Python extension "triangulation_ext",
+ * containing OpenMP-parallel versions of the Linear-LS and Iterative-LS triangulation methods of "triangulation.py".
+ *
+ * Build it by running (in this directory):
+ *     python setup.py build_ext --inplace
+ *
+ * Don't use the functions of this module directly,
+ * use the wrappers in "__init__.py", they take care of the argument conversions.
  */
 
 
 
-/* Libraries */
-
-/* opencv_imgproc */
-
-
-
 /* Includes */
 
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <Python.h>
+#include <numpy/arrayobject.h>
 #include <math.h>
-#include <opencv2/imgproc/imgproc.hpp>
+#include <float.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 
 
@@ -24,138 +29,463 @@
 #define P1_(k,l)    (P1[4 * (k) + (l)])
 #define P2_(k,l)    (P2[4 * (k) + (l)])
 
-#define u1_(j)    (u1[2 * xi + (j)])
-#define u2_(j)    (u2[2 * xi + (j)])
+/* Smallest ratio of a diagonal element of the R factor of "A" to the largest one,
+ * below which "A" is considered (nearly) rank deficient, and solved by SVD */
+#define QR_MIN_DIAGONAL_RATIO    1.e-10
+
+static int num_threads = 0;    /* amount of OpenMP threads, 0 means OpenMP's default */
+static int default_num_threads = 1;    /* OpenMP's default amount of threads, saved at module init */
+
+/* Builds the 4x3 (row-major) A matrix and the b vector of the point match ("u1", "u2") */
+static void construct_A_and_b(const double u1[2], const double *P1, const double u2[2], const double *P2,
+                              double A[12], double b[4])
+{
+    int k;
+    for (k = 0; k < 3; k++) {
+        A[3 * 0 + k] = u1[0] * P1_(2,k) - P1_(0,k);
+        A[3 * 1 + k] = u1[1] * P1_(2,k) - P1_(1,k);
+        A[3 * 2 + k] = u2[0] * P2_(2,k) - P2_(0,k);
+        A[3 * 3 + k] = u2[1] * P2_(2,k) - P2_(1,k);
+    }
+    b[0] = -(u1[0] * P1_(2,3) - P1_(0,3));
+    b[1] = -(u1[1] * P1_(2,3) - P1_(1,3));
+    b[2] = -(u2[0] * P2_(2,3) - P2_(0,3));
+    b[3] = -(u2[1] * P2_(2,3) - P2_(1,3));
+}
+
+/* Solves "A * x = b" in LS sense, like "cvSolve(A, b, x, DECOMP_SVD)":
+ * the SVD of the 4x3 "A" is computed by one-sided Jacobi rotations,
+ * (near-)zero singular values are discarded (minimum norm solution) */
+static void solve_LS_by_SVD(const double A[12], const double b[4], double x[3])
+{
+    double U[12], V[9] = { 1., 0., 0.,    0., 1., 0.,    0., 0., 1. };
+    double s[3], c[3], s_max = 0.;
+    int sweep, p, q, j, k;
+
+    for (k = 0; k < 12; k++)
+        U[k] = A[k];
+
+    /* Orthogonalize the columns of U (= A * V) */
+    for (sweep = 0; sweep < 30; sweep++) {
+        int rotated = 0;
+        for (p = 0; p < 2; p++) {
+            for (q = p + 1; q < 3; q++) {
+                double alpha = 0., beta = 0., gamma = 0., zeta, t, cs, sn;
+                for (k = 0; k < 4; k++) {
+                    alpha += U[3 * k + p] * U[3 * k + p];
+                    beta += U[3 * k + q] * U[3 * k + q];
+                    gamma += U[3 * k + p] * U[3 * k + q];
+                }
+                if (fabs(gamma) <= DBL_EPSILON * sqrt(alpha * beta))
+                    continue;
+                rotated = 1;
+
+                zeta = (beta - alpha) / (2. * gamma);
+                t = copysign(1., zeta) / (fabs(zeta) + sqrt(1. + zeta * zeta));
+                cs = 1. / sqrt(1. + t * t);
+                sn = cs * t;
+                for (k = 0; k < 4; k++) {
+                    const double up = U[3 * k + p], uq = U[3 * k + q];
+                    U[3 * k + p] = cs * up - sn * uq;
+                    U[3 * k + q] = sn * up + cs * uq;
+                }
+                for (k = 0; k < 3; k++) {
+                    const double vp = V[3 * k + p], vq = V[3 * k + q];
+                    V[3 * k + p] = cs * vp - sn * vq;
+                    V[3 * k + q] = sn * vp + cs * vq;
+                }
+            }
+        }
+        if (!rotated)
+            break;
+    }
+
+    /* Singular values are the norms of the columns of U */
+    for (j = 0; j < 3; j++) {
+        s[j] = 0.;
+        for (k = 0; k < 4; k++)
+            s[j] += U[3 * k + j] * U[3 * k + j];
+        s[j] = sqrt(s[j]);
+        if (s[j] > s_max)
+            s_max = s[j];
+    }
+
+    /* x = V * S^-1 * U^T * b, where U^T * S^-1 == (columns of U)^T / s^2 */
+    for (j = 0; j < 3; j++) {
+        c[j] = 0.;
+        if (s[j] > DBL_EPSILON * s_max) {
+            for (k = 0; k < 4; k++)
+                c[j] += U[3 * k + j] * b[k];
+            c[j] /= s[j] * s[j];
+        }
+    }
+    for (k = 0; k < 3; k++)
+        x[k] = V[3 * k + 0] * c[0] + V[3 * k + 1] * c[1] + V[3 * k + 2] * c[2];
+}
+
+/* Solves "A * x = b" in LS sense, by Householder QR decomposition of the 4x3 "A",
+ * which is as accurate as the SVD (no squared condition number like the normal equations), but cheaper;
+ * (nearly) rank deficient systems are solved by "solve_LS_by_SVD()" instead */
+static void solve_LS(const double A[12], const double b[4], double x[3])
+{
+    double R[12], y[4], r_max = 0.;
+    int j, k, l;
+
+    for (k = 0; k < 12; k++)
+        R[k] = A[k];
+    for (k = 0; k < 4; k++)
+        y[k] = b[k];
+
+    /* Triangularize R (= Q^T * A), and apply the same reflections to y (= Q^T * b) */
+    for (j = 0; j < 3; j++) {
+        double v[4], norm = 0., v_norm2, f;
+        for (k = j; k < 4; k++)
+            norm += R[3 * k + j] * R[3 * k + j];
+        norm = copysign(sqrt(norm), R[3 * j + j]);
+        for (k = j; k < 4; k++)
+            v[k] = R[3 * k + j];
+        v[j] += norm;
+        v_norm2 = norm * v[j];    // == (v[j:] . v[j:]) / 2
+        if (v_norm2 == 0.) {
+            solve_LS_by_SVD(A, b, x);
+            return;
+        }
+
+        for (l = j + 1; l < 3; l++) {
+            f = 0.;
+            for (k = j; k < 4; k++)
+                f += v[k] * R[3 * k + l];
+            f /= v_norm2;
+            for (k = j; k < 4; k++)
+                R[3 * k + l] -= f * v[k];
+        }
+        f = 0.;
+        for (k = j; k < 4; k++)
+            f += v[k] * y[k];
+        f /= v_norm2;
+        for (k = j; k < 4; k++)
+            y[k] -= f * v[k];
+        R[3 * j + j] = -norm;
+        if (fabs(norm) > r_max)
+            r_max = fabs(norm);
+    }
+
+    /* The diagonal of R reveals rank deficiency */
+    for (j = 0; j < 3; j++) {
+        if (!(fabs(R[3 * j + j]) > QR_MIN_DIAGONAL_RATIO * r_max)) {
+            solve_LS_by_SVD(A, b, x);
+            return;
+        }
+    }
+
+    /* Back-substitution of R * x = y[0:3] */
+    for (j = 2; j >= 0; j--) {
+        x[j] = y[j];
+        for (l = j + 1; l < 3; l++)
+            x[j] -= R[3 * j + l] * x[l];
+        x[j] /= R[3 * j + j];
+    }
+}
+
+/* Loads the 2D point "xi" of "u", of which the elements are of type "float" if "is_float32", otherwise "double" */
+static void load_point(const void *u, int is_float32, npy_intp xi, double ui[2])
+{
+    if (is_float32) {
+        ui[0] = ((const float *)u)[2 * xi + 0];
+        ui[1] = ((const float *)u)[2 * xi + 1];
+    } else {
+        ui[0] = ((const double *)u)[2 * xi + 0];
+        ui[1] = ((const double *)u)[2 * xi + 1];
+    }
+}
+
+/* Stores the 3D point "xi" in "x", of which the elements are of type "float" if "is_float32", otherwise "double" */
+static void store_point(void *x, int is_float32, npy_intp xi, const double xi_[3])
+{
+    int j;
+    if (is_float32) {
+        for (j = 0; j < 3; j++)
+            ((float *)x)[3 * xi + j] = (float)xi_[j];
+    } else {
+        for (j = 0; j < 3; j++)
+            ((double *)x)[3 * xi + j] = xi_[j];
+    }
+}
+
+#define NPY_FLOAT32_OR_64    (-1)    /* "type_num" of "check_array()" that accepts both NPY_FLOAT32 and NPY_FLOAT64 */
+
+/* Returns 1 if "a" is a C-contiguous array of "ndim" dimensions of type "type_num",
+ * of which the 2nd dimension (if any) has size "dim1";
+ * otherwise sets a Python exception with the name "name" and returns 0.
+ * No data is copied, arrays that don't qualify are rejected. */
+static int check_array(PyArrayObject *a, const char *name, int ndim, npy_intp dim1, int type_num)
+{
+    const int type_ok = (type_num == NPY_FLOAT32_OR_64) ?
+            (PyArray_TYPE(a) == NPY_FLOAT32 || PyArray_TYPE(a) == NPY_FLOAT64) : (PyArray_TYPE(a) == type_num);
+
+    if (PyArray_NDIM(a) != ndim || (ndim == 2 && PyArray_DIM(a, 1) != dim1)) {
+        PyErr_Format(PyExc_ValueError, "argument '%s' has an invalid shape", name);
+        return 0;
+    }
+    if (!type_ok || !PyArray_IS_C_CONTIGUOUS(a)) {
+        PyErr_Format(PyExc_TypeError, "argument '%s' should be a C-contiguous array of the right dtype", name);
+        return 0;
+    }
+    return 1;
+}
 
-#define construct_A()    double A[12] = { \
-        u1_(0) * P1_(2,0) - P1_(0,0),    u1_(0) * P1_(2,1) - P1_(0,1),    u1_(0) * P1_(2,2) - P1_(0,2), \
-        u1_(1) * P1_(2,0) - P1_(1,0),    u1_(1) * P1_(2,1) - P1_(1,1),    u1_(1) * P1_(2,2) - P1_(1,2), \
-        u2_(0) * P2_(2,0) - P2_(0,0),    u2_(0) * P2_(2,1) - P2_(0,1),    u2_(0) * P2_(2,2) - P2_(0,2), \
-        u2_(1) * P2_(2,0) - P2_(1,0),    u2_(1) * P2_(2,1) - P2_(1,1),    u2_(1) * P2_(2,2) - P2_(1,2) }
+#define CHECK_ARRAY(a, ndim, dim1, type_num)    if (!check_array(a##_arr, #a, ndim, dim1, type_num)) return NULL;
 
-#define construct_b()    double b[4] = { \
-        -(u1_(0) * P1_(2,3) - P1_(0,3)), \
-        -(u1_(1) * P1_(2,3) - P1_(1,3)), \
-        -(u2_(0) * P2_(2,3) - P2_(0,3)), \
-        -(u2_(1) * P2_(2,3) - P2_(1,3)) }
+/* Saves OpenMP's default amount of threads, to restore it when "num_threads" is set back to 0 */
+static void save_default_num_threads(void)
+{
+#ifdef _OPENMP
+    default_num_threads = omp_get_max_threads();
+#endif
+}
 
-#define x_(j)    (x[3 * xi + (j)])
+/* Applies "num_threads" to the OpenMP regions that follow, restoring OpenMP's default if it's 0 */
+static void set_omp_num_threads(void)
+{
+#ifdef _OPENMP
+    omp_set_num_threads((num_threads > 0) ? num_threads : default_num_threads);
+#endif
+}
 
 
 
 /* Functions exported to Python */
 
-/* Arguments:
- *      u1 = np.empty((0, 2), dtype=np.float64)    # [in]
- *      P1 = np.empty((3, 4), dtype=np.float64)    # [in]
- *      u2 = np.empty((0, 2), dtype=np.float64)    # [in]
- *      P2 = np.empty((3, 4), dtype=np.float64)    # [in]
- * 
- *       x = np.empty((0, 3), dtype=np.float64)    # [out]
- * 
- *  Note 1:
- *      The dimensions with size 0 should be replaced by the amount of points to triangulate.
- *  Note 2:
- *      The data of each numpy array argument "a" should be aligned,
- *      to check whether this is the case, the following code shouldn't raise an exception:
- *      #    v = a.view(); v.shape = (a.size,)
- *      To fix this automatically, run:
- *      #    a = a.reshape(a.size).reshape(a.shape)
- */
-void linear_LS_triangulation(/* ... */)
+PyDoc_STRVAR(linear_LS_triangulation_doc,
+"linear_LS_triangulation(u1, P1, u2, P2, x)\n"
+"\n"
+"Arguments:\n"
+"    u1 = np.empty((N, 2), dtype=np.float32 or np.float64)    # [in]\n"
+"    P1 = np.empty((3, 4), dtype=np.float64)                  # [in]\n"
+"    u2 = np.empty((N, 2), dtype=np.float32 or np.float64)    # [in]\n"
+"    P2 = np.empty((3, 4), dtype=np.float64)                  # [in]\n"
+"\n"
+"     x = np.empty((N, 3), dtype=np.float32 or np.float64)    # [out]\n"
+"\n"
+"All arrays should be C-contiguous, (4, 4) camera matrices are accepted as well.\n"
+"The arrays are used in place, the computations are done in double precision.");
+
+static PyObject *linear_LS_triangulation(PyObject *self, PyObject *args)
 {
-    const int num_points = Nu1[0];    // len(u1)
-    int xi;
-    
+    PyArrayObject *u1_arr, *P1_arr, *u2_arr, *P2_arr, *x_arr;
+    const void *u1, *u2;
+    const double *P1, *P2;
+    void *x;
+    int u1_is_float32, u2_is_float32, x_is_float32;
+    npy_intp num_points, xi;
+
+    if (!PyArg_ParseTuple(args, "O!O!O!O!O!",
+            &PyArray_Type, &u1_arr, &PyArray_Type, &P1_arr, &PyArray_Type, &u2_arr, &PyArray_Type, &P2_arr,
+            &PyArray_Type, &x_arr))
+        return NULL;
+    CHECK_ARRAY(u1, 2, 2, NPY_FLOAT32_OR_64);
+    CHECK_ARRAY(P1, 2, 4, NPY_FLOAT64);
+    CHECK_ARRAY(u2, 2, 2, NPY_FLOAT32_OR_64);
+    CHECK_ARRAY(P2, 2, 4, NPY_FLOAT64);
+    CHECK_ARRAY(x, 2, 3, NPY_FLOAT32_OR_64);
+    num_points = PyArray_DIM(u1_arr, 0);    // len(u1)
+    if (PyArray_DIM(u2_arr, 0) != num_points || PyArray_DIM(x_arr, 0) != num_points ||
+            PyArray_DIM(P1_arr, 0) < 3 || PyArray_DIM(P2_arr, 0) < 3) {
+        PyErr_SetString(PyExc_ValueError, "arguments have inconsistent shapes");
+        return NULL;
+    }
+
+    u1 = PyArray_DATA(u1_arr);    u1_is_float32 = (PyArray_TYPE(u1_arr) == NPY_FLOAT32);
+    P1 = (const double *)PyArray_DATA(P1_arr);
+    u2 = PyArray_DATA(u2_arr);    u2_is_float32 = (PyArray_TYPE(u2_arr) == NPY_FLOAT32);
+    P2 = (const double *)PyArray_DATA(P2_arr);
+    x = PyArray_DATA(x_arr);    x_is_float32 = (PyArray_TYPE(x_arr) == NPY_FLOAT32);
+
+    Py_BEGIN_ALLOW_THREADS
+    set_omp_num_threads();
     #pragma omp parallel for
     for (xi = 0; xi < num_points; xi++) {
-        const construct_A();
-        const CvMat A_mat = cvMat(4, 3, CV_64F, const_cast<double *>(A));
-        
-        const construct_b();
-        const CvMat b_vec = cvMat(4, 1, CV_64F, const_cast<double *>(b));
-        
-        CvMat x_vec = cvMat(3, 1, CV_64F, &x_(0));
-        
+        double u1_xi[2], u2_xi[2], A[12], b[4], x_xi[3];
+        load_point(u1, u1_is_float32, xi, u1_xi);
+        load_point(u2, u2_is_float32, xi, u2_xi);
+        construct_A_and_b(u1_xi, P1, u2_xi, P2, A, b);
+
         /* Solve for x vector */
-        cvSolve(&A_mat, &b_vec, &x_vec, cv::DECOMP_SVD);
+        solve_LS(A, b, x_xi);
+        store_point(x, x_is_float32, xi, x_xi);
     }
+    Py_END_ALLOW_THREADS
+
+    Py_RETURN_NONE;
 }
 
-/* Arguments:
- *             u1 = np.empty((0, 2), dtype=np.float64)     # [in]
- *             P1 = np.empty((3, 4), dtype=np.float64)     # [in]
- *             u2 = np.empty((0, 2), dtype=np.float64)     # [in]
- *             P2 = np.empty((3, 4), dtype=np.float64)     # [in]
- *      tolerance = float()                                # [in]
- * 
- *             x = np.empty((0, 3), dtype=np.float64)    # [out]
- *      x_status = np.empty( 0    , dtype=np.int32)      # [out]
- * 
- *  Note 1:
- *      The dimensions with size 0 should be replaced by the amount of points to triangulate.
- *  Note 2:
- *      The data of each numpy array argument "a" should be aligned,
- *      to check whether this is the case, the following code shouldn't raise an exception:
- *      #    v = a.view(); v.shape = (a.size,)
- *      To fix this automatically, run:
- *      #    a = a.reshape(a.size).reshape(a.shape)
- */
-void iterative_LS_triangulation(/* ... */)
+PyDoc_STRVAR(iterative_LS_triangulation_doc,
+"iterative_LS_triangulation(u1, P1, u2, P2, tolerance, x, x_status)\n"
+"\n"
+"Arguments:\n"
+"           u1 = np.empty((N, 2), dtype=np.float32 or np.float64)    # [in]\n"
+"           P1 = np.empty((3, 4), dtype=np.float64)                  # [in]\n"
+"           u2 = np.empty((N, 2), dtype=np.float32 or np.float64)    # [in]\n"
+"           P2 = np.empty((3, 4), dtype=np.float64)                  # [in]\n"
+"    tolerance = float()                                             # [in]\n"
+"\n"
+"            x = np.empty((N, 3), dtype=np.float32 or np.float64)    # [out]\n"
+"     x_status = np.empty( N    , dtype=np.int32)                    # [out]\n"
+"\n"
+"All arrays should be C-contiguous, (4, 4) camera matrices are accepted as well.\n"
+"The arrays are used in place, the computations are done in double precision.");
+
+static PyObject *iterative_LS_triangulation(PyObject *self, PyObject *args)
 {
-    const int num_points = Nu1[0];    // len(u1)
-    int xi, i;
-    
+    PyArrayObject *u1_arr, *P1_arr, *u2_arr, *P2_arr, *x_arr, *x_status_arr;
+    const void *u1, *u2;
+    const double *P1, *P2;
+    double tolerance;
+    void *x;
+    npy_int32 *x_status;
+    int u1_is_float32, u2_is_float32, x_is_float32;
+    npy_intp num_points, xi;
+
+    if (!PyArg_ParseTuple(args, "O!O!O!O!dO!O!",
+            &PyArray_Type, &u1_arr, &PyArray_Type, &P1_arr, &PyArray_Type, &u2_arr, &PyArray_Type, &P2_arr,
+            &tolerance, &PyArray_Type, &x_arr, &PyArray_Type, &x_status_arr))
+        return NULL;
+    CHECK_ARRAY(u1, 2, 2, NPY_FLOAT32_OR_64);
+    CHECK_ARRAY(P1, 2, 4, NPY_FLOAT64);
+    CHECK_ARRAY(u2, 2, 2, NPY_FLOAT32_OR_64);
+    CHECK_ARRAY(P2, 2, 4, NPY_FLOAT64);
+    CHECK_ARRAY(x, 2, 3, NPY_FLOAT32_OR_64);
+    CHECK_ARRAY(x_status, 1, 0, NPY_INT32);
+    num_points = PyArray_DIM(u1_arr, 0);    // len(u1)
+    if (PyArray_DIM(u2_arr, 0) != num_points || PyArray_DIM(x_arr, 0) != num_points ||
+            PyArray_DIM(x_status_arr, 0) != num_points ||
+            PyArray_DIM(P1_arr, 0) < 3 || PyArray_DIM(P2_arr, 0) < 3) {
+        PyErr_SetString(PyExc_ValueError, "arguments have inconsistent shapes");
+        return NULL;
+    }
+
+    u1 = PyArray_DATA(u1_arr);    u1_is_float32 = (PyArray_TYPE(u1_arr) == NPY_FLOAT32);
+    P1 = (const double *)PyArray_DATA(P1_arr);
+    u2 = PyArray_DATA(u2_arr);    u2_is_float32 = (PyArray_TYPE(u2_arr) == NPY_FLOAT32);
+    P2 = (const double *)PyArray_DATA(P2_arr);
+    x = PyArray_DATA(x_arr);    x_is_float32 = (PyArray_TYPE(x_arr) == NPY_FLOAT32);
+    x_status = (npy_int32 *)PyArray_DATA(x_status_arr);
+
+    Py_BEGIN_ALLOW_THREADS
+    set_omp_num_threads();
     #pragma omp parallel for
     for (xi = 0; xi < num_points; xi++) {
-        construct_A();
-        CvMat A_mat = cvMat(4, 3, CV_64F, A);
-        CvMat A_01_mat = cvMat(2, 3, CV_64F, &A[3 * 0]);    // A[0:2, :]
-        CvMat A_23_mat = cvMat(2, 3, CV_64F, &A[3 * 2]);    // A[2:4, :]
-        
-        construct_b();
-        CvMat b_vec = cvMat(4, 1, CV_64F, b);
-        CvMat b_01_vec = cvMat(2, 1, CV_64F, &b[1 * 0]);    // b[0:2, :]
-        CvMat b_23_vec = cvMat(2, 1, CV_64F, &b[1 * 2]);    // b[2:4, :]
-        
-        CvMat x_vec = cvMat(3, 1, CV_64F, &x_(0));
-        
+        double u1_xi[2], u2_xi[2], A[12], b[4], x_xi[3];
+        double d1, d1_new = 1., d2, d2_new = 1.;
+        int i, k;
+        load_point(u1, u1_is_float32, xi, u1_xi);
+        load_point(u2, u2_is_float32, xi, u2_xi);
+        construct_A_and_b(u1_xi, P1, u2_xi, P2, A, b);
+
         /* Init depths */
-        double d1, d1_new, d2, d2_new;
         d1 = d2 = 1.;
-        
+
         /* Hartley suggests 10 iterations at most */
         for (i = 0; i < 10; i++) {
             /* Solve for x vector */
-            cvSolve(&A_mat, &b_vec, &x_vec, cv::DECOMP_SVD);
-            
+            solve_LS(A, b, x_xi);
+
             /* Calculate new depths */
-            d1_new = P1_(2, 0) * x_(0) + P1_(2, 1) * x_(1) + P1_(2, 2) * x_(2) + P1_(2, 3);    // P1_(2, :).dot([x_(:), 1.])
-            d2_new = P2_(2, 0) * x_(0) + P2_(2, 1) * x_(1) + P2_(2, 2) * x_(2) + P2_(2, 3);    // P2_(2, :).dot([x_(:), 1.])
-            
+            d1_new = P1_(2, 0) * x_xi[0] + P1_(2, 1) * x_xi[1] + P1_(2, 2) * x_xi[2] + P1_(2, 3);    // P1_(2, :).dot([x_xi, 1.])
+            d2_new = P2_(2, 0) * x_xi[0] + P2_(2, 1) * x_xi[1] + P2_(2, 2) * x_xi[2] + P2_(2, 3);    // P2_(2, :).dot([x_xi, 1.])
+
             /* Convergence criterium */
-            if ( ((fabs(d1_new - d1) <= tolerance) && (fabs(d2_new - d2) <= tolerance)) || 
+            if ( ((fabs(d1_new - d1) <= tolerance) && (fabs(d2_new - d2) <= tolerance)) ||
                     ((d1_new == 0) || (d2_new == 0)) ) {
                 break;
             }
-            
+
             /* Re-weight A matrix and b vector with the new depths */
-            cvScale(&A_01_mat, &A_01_mat, 1. / d1_new);    // A[0:2, :] /= d1_new
-            cvScale(&A_23_mat, &A_23_mat, 1. / d2_new);    // A[2:4, :] /= d2_new
-            cvScale(&b_01_vec, &b_01_vec, 1. / d1_new);    // b[0:2, :] /= d1_new
-            cvScale(&b_23_vec, &b_23_vec, 1. / d2_new);    // b[2:4, :] /= d2_new
-            
+            for (k = 0; k < 6; k++) {
+                A[k] *= 1. / d1_new;    // A[0:2, :] /= d1_new
+                A[6 + k] *= 1. / d2_new;    // A[2:4, :] /= d2_new
+            }
+            b[0] *= 1. / d1_new;    b[1] *= 1. / d1_new;    // b[0:2, :] /= d1_new
+            b[2] *= 1. / d2_new;    b[3] *= 1. / d2_new;    // b[2:4, :] /= d2_new
+
             /* Update depths */
             d1 = d1_new;
             d2 = d2_new;
         }
-        
+        store_point(x, x_is_float32, xi, x_xi);
+
         /* Set status */
-        x_status[xi] = ( (i < 10) &&                          // points should have converged by now
-                         ((d1_new > 0) && (d2_new > 0)) );    // points should be in front of both cameras
+        x_status[xi] = ((d1_new > 0) && (d2_new > 0));    // points should be in front of both cameras
         if (d1_new <= 0)
             x_status[xi] -= 1;    // behind 1st cam
         if (d2_new <= 0)
             x_status[xi] -= 2;    // behind 2nd cam
     }
+    Py_END_ALLOW_THREADS
+
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(set_num_threads_doc,
+"set_num_threads(num_threads)\n"
+"\n"
+"Set the amount of OpenMP threads used by the triangulation functions, 0 means OpenMP's default.");
+
+static PyObject *set_num_threads(PyObject *self, PyObject *args)
+{
+    int num_threads_;
+    if (!PyArg_ParseTuple(args, "i", &num_threads_))
+        return NULL;
+    if (num_threads_ < 0) {
+        PyErr_SetString(PyExc_ValueError, "the amount of threads should be at least 0");
+        return NULL;
+    }
+    num_threads = num_threads_;
+    Py_RETURN_NONE;
 }
+
+PyDoc_STRVAR(get_num_threads_doc,
+"get_num_threads()\n"
+"\n"
+"Returns the amount of OpenMP threads used by the triangulation functions, 1 if built without OpenMP.");
+
+static PyObject *get_num_threads(PyObject *self, PyObject *args)
+{
+    return Py_BuildValue("i", (num_threads > 0) ? num_threads : default_num_threads);
+}
+
+
+
+/* Module definition */
+
+static PyMethodDef triangulation_ext_methods[] = {
+    {"linear_LS_triangulation", linear_LS_triangulation, METH_VARARGS, linear_LS_triangulation_doc},
+    {"iterative_LS_triangulation", iterative_LS_triangulation, METH_VARARGS, iterative_LS_triangulation_doc},
+    {"set_num_threads", set_num_threads, METH_VARARGS, set_num_threads_doc},
+    {"get_num_threads", get_num_threads, METH_NOARGS, get_num_threads_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+#if PY_MAJOR_VERSION >= 3
+
+static struct PyModuleDef triangulation_ext_module = {
+    PyModuleDef_HEAD_INIT, "triangulation_ext", NULL, -1, triangulation_ext_methods
+};
+
+PyMODINIT_FUNC PyInit_triangulation_ext(void)
+{
+    save_default_num_threads();
+    import_array();
+    return PyModule_Create(&triangulation_ext_module);
+}
+
+#else
+
+PyMODINIT_FUNC inittriangulation_ext(void)
+{
+    save_default_num_threads();
+    Py_InitModule("triangulation_ext", triangulation_ext_methods);
+    import_array();
+}
+
+#endif
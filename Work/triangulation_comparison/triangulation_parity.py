@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function    # Python 3 compatibility
+
+import os
+from time import time
+import numpy as np
+from numpy import random
+import cv2
+
+import sys; sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "python_libs"))
+import transforms as trfm
+import triangulation
+import triangulation_legacy
+
+
+
+""" Legacy (per-point) triangulation implementations, used as reference """
+
+legacy_methods = {
+    "linear_eigen"  : triangulation_legacy.linear_eigen_triangulation,
+    "linear_LS"     : triangulation_legacy.linear_LS_triangulation,
+    "iterative_LS"  : triangulation_legacy.iterative_LS_triangulation,
+    "polynomial"    : triangulation_legacy.polynomial_triangulation }
+
+""" Test case """
+
+num_points = 2000
+noise_sigma = 1.e-3    # in normalized image coordinates
+max_rel_error = 1.e-6    # relative to the distance of the point to the 1st cam
+rseed = 123456789
+
+def random_scene(num_points):
+    """
+    Returns 2 camera matrices and "num_points" noisy normalized 2D point matches,
+    a few percent of the points lay behind the 2nd cam, behind the 1st cam, and behind both cams, respectively.
+    """
+    P1 = np.eye(3, 4)
+    P2 = trfm.P_from_R_and_t(cv2.Rodrigues(np.array([0.05, -0.2, 0.02]))[0], np.array([[-1., 0.1, 0.3]]).T)[0:3, :]
+    
+    points = np.concatenate((
+            random.uniform(-3, 3, (num_points, 2)), random.uniform(2, 12, (num_points, 1)), np.ones((num_points, 1)) ), axis=1)
+    k = num_points // 50
+    points[0:k, 0] -= 60.    # far sideways, behind the 2nd cam (its depth is about 0.2 * x + z + 0.3)
+    points[k:2*k, 0] += 60.; points[k:2*k, 2] *= -1    # behind the 1st cam, in front of the 2nd cam
+    points[2*k:3*k, 2] *= -1    # behind both cams
+    
+    u1 = P1.dot(points.T).T; u1 = u1[:, 0:2] / u1[:, 2:3]
+    u2 = P2.dot(points.T).T; u2 = u2[:, 0:2] / u2[:, 2:3]
+    u1 += random.normal(0, noise_sigma, u1.shape)
+    u2 += random.normal(0, noise_sigma, u2.shape)
+    
+    return P1, P2, u1, u2
+
+def main(backend="numpy"):
+    """Compare the "backend" implementations of "triangulation.triangulate()" against the legacy ones."""
+    random.seed(rseed)
+    P1, P2, u1, u2 = random_scene(num_points)
+    
+    all_ok = True
+    methods = sorted(legacy_methods)
+    if backend == "c":
+        methods = ["iterative_LS", "linear_LS"]    # only methods with a C implementation
+    for method in methods:
+        t0 = time()
+        x_legacy, status_legacy = legacy_methods[method](u1, P1, u2, P2)
+        t1 = time()
+        x, status = triangulation.triangulate(u1, P1, u2, P2, method=method, backend=backend)
+        t2 = time()
+        
+        valid = np.isfinite(x_legacy).all(axis=1)
+        rel_error = np.max(np.sqrt(np.sum((x[valid] - x_legacy[valid])**2, axis=1)) /
+                           np.sqrt(np.sum(x_legacy[valid]**2, axis=1)))
+        statuses_equal = (status == status_legacy).all()
+        ok = statuses_equal and rel_error <= max_rel_error
+        all_ok = all_ok and ok
+        
+        print ("%-13s max rel error: %.2e    statuses: %-6s    legacy: %.4fs    batched: %.4fs    %s" % (
+                method, rel_error, ("equal" if statuses_equal else "differ"), t1 - t0, t2 - t1,
+                ("OK" if ok else "MISMATCH")))
+    
+    # The scene should contain points behind each camera, to compare the statuses of all cases
+    status_legacy = legacy_methods["iterative_LS"](u1, P1, u2, P2)[1]
+    for s in (1, -1, -2, -3):
+        if not (status_legacy == s).any():
+            print ("MISMATCH: the scene has no points with iterative_LS status %d" % s)
+            all_ok = False
+    
+    # Also verify the datatype of the output
+    x, status = triangulation.triangulate(u1, P1, u2, P2, dtype=np.float32, backend=backend)
+    if x.dtype != np.float32:
+        print ("MISMATCH: requested float32 output, got %s" % x.dtype)
+        all_ok = False
+    
+    return all_ok
+
+
+if __name__ == "__main__":
+    sys.exit(not main(*sys.argv[1:2]))    # optional argument: "numpy" (default) or "c"